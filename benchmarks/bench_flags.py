@@ -0,0 +1,60 @@
+"""Microbenchmark for the per-Code cost of flag handling.
+
+Run with ``python benchmarks/bench_flags.py``.
+"""
+from timeit import repeat
+
+from codetransformer.code import Code, Flag
+from codetransformer.instructions import LOAD_CONST, RETURN_VALUE
+
+
+def _best(stmt, number, **namespace):
+    """The best time per call of ``stmt`` in microseconds.
+    """
+    return min(repeat(stmt, number=number, repeat=5, globals=namespace)) / (
+        number / 1e6
+    )
+
+
+def main(number=20000):
+    def f(a, *args, b, **kwargs):
+        return a
+
+    co = f.__code__
+    instrs = LOAD_CONST(None), RETURN_VALUE()
+    code = Code.from_pycode(co)
+
+    cases = [
+        ('Flag.max', 'Flag.max', dict(Flag=Flag)),
+        (
+            'Flag.unpack',
+            'Flag.unpack(mask)',
+            dict(Flag=Flag, mask=co.co_flags),
+        ),
+        (
+            'Code(instrs)',
+            'Code(instrs, ("a",))',
+            dict(Code=Code, instrs=instrs),
+        ),
+        (
+            'Code(instrs, flags=dict)',
+            'Code(instrs, ("a",), flags=flags)',
+            dict(Code=Code, instrs=instrs, flags=code.flags),
+        ),
+        (
+            'Code(instrs, flags=int)',
+            'Code(instrs, ("a",), flags=flags)',
+            dict(Code=Code, instrs=instrs, flags=code.py_flags),
+        ),
+        (
+            'Code.from_pycode(lazy=True)',
+            'Code.from_pycode(co, lazy=True)',
+            dict(Code=Code, co=co),
+        ),
+    ]
+    for name, stmt, namespace in cases:
+        print('%-30s %8.2fus' % (name, _best(stmt, number, **namespace)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Command line interface for codetransformer.
+
+``python -m codetransformer compile TRANSFORMER PATH...`` writes the
+transformed bytecode for a source tree ahead of time so that
+:class:`~codetransformer.importer.TransformerFinder` can import it without
+transforming anything.
+"""
+from argparse import ArgumentParser
+import sys
+
+from .importer import compile_paths
+
+
+def main(argv=None):
+    """Run the command line interface.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        The arguments, not including the program name. By default,
+        ``sys.argv[1:]``.
+
+    Returns
+    -------
+    status : int
+        The exit status.
+    """
+    parser = ArgumentParser(prog='python -m codetransformer')
+    subparsers = parser.add_subparsers(dest='command')
+
+    compile_parser = subparsers.add_parser(
+        'compile',
+        help='write transformed bytecode for source files ahead of time',
+    )
+    compile_parser.add_argument(
+        'transformer',
+        help='the transformer to apply, as module:attribute',
+    )
+    compile_parser.add_argument(
+        'paths',
+        nargs='+',
+        help='the source files and directories to compile',
+    )
+    compile_parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help='the number of processes to use, by default one per cpu',
+    )
+    compile_parser.add_argument(
+        '-f',
+        '--force',
+        action='store_true',
+        help='transform files even if their bytecode is up to date',
+    )
+    compile_parser.add_argument(
+        '-q',
+        '--quiet',
+        action='store_true',
+        help='do not list the files that were transformed',
+    )
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    try:
+        written, failed = compile_paths(
+            args.transformer,
+            args.paths,
+            jobs=args.jobs,
+            force=args.force,
+        )
+    except (ImportError, AttributeError, TypeError, ValueError) as e:
+        parser.error(str(e))
+
+    if not args.quiet:
+        for path in written:
+            print('transformed %s' % path)
+    for path in failed:
+        print(
+            'could not write %s: the transformed code cannot be marshalled'
+            % path,
+            file=sys.stderr,
+        )
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
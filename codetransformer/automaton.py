@@ -0,0 +1,498 @@
+"""
+codetransformer.automaton
+-------------------------
+
+The engine used to match patterns against opcodes.
+
+Patterns are compiled into a nondeterministic finite automaton with
+Thompson's construction which is then turned into a deterministic automaton
+one state at a time while matching. Each opcode is looked at once per match,
+so matching time is linear in the number of instructions scanned no matter
+how the pattern is written.
+"""
+from threading import Lock
+
+#: Every opcode.
+ALL_OPCODES = frozenset(range(256))
+
+#: The largest number of states that ``NFA.complement`` will create before
+#: giving up.
+MAX_COMPLEMENT_STATES = 10000
+
+
+class NFA:
+    """A nondeterministic finite automaton over opcodes.
+
+    States are ints. Each state has a list of epsilon transitions and a list
+    of ``(opcodes, target, guard)`` transitions. The methods that build
+    fragments return a ``(start, end)`` pair of states where ``end`` has no
+    outgoing transitions yet.
+
+    Attributes
+    ----------
+    accepts : dict[int -> any]
+        The accepting states mapped to the tag that is reported when they are
+        reached.
+    """
+    def __init__(self):
+        self._epsilons = []
+        self._edges = []
+        self.accepts = {}
+
+    def __len__(self):
+        return len(self._edges)
+
+    def state(self):
+        """Create a new state.
+
+        Returns
+        -------
+        state : int
+            The new state.
+        """
+        self._epsilons.append([])
+        self._edges.append([])
+        return len(self._edges) - 1
+
+    def epsilon(self, source, target):
+        """Add a transition that does not consume an opcode.
+        """
+        self._epsilons[source].append(target)
+
+    def edge(self, source, opcodes, target, guard=None):
+        """Add a transition that consumes one of ``opcodes``.
+
+        Parameters
+        ----------
+        source, target : int
+            The states to connect.
+        opcodes : iterable of int
+            The opcodes that may be consumed.
+        guard : callable[(any, Instruction) -> bool], optional
+            A function called with the matching context and the instruction
+            being consumed. The transition is only taken if this returns
+            True.
+        """
+        self._edges[source].append((frozenset(opcodes), target, guard))
+
+    def closure(self, states):
+        """The states reachable from ``states`` without consuming an opcode.
+
+        Parameters
+        ----------
+        states : iterable of int
+            The states to start from.
+
+        Returns
+        -------
+        closure : frozenset[int]
+            The closure of ``states``.
+        """
+        epsilons = self._epsilons
+        stack = list(states)
+        seen = set(stack)
+        while stack:
+            for target in epsilons[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+    def move(self, states, opcode):
+        """The states reached from ``states`` by consuming ``opcode``.
+
+        Parameters
+        ----------
+        states : iterable of int
+            The states to start from. These should already be closed.
+        opcode : int
+            The opcode to consume.
+
+        Returns
+        -------
+        states : frozenset[int]
+            The closure of the states that were reached.
+        """
+        edges = self._edges
+        return self.closure(
+            target
+            for state in states
+            for opcodes, target, guard in edges[state]
+            if opcode in opcodes and guard is None
+        )
+
+    def guarded_moves(self, states, opcode):
+        """The guarded transitions out of ``states`` on ``opcode``.
+
+        Parameters
+        ----------
+        states : iterable of int
+            The states to start from.
+        opcode : int
+            The opcode to consume.
+
+        Returns
+        -------
+        moves : list[(callable, int)]
+            The guard and target of each transition.
+        """
+        edges = self._edges
+        return [
+            (guard, target)
+            for state in states
+            for opcodes, target, guard in edges[state]
+            if opcode in opcodes and guard is not None
+        ]
+
+    def reverse(self, start, end):
+        """An NFA that matches the reverse of a fragment.
+
+        Parameters
+        ----------
+        start, end : int
+            The fragment to reverse.
+
+        Returns
+        -------
+        reversed : NFA
+            The new NFA. ``start`` is its accepting state with the tag 0.
+        start : int
+            The state to start matching from in the new NFA.
+        """
+        reversed_ = NFA()
+        for _ in range(len(self)):
+            reversed_.state()
+        for source, targets in enumerate(self._epsilons):
+            for target in targets:
+                reversed_.epsilon(target, source)
+        for source, edges in enumerate(self._edges):
+            for opcodes, target, guard in edges:
+                reversed_.edge(target, opcodes, source, guard)
+        reversed_.accepts[start] = 0
+        return reversed_, end
+
+    def empty(self):
+        """A fragment that matches no instructions.
+        """
+        state = self.state()
+        return state, state
+
+    def symbol(self, opcodes, guard=None):
+        """A fragment that matches one instruction with an opcode in
+        ``opcodes``.
+        """
+        start = self.state()
+        end = self.state()
+        self.edge(start, opcodes, end, guard)
+        return start, end
+
+    def concat(self, fragments):
+        """A fragment that matches each of ``fragments`` in order.
+        """
+        fragments = iter(fragments)
+        start, end = next(fragments)
+        for next_start, next_end in fragments:
+            self.epsilon(end, next_start)
+            end = next_end
+        return start, end
+
+    def union(self, fragments):
+        """A fragment that matches any one of ``fragments``.
+        """
+        start = self.state()
+        end = self.state()
+        for fragment_start, fragment_end in fragments:
+            self.epsilon(start, fragment_start)
+            self.epsilon(fragment_end, end)
+        return start, end
+
+    def star(self, fragment):
+        """A fragment that matches ``fragment`` zero or more times.
+        """
+        fragment_start, fragment_end = fragment
+        start = self.state()
+        end = self.state()
+        self.epsilon(start, fragment_start)
+        self.epsilon(start, end)
+        self.epsilon(fragment_end, fragment_start)
+        self.epsilon(fragment_end, end)
+        return start, end
+
+    def plus(self, fragment):
+        """A fragment that matches ``fragment`` one or more times.
+        """
+        fragment_start, fragment_end = fragment
+        end = self.state()
+        self.epsilon(fragment_end, fragment_start)
+        self.epsilon(fragment_end, end)
+        return fragment_start, end
+
+    def option(self, fragment):
+        """A fragment that matches ``fragment`` zero or one times.
+        """
+        fragment_start, fragment_end = fragment
+        start = self.state()
+        end = self.state()
+        self.epsilon(start, fragment_start)
+        self.epsilon(start, end)
+        self.epsilon(fragment_end, end)
+        return start, end
+
+    def repeat(self, build, n, m=None):
+        """A fragment that matches a fragment between ``n`` and ``m`` times.
+
+        Parameters
+        ----------
+        build : callable[NFA -> (int, int)]
+            A function that builds a new copy of the fragment in this NFA.
+        n : int
+            The least number of times to match.
+        m : int, optional
+            The most number of times to match. If not given, there is no
+            upper bound.
+        """
+        fragments = [build(self) for _ in range(n)]
+        if m is None:
+            fragments.append(self.star(build(self)))
+        else:
+            fragments.extend(self.option(build(self)) for _ in range(m - n))
+
+        if not fragments:
+            return self.empty()
+        return self.concat(fragments)
+
+    def complement(self, build):
+        """A fragment that matches the sequences of instructions that do not
+        contain a match of another fragment.
+
+        Parameters
+        ----------
+        build : callable[NFA -> (int, int)]
+            A function that builds the fragment to complement in an NFA.
+
+        Notes
+        -----
+        The fragment is built in a separate NFA for ``.* fragment .*`` which
+        is turned into a deterministic automaton up front. The states that
+        have not yet seen a match are copied into this NFA and all accept, the
+        rest are dropped. This can create exponentially many states in the
+        size of the fragment.
+
+        Fragments with guarded transitions cannot be complemented.
+        """
+        sub = NFA()
+        sub_start = sub.state()
+        sub.edge(sub_start, ALL_OPCODES, sub_start)
+        fragment_start, fragment_end = build(sub)
+        sub.epsilon(sub_start, fragment_start)
+        seen = sub.state()
+        sub.epsilon(fragment_end, seen)
+        sub.edge(seen, ALL_OPCODES, seen)
+
+        # Only the opcodes that some edge tells apart need to be tried.
+        classes = {}
+        for edges in sub._edges:
+            for opcodes, _, guard in edges:
+                if guard is not None:
+                    raise TypeError(
+                        'cannot negate a pattern that uses where',
+                    )
+                for opcode in opcodes:
+                    classes.setdefault(opcode, set()).add(opcodes)
+        alphabet = {}
+        for opcode, labels in classes.items():
+            alphabet.setdefault(frozenset(labels), []).append(opcode)
+
+        start = sub.closure((sub_start,))
+        end = self.state()
+        if seen in start:
+            # The fragment matches nothing so everything contains a match.
+            return self.state(), end
+
+        states = {start: self.state()}
+        stack = [start]
+        while stack:
+            current = stack.pop()
+            source = states[current]
+            self.epsilon(source, end)
+            for opcodes in alphabet.values():
+                target = sub.move(current, opcodes[0])
+                if seen in target:
+                    continue
+                try:
+                    target_state = states[target]
+                except KeyError:
+                    if len(states) >= MAX_COMPLEMENT_STATES:
+                        raise ValueError(
+                            'pattern is too complex to complement',
+                        )
+                    target_state = states[target] = self.state()
+                    stack.append(target)
+                self.edge(source, opcodes, target_state)
+
+        return states[start], end
+
+
+class DFA:
+    """A deterministic automaton that is built from an NFA as it is used.
+
+    Parameters
+    ----------
+    nfa : NFA
+        The automaton to run.
+    start : int
+        The start state in ``nfa``.
+
+    Notes
+    -----
+    Each state of the DFA is a set of NFA states. A transition is computed the
+    first time it is taken and is a list lookup after that. The number of DFA
+    states that are built is at most the number of opcodes that have been
+    matched against.
+
+    Transitions that depend on guards are stored in the table as the negative
+    index of an entry in ``_guarded`` which holds the guards to call and the
+    state to go to for each combination of their results.
+    """
+    def __init__(self, nfa, start):
+        self._nfa = nfa
+        self._lock = Lock()
+        self._ids = {}
+        self._sets = []
+        self._table = []
+        self._tags = []
+        self._guarded = []
+        # State 0 is the dead state which matches nothing.
+        self._add(frozenset())
+        self._start = self._add(nfa.closure((start,)))
+
+    def __len__(self):
+        return len(self._sets)
+
+    def _add(self, states):
+        try:
+            return self._ids[states]
+        except KeyError:
+            pass
+
+        accepts = self._nfa.accepts
+        id_ = self._ids[states] = len(self._sets)
+        self._sets.append(states)
+        self._table.append([None] * 256)
+        self._tags.append(tuple({
+            accepts[state] for state in states if state in accepts
+        }))
+        return id_
+
+    def _step(self, state, opcode):
+        with self._lock:
+            next_ = self._table[state][opcode]
+            if next_ is None:
+                nfa = self._nfa
+                states = self._sets[state]
+                unguarded = nfa.move(states, opcode)
+                moves = nfa.guarded_moves(states, opcode)
+                if not moves:
+                    next_ = self._add(unguarded)
+                else:
+                    guards = tuple({guard for guard, _ in moves})
+                    self._guarded.append((guards, moves, unguarded, {}))
+                    next_ = -len(self._guarded)
+                self._table[state][opcode] = next_
+            return next_
+
+    def _resolve(self, guarded, instr, context):
+        guards, moves, unguarded, targets = self._guarded[-guarded - 1]
+        results = tuple(guard(context, instr) for guard in guards)
+        try:
+            return targets[results]
+        except KeyError:
+            pass
+
+        passed = {guard for guard, result in zip(guards, results) if result}
+        with self._lock:
+            target = targets[results] = self._add(
+                unguarded | self._nfa.closure(
+                    target for guard, target in moves if guard in passed
+                ),
+            )
+        return target
+
+    def match(self, opcodes, pos=0, instrs=None, context=None):
+        """Find the non-empty matches that start at ``pos``.
+
+        Parameters
+        ----------
+        opcodes : bytes
+            The opcodes to match against.
+        pos : int, optional
+            The index to start matching at.
+        instrs : sequence of Instruction, optional
+            The instructions for ``opcodes``. These are passed to the guards
+            and are required if the NFA has any guarded transitions.
+        context : any, optional
+            The first argument passed to the guards.
+
+        Returns
+        -------
+        ends : list[(any, int)]
+            The tag of each accepting state that was reached paired with the
+            end of the longest match for that tag, sorted by tag.
+        """
+        table = self._table
+        tags = self._tags
+        ends = {}
+        state = self._start
+        for idx in range(pos, len(opcodes)):
+            opcode = opcodes[idx]
+            next_ = table[state][opcode]
+            if next_ is None:
+                next_ = self._step(state, opcode)
+            if next_ < 0:
+                next_ = self._resolve(next_, instrs[idx], context)
+            state = next_
+            if not state:
+                # Nothing can match from here.
+                break
+            for tag in tags[state]:
+                ends[tag] = idx + 1
+        return sorted(ends.items())
+
+    def accepting(self, opcodes, indices, instrs=None, context=None):
+        """Find the lengths of all of the matches along some indices.
+
+        Parameters
+        ----------
+        opcodes : bytes
+            The opcodes to match against.
+        indices : iterable of int
+            The indices of the opcodes to consume, in order. These may run
+            backwards to match with a reversed NFA.
+        instrs : sequence of Instruction, optional
+            The instructions for ``opcodes``.
+        context : any, optional
+            The first argument passed to the guards.
+
+        Returns
+        -------
+        lengths : list[int]
+            The number of opcodes consumed for each match in increasing
+            order. This includes 0 if the empty sequence matches.
+        """
+        table = self._table
+        tags = self._tags
+        state = self._start
+        lengths = [0] if tags[state] else []
+        for n, idx in enumerate(indices, 1):
+            opcode = opcodes[idx]
+            next_ = table[state][opcode]
+            if next_ is None:
+                next_ = self._step(state, opcode)
+            if next_ < 0:
+                next_ = self._resolve(next_, instrs[idx], context)
+            state = next_
+            if not state:
+                break
+            if tags[state]:
+                lengths.append(n)
+        return lengths
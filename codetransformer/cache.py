@@ -0,0 +1,513 @@
+"""
+codetransformer.cache
+---------------------
+
+Caches for the results of code transformers.
+"""
+from collections import OrderedDict, namedtuple
+from hashlib import sha256
+from importlib.util import MAGIC_NUMBER
+import marshal
+import os
+from tempfile import mkstemp
+from threading import Lock
+from types import CodeType
+
+from .code import Code, fingerprint_const
+
+
+#: The statistics of a :class:`~codetransformer.cache.TransformCache`.
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+_literal_types = frozenset({
+    str,
+    bytes,
+    int,
+    bool,
+    float,
+    complex,
+    type(None),
+    type(Ellipsis),
+})
+
+
+def _fingerprintable(const):
+    """Does :func:`~codetransformer.code.fingerprint_const` tell this
+    constant apart from every other value?
+
+    Objects without a known encoding are fingerprinted by their ``repr``
+    which may be shared by unequal objects.
+    """
+    type_ = type(const)
+    if type_ in _literal_types:
+        return True
+    if type_ is tuple or type_ is frozenset:
+        return all(map(_fingerprintable, const))
+    if type_ is CodeType:
+        return all(map(_fingerprintable, const.co_consts))
+    if isinstance(const, Code):
+        return all(map(_fingerprintable, const.consts))
+    return False
+
+
+def _pycode_key(co):
+    """The raw bytecode and metadata of a python code object, with the
+    nested code objects replaced by their own keys.
+    """
+    return (
+        co.co_code,
+        tuple(
+            _pycode_key(const)
+            if type(const) is CodeType else
+            fingerprint_const(const)
+            for const in co.co_consts
+        ),
+        co.co_names,
+        co.co_varnames,
+        co.co_freevars,
+        co.co_cellvars,
+        co.co_argcount,
+        co.co_kwonlyargcount,
+        co.co_flags,
+        co.co_name,
+        co.co_filename,
+        co.co_firstlineno,
+        co.co_lnotab,
+    )
+
+
+def code_key(code):
+    """The part of a cache key that identifies a code object.
+
+    Parameters
+    ----------
+    code : Code
+        The code object to identify.
+
+    Returns
+    -------
+    key : tuple or None
+        The bytecode of the code object along with its constants, names, and
+        line numbers. This is None if the code object has constants that
+        cannot be told apart from unequal values.
+
+    Notes
+    -----
+    A code object that has not changed since it was created with
+    ``Code.from_pycode`` is keyed by the python code object it was created
+    from, so a lazy code object is never decoded. Other code objects are
+    assembled first.
+    """
+    co = code.to_pycode(reuse=True)
+    if not _fingerprintable(co):
+        return None
+    return _pycode_key(co)
+
+
+def freeze(ob):
+    """Convert an object into a hashable one for use in a cache key.
+
+    Parameters
+    ----------
+    ob : any
+        The object to freeze.
+
+    Returns
+    -------
+    frozen : hashable
+        ``ob`` with dicts, lists, and sets replaced by hashable equivalents.
+        Every value is paired with its type so that equal values of
+        different types, like ``1`` and ``1.0``, are kept apart.
+
+    Raises
+    ------
+    TypeError
+        Raised when ``ob`` contains an object that cannot be hashed.
+    """
+    type_ = type(ob)
+    if isinstance(ob, dict):
+        return type_, frozenset((k, freeze(v)) for k, v in ob.items())
+    if type_ is list or type_ is tuple:
+        return type_, tuple(map(freeze, ob))
+    if type_ is set or type_ is frozenset:
+        return type_, frozenset(map(freeze, ob))
+    hash(ob)
+    return type_, ob
+
+
+class TransformCache:
+    """A bounded cache of transformed code objects with least recently used
+    eviction.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The most number of results to keep.
+
+    Notes
+    -----
+    Results are stored as python code objects so that cached results cannot
+    be changed by the caller. Set this as the ``cache`` attribute of a
+    :class:`~codetransformer.core.CodeTransformer` instance or class to use
+    it.
+
+    Examples
+    --------
+    >>> from codetransformer.transformers import asconstants
+    >>> cache = TransformCache(maxsize=16)
+    >>> t = asconstants('len')
+    >>> t.cache = cache
+    >>> def f(a):
+    ...     return len(a)
+    ...
+    >>> g = t(f)
+    >>> h = t(f)
+    >>> g.__code__ is h.__code__
+    True
+    >>> cache.info()
+    CacheInfo(hits=1, misses=1, maxsize=16, currsize=1)
+    """
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive, got %r' % maxsize)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Look up a result.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to look up.
+        default : any, optional
+            The value to return if ``key`` is not in the cache.
+
+        Returns
+        -------
+        value : any
+            The cached value or ``default``.
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store a result, evicting the least recently used one if the cache
+        is full.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to store the result under.
+        value : any
+            The result to store.
+        """
+        with self._lock:
+            data = self._data
+            data[key] = value
+            data.move_to_end(key)
+            if len(data) > self.maxsize:
+                data.popitem(last=False)
+
+    def clear(self):
+        """Remove all of the results and reset the statistics.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """The statistics of this cache.
+
+        Returns
+        -------
+        info : CacheInfo
+            The hits, misses, maximum size, and current size.
+        """
+        with self._lock:
+            return CacheInfo(
+                self.hits,
+                self.misses,
+                self.maxsize,
+                len(self._data),
+            )
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<{cls}: {info}>'.format(
+            cls=type(self).__name__,
+            info=self.info(),
+        )
+
+
+def _stable_encode(ob):
+    """Encode a cache key as bytes that are the same in every process.
+
+    Parameters
+    ----------
+    ob : hashable
+        The key to encode, like the ones built by :func:`freeze`.
+
+    Returns
+    -------
+    encoded : bytes
+        The encoded key.
+
+    Raises
+    ------
+    TypeError
+        Raised when ``ob`` contains an object whose identity is not stable
+        across processes, like a function or a class defined in a function.
+    """
+    return fingerprint_const(ob, fallback=_stable_encode_type)
+
+
+def _stable_encode_type(ob):
+    """Encode the parts of a cache key that :func:`fingerprint_const` does
+    not know how to encode.
+
+    Only classes that can be found by their qualified name are stable across
+    processes.
+    """
+    if isinstance(ob, type) and '<locals>' not in ob.__qualname__:
+        return ('T%s.%s' % (ob.__module__, ob.__qualname__)).encode(
+            'utf-8',
+            'surrogatepass',
+        )
+    raise TypeError('%r cannot be part of a persistent cache key' % (ob,))
+
+
+class DiskCache:
+    """A cache of transformed code objects stored in a directory so that
+    results are shared across processes and survive restarts.
+
+    Parameters
+    ----------
+    path : str
+        The directory to store the results in. It is created if it does not
+        exist.
+    max_bytes : int, optional
+        The most number of bytes of results to keep.
+
+    Notes
+    -----
+    Results are marshalled, so transformations that produce constants that
+    cannot be marshalled are not stored. The keys include the transformer's
+    module and qualified name but not its source, so remove the directory
+    when a transformer's behavior changes. Results from other versions of
+    Python or codetransformer are never used.
+
+    Each result is written to a temporary file which is then renamed into
+    place, so readers never see partial results. When the directory grows
+    past ``max_bytes`` the least recently used results are removed until it
+    is at three quarters of ``max_bytes``.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from codetransformer.transformers import asconstants
+    >>> path = tempfile.mkdtemp()
+    >>> t = asconstants(a=1)
+    >>> t.cache = DiskCache(path)
+    >>> def f():
+    ...     return a
+    ...
+    >>> t(f)()
+    1
+    >>> t.cache = DiskCache(path)  # as if in a new process
+    >>> t(f)()
+    1
+    >>> t.cache.info().hits
+    1
+    """
+    _magic = b'ctc\x00' + MAGIC_NUMBER
+    _suffix = '.ctc'
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        if max_bytes < 1:
+            raise ValueError('max_bytes must be positive, got %r' % max_bytes)
+
+        from codetransformer import __version__
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._salt = _stable_encode((MAGIC_NUMBER, __version__))
+        self._lock = Lock()
+        # An upper bound on the size of the directory, None until the
+        # directory has been scanned.
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+
+    def _filename(self, key):
+        try:
+            encoded = _stable_encode(key)
+        except TypeError:
+            return None
+        return os.path.join(
+            self.path,
+            sha256(self._salt + encoded).hexdigest() + self._suffix,
+        )
+
+    def _entries(self):
+        """The results in the directory.
+
+        Returns
+        -------
+        entries : list[(float, int, str)]
+            The last use time, size, and filename of each result.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self._suffix):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def get(self, key, default=None):
+        """Look up a result.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to look up.
+        default : any, optional
+            The value to return if ``key`` is not in the cache or cannot be
+            stored on disk.
+
+        Returns
+        -------
+        value : any
+            The cached value or ``default``.
+        """
+        filename = self._filename(key)
+        if filename is None:
+            return default
+
+        magic = self._magic
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            if not data.startswith(magic):
+                raise ValueError('bad cache file: %r' % filename)
+            value = marshal.loads(memoryview(data)[len(magic):])
+        except (OSError, EOFError, ValueError, TypeError):
+            with self._lock:
+                self.misses += 1
+            return default
+
+        try:
+            # mark the result as recently used
+            os.utime(filename)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store a result, removing the least recently used ones if the
+        directory is full.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to store the result under.
+        value : any
+            The result to store. This must be marshallable.
+        """
+        filename = self._filename(key)
+        if filename is None:
+            return
+        try:
+            data = self._magic + marshal.dumps(value)
+        except ValueError:
+            return
+
+        fd, tmp = mkstemp(dir=self.path, prefix='.', suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, filename)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+            if self._size is None or self._size > self.max_bytes:
+                self._prune()
+
+    def _prune(self):
+        entries = self._entries()
+        size = sum(entry[1] for entry in entries)
+        if size > self.max_bytes:
+            target = self.max_bytes * 3 // 4
+            entries.sort()
+            for _, entry_size, filename in entries:
+                if size <= target:
+                    break
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    continue
+                size -= entry_size
+        self._size = size
+
+    def clear(self):
+        """Remove all of the results and reset the statistics.
+        """
+        with self._lock:
+            for _, _, filename in self._entries():
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+            self._size = 0
+            self.hits = self.misses = 0
+
+    def info(self):
+        """The statistics of this cache.
+
+        Returns
+        -------
+        info : CacheInfo
+            The hits, misses, ``max_bytes``, and the current size of the
+            directory in bytes.
+        """
+        size = sum(entry[1] for entry in self._entries())
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.max_bytes, size)
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __repr__(self):
+        return '<{cls}: {path!r}>'.format(
+            cls=type(self).__name__,
+            path=self.path,
+        )
@@ -1,14 +1,29 @@
+from array import array
 from collections import OrderedDict
-from dis import Bytecode, dis, findlinestarts
+from collections.abc import Sequence
+from dis import (
+    EXTENDED_ARG,
+    HAVE_ARGUMENT,
+    dis,
+    findlinestarts,
+    hasjabs,
+    hasjrel,
+)
 from enum import IntEnum, unique
-from functools import reduce
-from itertools import repeat
+from functools import reduce, wraps
+from importlib.util import MAGIC_NUMBER
+from itertools import accumulate, chain
+import marshal
 import operator as op
+import pickle
+from struct import Struct
 import sys
-from types import CodeType
+from threading import RLock
+from types import CodeType, MappingProxyType
 
 from .instructions import (
     Instruction,
+    InstructionMeta,
     LOAD_CONST,
     YIELD_FROM,
     YIELD_VALUE,
@@ -23,42 +38,98 @@ WORDCODE = sys.version_info >= (3, 6)
 if WORDCODE:
     argsize = 1
     max_lnotab_increment = 127
-
-    def _sparse_args(instrs):
-        for instr in instrs:
-            yield instr
-            yield None
-
 else:
     argsize = 2
     max_lnotab_increment = 255
 
-    def _sparse_args(instrs):
-        for instr in instrs:
-            yield instr
-            if instr.have_arg:
-                yield None
-                yield None
+max_lnotab_addr_increment = 255
+
+if sys.version_info >= (3, 6):
+    from hashlib import blake2b as _fingerprint_hash
+else:
+    from hashlib import sha256 as _fingerprint_hash
+
+_jump_opcodes = frozenset(hasjabs + hasjrel)
+_arg_mask = (1 << (8 * argsize)) - 1
+
+# The header of a serialized Code object: the magic bytes, the format
+# version, whether the arguments are little endian, the size of each
+# argument, and the number of instructions. The header is a multiple of 4
+# bytes so the arguments that follow it are aligned.
+_dump_header = Struct('<4sBBBxI')
+_dump_magic = b'ctco'
+_dump_version = 2
+# The array typecode for unsigned integers of each size, preferring 'I'
+# which is what the arguments are written with.
+_dump_arg_typecodes = {array(t).itemsize: t for t in 'QLIH'}
+# The kinds of constants that are not stored directly in the marshalled
+# metadata.
+_DUMP_CODE = 0
+_DUMP_PICKLE = 1
+
+
+def _instr_size(arg):
+    """The number of bytes needed to write an instruction, including any
+    EXTENDED_ARG prefixes.
+
+    Parameters
+    ----------
+    arg : int or None
+        The raw argument to the instruction or None if the instruction does
+        not take an argument.
+
+    Returns
+    -------
+    size : int
+        The size of the instruction in bytes.
+    """
+    if arg is None:
+        # with wordcode, all instructions are padded to 2 bytes
+        return 1 + argsize if WORDCODE else 1
 
+    if arg < 0:
+        raise ValueError('instruction argument cannot be negative: %d' % arg)
 
-_sparse_args.__doc__ = """\
-Makes the arguments sparse so that instructions live at the correct index for
-the jump resolution step.
+    size = 1 + argsize
+    arg >>= 8 * argsize
+    while arg:
+        size += 1 + argsize
+        arg >>= 8 * argsize
+    return size
 
-This pads the instruction set with None to mark the bytes occupied by
-arguments.
 
-Parameters
-----------
-instrs : iterable of Instruction
-    The dense instruction set.
+def _write_instr(bc, opcode, arg, size):
+    """Write an instruction and its EXTENDED_ARG prefixes to a bytearray.
 
-Yields
-------
-sparse : Instruction or None
-    Yields the instructions, with objects marking the bytes that are used for
-    arguments.
-"""
+    Parameters
+    ----------
+    bc : bytearray
+        The bytecode to write into.
+    opcode : int
+        The opcode of the instruction.
+    arg : int or None
+        The raw argument to the instruction or None if the instruction does
+        not take an argument.
+    size : int
+        The size of the instruction from ``_instr_size``. This may be larger
+        than ``arg`` needs, in which case the extra prefixes are zero.
+    """
+    if arg is None:
+        bc.append(opcode)
+        if WORDCODE:
+            bc.append(0)
+        return
+
+    for shift in reversed(range(1, size // (1 + argsize))):
+        bc.append(EXTENDED_ARG)
+        bc.extend(
+            ((arg >> (8 * argsize * shift)) & _arg_mask).to_bytes(
+                argsize,
+                'little',
+            ),
+        )
+    bc.append(opcode)
+    bc.extend((arg & _arg_mask).to_bytes(argsize, 'little'))
 
 
 @unique
@@ -101,7 +172,7 @@ class Flag(IntEnum):
         """The largest bitmask that represents a valid flag.
         """
         def __get__(self, instance, owner):
-            return owner.pack(**dict(zip(owner.__members__, repeat(True))))
+            return _flag_max
 
         def __set__(self, instance, value):
             raise AttributeError("can't set 'max' attribute")
@@ -159,7 +230,7 @@ class Flag(IntEnum):
         ls = locals()
         return reduce(
             op.or_,
-            (v for k, v in cls.__members__.items() if ls[k]),
+            (v for k, v in _flag_values.items() if ls[k]),
             0,
         )
 
@@ -181,40 +252,282 @@ class Flag(IntEnum):
         --------
         codetransformer.code.Flag.pack
         """
-        if mask > cls.max:
+        if mask > _flag_max:
             raise ValueError('Invalid mask, too large: %d' % mask)
 
         return OrderedDict(
-            (k, bool(mask & getattr(cls, k)))
-            for k, v in cls.__members__.items()
+            (k, bool(mask & v)) for k, v in _flag_values.items()
         )
 
 
-def _freevar_argname(arg, cellvars, freevars):
+# The flags as plain ints. Looking up a member on an enum class goes through
+# ``EnumMeta.__getattr__`` and the results are ``Flag`` instances, both of
+# which are slow enough to matter when creating many code objects.
+_flag_values = OrderedDict(
+    (name, int(flag)) for name, flag in Flag.__members__.items()
+)
+_flag_max = reduce(op.or_, _flag_values.values(), 0)
+
+
+def _opcodes(co):
+    """Read the opcodes of a python code object without decoding the
+    instructions.
+
+    Parameters
+    ----------
+    co : CodeType
+        The python code object.
+
+    Returns
+    -------
+    opcodes : bytes
+        The opcode of each instruction, skipping ``EXTENDED_ARG`` prefixes.
     """
-    Get the name of the variable manipulated by a 'uses_free' instruction.
+    if WORDCODE:
+        return co.co_code[::2].replace(bytes((EXTENDED_ARG,)), b'')
+
+    return bytes(opcode for _, _, opcode, _, _ in _iter_bytecode(co))
+
+
+def _iter_bytecode(co):
+    """Iterate over the instructions in the bytecode of a python code object.
+
+    ``EXTENDED_ARG`` prefixes are folded into the argument of the instruction
+    they extend.
 
     Parameters
     ----------
-    arg : int
-        The raw argument to a uses_free instruction that we want to resolve to
-        a name.
-    cellvars : list[str]
-        The co_cellvars of the function for which we want to resolve `arg`.
-    freevars : list[str]
-        The co_freevars of the function for which we want to resolve `arg`.
+    co : CodeType
+        The python code object to read.
+
+    Yields
+    ------
+    start : int
+        The offset of the instruction, including any ``EXTENDED_ARG`` prefix.
+    offset : int
+        The offset of the instruction's opcode.
+    opcode : int
+        The opcode of the instruction.
+    arg : int or None
+        The raw argument of the instruction, or None if it does not take one.
+    next_offset : int
+        The offset of the next instruction.
+    """
+    bytecode = memoryview(co.co_code)
+    extended_arg = 0
+    start = offset = 0
+    end = len(bytecode)
+    while offset < end:
+        opcode = bytecode[offset]
+        if opcode < HAVE_ARGUMENT:
+            arg = None
+            next_offset = offset + 1 + WORDCODE
+        elif WORDCODE:
+            arg = bytecode[offset + 1] | extended_arg
+            next_offset = offset + 2
+        else:
+            arg = (
+                bytecode[offset + 1] |
+                bytecode[offset + 2] << 8 |
+                extended_arg
+            )
+            next_offset = offset + 3
+
+        if opcode == EXTENDED_ARG:
+            extended_arg = arg << (8 * argsize)
+            offset = next_offset
+            continue
+
+        yield start, offset, opcode, arg, next_offset
+        extended_arg = 0
+        start = offset = next_offset
+
+
+def _instruction_type(opcode):
+    """Lookup the instruction type for an opcode.
+    """
+    try:
+        return InstructionMeta._type_cache[opcode]
+    except KeyError:
+        raise TypeError('Invalid opcode: {}'.format(opcode))
 
-    Notes
-    -----
-    From https://docs.python.org/3.5/library/dis.html#opcode-LOAD_CLOSURE:
 
-        The name of the variable is co_cellvars[i] if i is less than the length
-        of co_cellvars. Otherwise it is co_freevars[i - len(co_cellvars)]
+def _decode(co, consts):
+    """Decode the instructions of a python code object.
+
+    This walks ``co.co_code`` directly and resolves the arguments of every
+    instruction in one pass. Jumps are resolved afterwards with an array from
+    bytecode offset to instruction.
+
+    Parameters
+    ----------
+    co : CodeType
+        The python code object to decode.
+    consts : tuple
+        The constants to use for the arguments of LOAD_CONST. This is normally
+        ``co.co_consts``.
+
+    Returns
+    -------
+    instrs : list[Instruction]
+        The decoded instructions.
+    instr_at : list[Instruction or None]
+        The instruction that starts at each bytecode offset. The offset of an
+        ``EXTENDED_ARG`` prefix maps to the instruction that it extends.
+    """
+    names = co.co_names
+    varnames = co.co_varnames
+    # The raw argument to a uses_free instruction is an index into
+    # co_cellvars + co_freevars.
+    free = co.co_cellvars + co.co_freevars
+
+    instrs = []
+    append_instr = instrs.append
+    instr_at = [None] * len(co.co_code)
+    jumps = []
+    for start, offset, opcode, arg, next_offset in _iter_bytecode(co):
+        type_ = _instruction_type(opcode)
+        if arg is None:
+            instr = type_()
+        elif type_.absjmp:
+            instr = type_(_RawArg(arg))
+            jumps.append(instr)
+        elif type_.reljmp:
+            instr = type_(_RawArg(next_offset + arg))
+            jumps.append(instr)
+        elif type_ is LOAD_CONST:
+            instr = type_(consts[arg])
+        elif type_.uses_name:
+            instr = type_(names[arg])
+        elif type_.uses_varname:
+            instr = type_(varnames[arg])
+        elif type_.uses_free:
+            instr = type_(free[arg])
+        else:
+            instr = type_(arg)
+
+        append_instr(instr)
+        instr_at[start] = instr_at[offset] = instr
+
+    for instr in jumps:
+        # The instructions are not yet owned by a code object so we do not
+        # need to go through the ``arg`` setter.
+        instr._arg = instr_at[instr._arg]
+
+    return instrs, instr_at
+
+
+class _OperandTable:
+    """An ordered collection of unique operands that can find the index of an
+    operand in constant time.
+
+    Operands are compared by equality, like ``tuple.index``. Hashable
+    operands are found with a dict lookup; unhashable operands, for example
+    mutable objects inlined with ``LOAD_CONST``, fall back to a linear scan
+    over only the unhashable operands.
+
+    Parameters
+    ----------
+    operands : iterable, optional
+        The initial operands. Duplicates are dropped, keeping the first.
+    """
+    __slots__ = '_operands', '_indices', '_unhashable'
+
+    def __init__(self, operands=()):
+        self._operands = []
+        self._indices = {}
+        self._unhashable = []
+        for operand in operands:
+            self.add(operand)
+
+    @staticmethod
+    def _key(operand):
+        return operand
+
+    def _find(self, operand):
+        try:
+            return self._indices.get(self._key(operand))
+        except TypeError:
+            for idx in self._unhashable:
+                candidate = self._operands[idx]
+                if candidate is operand or candidate == operand:
+                    return idx
+            return None
+
+    def add(self, operand):
+        """Add an operand to the table if an equal operand is not already
+        present.
+
+        Parameters
+        ----------
+        operand : any
+            The operand to add.
+
+        Returns
+        -------
+        idx : int
+            The index of the operand in the table.
+        """
+        idx = self._find(operand)
+        if idx is not None:
+            return idx
+
+        idx = len(self._operands)
+        self._operands.append(operand)
+        try:
+            self._indices[self._key(operand)] = idx
+        except TypeError:
+            self._unhashable.append(idx)
+        return idx
+
+    def index(self, operand):
+        """Lookup the index of an operand.
+
+        Parameters
+        ----------
+        operand : any
+            The operand to lookup.
+
+        Returns
+        -------
+        idx : int
+            The index of the operand in the table.
+
+        Raises
+        ------
+        ValueError
+            Raised when the operand is not in the table.
+        """
+        idx = self._find(operand)
+        if idx is None:
+            raise ValueError('%r is not in the operand table' % (operand,))
+        return idx
+
+    def __iter__(self):
+        return iter(self._operands)
+
+    def __len__(self):
+        return len(self._operands)
+
+
+def _const_key(const):
+    """The key of a constant in a :class:`_ConstTable`.
+
+    Equal constants of different types, like ``0``, ``0.0`` and ``False``, are
+    different constants, including inside of tuples and frozensets.
+    """
+    type_ = type(const)
+    if type_ is tuple or type_ is frozenset:
+        return type_, type_(map(_const_key, const))
+    return type_, const
+
+
+class _ConstTable(_OperandTable):
+    """An operand table for constants which keeps equal constants of
+    different types apart, like the compiler does.
     """
-    len_cellvars = len(cellvars)
-    if arg < len_cellvars:
-        return cellvars[arg]
-    return freevars[arg - len_cellvars]
+    __slots__ = ()
+    _key = staticmethod(_const_key)
 
 
 def pycode(argcount,
@@ -257,6 +570,361 @@ def pycode(argcount,
     )
 
 
+def _derived(f):
+    """Decorator for properties of a Code object that are derived from its
+    instructions.
+
+    The value is computed once and stored in the code object's cache. The
+    cache is dropped when the ``arg`` of any instruction is reassigned, which
+    is tracked with ``Instruction._arg_version``.
+    """
+    name = f.__name__
+
+    @wraps(f)
+    def get(self):
+        cache = self._cache
+        version = Instruction._arg_version
+        if self._cache_version != version:
+            cache.clear()
+            self._cache_version = version
+        try:
+            return cache[name]
+        except KeyError:
+            cache[name] = value = f(self)
+            return value
+
+    return property(get)
+
+
+class CompactInstrs(Sequence):
+    """A compact sequence of instructions stored as parallel arrays.
+
+    The opcodes and raw arguments are stored in ``array`` buffers. Constant,
+    name, varname and cell/free arguments are indices into the operand pools
+    of the original code object and jump arguments are the index of the target
+    instruction.
+
+    Instruction objects are only created when an index is read. Once created,
+    an instruction is kept so that an index always maps to the same
+    instruction and mutations made through it are seen by the code object.
+    Scans over the opcodes or arguments, like the ones done when assembling,
+    read the arrays and do not create instructions.
+
+    This saves memory when most of the instructions are never read. Reading
+    an instruction creates every instruction connected to it by jumps, and
+    once all of them have been read this uses somewhat more memory than a
+    tuple of instructions because it holds the arrays as well.
+
+    Use ``Code.from_pycode(co, compact=True)`` to create a code object with
+    this storage.
+    """
+    __slots__ = (
+        '_opcodes',
+        '_args',
+        '_consts',
+        '_names',
+        '_varnames',
+        '_free',
+        '_ncellvars',
+        '_instrs',
+        '_indices',
+        '_jump_sources',
+    )
+
+    def __init__(self,
+                 opcodes,
+                 args,
+                 *,
+                 consts,
+                 names,
+                 varnames,
+                 cellvars,
+                 freevars):
+        self._opcodes = opcodes
+        self._args = args
+        self._consts = consts
+        self._names = names
+        self._varnames = varnames
+        self._free = tuple(cellvars) + tuple(freevars)
+        self._ncellvars = len(cellvars)
+        self._instrs = {}  # index -> Instruction
+        self._indices = {}  # Instruction -> index
+        self._jump_sources = None
+
+    @classmethod
+    def from_pycode(cls, co, consts=None):
+        """Decode the instructions of a python code object into arrays.
+
+        Parameters
+        ----------
+        co : CodeType
+            The python code object to decode.
+        consts : tuple, optional
+            The constants to use for the arguments of LOAD_CONST. Defaults to
+            ``co.co_consts``.
+
+        Returns
+        -------
+        instrs : CompactInstrs
+            The compact instructions.
+        index_at : list[int or None]
+            The index of the instruction that starts at each bytecode offset.
+        """
+        opcodes = array('B')
+        args = array('I')
+        append_opcode = opcodes.append
+        append_arg = args.append
+        index_at = [None] * len(co.co_code)
+        jumps = []
+        for idx, (start, offset, opcode, arg, next_offset) in enumerate(
+                _iter_bytecode(co)):
+            type_ = _instruction_type(opcode)
+            if arg is None:
+                arg = 0
+            elif type_.is_jmp:
+                jumps.append(idx)
+                if type_.reljmp:
+                    arg += next_offset
+
+            append_opcode(opcode)
+            append_arg(arg)
+            index_at[start] = index_at[offset] = idx
+
+        # Jump arguments are offsets until now.
+        for idx in jumps:
+            args[idx] = index_at[args[idx]]
+
+        return cls(
+            opcodes,
+            args,
+            consts=co.co_consts if consts is None else consts,
+            names=co.co_names,
+            varnames=co.co_varnames,
+            cellvars=co.co_cellvars,
+            freevars=co.co_freevars,
+        ), index_at
+
+    @property
+    def opcodes(self):
+        """The opcodes of the instructions as a bytes object.
+        """
+        return self._opcodes.tobytes()
+
+    def _operand(self, type_, arg):
+        """Resolve a raw argument to the argument of an instruction.
+        """
+        if type_ is LOAD_CONST:
+            return self._consts[arg]
+        if type_.uses_name:
+            return self._names[arg]
+        if type_.uses_varname:
+            return self._varnames[arg]
+        if type_.uses_free:
+            return self._free[arg]
+        # Match the argument of the instruction, like the comparator enum
+        # of COMPARE_OP.
+        return type_._normalize_arg(arg)
+
+    def _sources(self, idx):
+        """The indices of the jumps that target ``idx``.
+        """
+        jump_sources = self._jump_sources
+        if jump_sources is None:
+            jump_sources = self._jump_sources = {}
+            args = self._args
+            for source, opcode in enumerate(self._opcodes):
+                if opcode in _jump_opcodes:
+                    jump_sources.setdefault(args[source], []).append(source)
+        return jump_sources.get(idx, ())
+
+    def _new_instr(self, idx):
+        """Create the instruction at ``idx`` without resolving its jump
+        target.
+        """
+        type_ = _instruction_type(self._opcodes[idx])
+        arg = self._args[idx]
+        if not type_.have_arg:
+            instr = type_()
+        elif type_.is_jmp:
+            instr = type_(_RawArg(arg))
+        else:
+            instr = type_(self._operand(type_, arg))
+            if type_.uses_free:
+                instr._vartype = 'cell' if arg < self._ncellvars else 'free'
+
+        self._instrs[idx] = instr
+        self._indices[instr] = idx
+        return instr
+
+    def _instr(self, idx):
+        """Get the instruction at ``idx``, creating it if needed.
+
+        A jump needs its target, and an instruction needs every jump that
+        targets it in its ``_target_of`` so that ``steal`` can redirect
+        them, so this creates all of the instructions connected to ``idx``
+        by jumps.
+        """
+        instrs = self._instrs
+        try:
+            return instrs[idx]
+        except KeyError:
+            pass
+
+        args = self._args
+        sources = self._sources
+        # Create the instructions first and then resolve the jumps between
+        # them. This is done with a worklist instead of recursion because
+        # generated code can have very long chains of jumps.
+        jumps = []
+        stack = [idx]
+        while stack:
+            n = stack.pop()
+            if n in instrs:
+                continue
+            instr = self._new_instr(n)
+            if instr.is_jmp:
+                jumps.append(instr)
+                stack.append(args[n])
+            stack.extend(sources(n))
+
+        for instr in jumps:
+            target = instrs[instr._arg]
+            instr._arg = target
+            target._target_of.add(instr)
+
+        return instrs[idx]
+
+    def operations(self):
+        """Iterate over the type and argument of each instruction without
+        creating instructions that do not yet exist.
+
+        Yields
+        ------
+        type_ : type
+            The type of the instruction.
+        arg : any
+            The argument to the instruction. Jump arguments are the index of
+            the target instruction.
+
+        Raises
+        ------
+        ValueError
+            Raised when an instruction jumps to an instruction that is not in
+            this sequence.
+        """
+        instrs = self._instrs
+        indices = self._indices
+        operand = self._operand
+        args = self._args
+        for idx, opcode in enumerate(self._opcodes):
+            type_ = _instruction_type(opcode)
+            try:
+                instr = instrs[idx]
+            except KeyError:
+                if not type_.have_arg:
+                    arg = None
+                elif type_.is_jmp:
+                    arg = args[idx]
+                else:
+                    arg = operand(type_, args[idx])
+                yield type_, arg
+                continue
+
+            arg = instr.arg
+            if type_.is_jmp:
+                try:
+                    arg = indices[arg]
+                except KeyError:
+                    raise ValueError(
+                        '%r jumps to an instruction that is not in this code'
+                        ' object' % instr,
+                    )
+            yield type_, arg
+
+    def index(self, instr):
+        try:
+            return self._indices[instr]
+        except (KeyError, TypeError):
+            raise ValueError('%r is not in this code object' % (instr,))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return tuple(map(self._instr, range(*key.indices(len(self)))))
+
+        idx = key
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('instruction index out of range')
+        return self._instr(idx)
+
+    def __iter__(self):
+        return map(self._instr, range(len(self)))
+
+    def __len__(self):
+        return len(self._opcodes)
+
+    def __contains__(self, instr):
+        try:
+            return instr in self._indices
+        except TypeError:
+            return False
+
+
+def fingerprint_const(const, *, fallback=None):
+    """Encode a constant the way :attr:`Code.fingerprint` does.
+
+    Parameters
+    ----------
+    const : any
+        The constant to encode.
+    fallback : callable[any -> bytes], optional
+        The encoding for objects, including the ones nested in tuples and
+        frozensets, without a known encoding. By default these are encoded
+        by their type and ``repr``.
+
+    Returns
+    -------
+    encoded : bytes
+        A byte string that is equal for equal constants of the same type.
+
+    Notes
+    -----
+    ``marshal`` is not used because its output depends on whether strings are
+    interned and on reference counts. Code objects are encoded by their
+    fingerprint so their filename and line numbers are ignored. Objects
+    without a known encoding fall back to their type and ``repr``.
+    """
+    type_ = type(const)
+    if type_ is str:
+        return b's' + const.encode('utf-8', 'surrogatepass')
+    if type_ is bytes:
+        return b'b' + const
+    if type_ in (int, bool, float, complex, type(None), type(Ellipsis)):
+        return ('v%s:%r' % (type_.__name__, const)).encode('ascii')
+    if type_ is tuple or type_ is frozenset:
+        parts = [fingerprint_const(c, fallback=fallback) for c in const]
+        if type_ is frozenset:
+            parts.sort()
+        return (b't' if type_ is tuple else b'f') + b''.join(
+            len(part).to_bytes(8, 'little') + part for part in parts
+        )
+    if type_ is CodeType:
+        const = Code.from_pycode(const, lazy=True)
+    if isinstance(const, Code):
+        return b'c' + const.fingerprint.encode('ascii')
+    if fallback is not None:
+        return fallback(const)
+    return ('o%s.%s:%r' % (
+        type_.__module__,
+        type_.__qualname__,
+        const,
+    )).encode('utf-8', 'surrogatepass')
+
+
+_materialize_lock = RLock()
+
+
 class Code:
     """A higher abstraction over python's CodeType.
 
@@ -276,8 +944,9 @@ class Code:
         The first line number of the code in this code object.
     lnotab : dict[Instruction -> int], optional
         The mapping from instruction to the line that it starts.
-    flags : dict[str -> bool], optional
-        Any flags to set. This updates the default flag set.
+    flags : dict[str -> bool] or int, optional
+        Any flags to set. A dict updates the default flag set. An int is used
+        as the bitmask of flags as is.
 
     Attributes
     ----------
@@ -287,6 +956,7 @@ class Code:
     constructs_new_locals
     consts
     filename
+    fingerprint
     flags
     freevars
     instrs
@@ -298,6 +968,7 @@ class Code:
     lnotab
     name
     names
+    opcodes
     py_lnotab
     sparse_instrs
     stacksize
@@ -314,7 +985,16 @@ class Code:
         '_filename',
         '_firstlineno',
         '_lnotab',
+        '_line_starts',
         '_flags',
+        '_pycode',
+        '_pycode_version',
+        '_pyconsts',
+        '_pyinstrs',
+        '_compact',
+        '_recursive',
+        '_cache',
+        '_cache_version',
         '__weakref__',
     )
 
@@ -346,9 +1026,11 @@ class Code:
                 kwarg = argname[2:]
                 continue
             elif argname.startswith('*'):
-                if varg is not None:
+                if argcounter is kwonlyargcount:
                     raise ValueError('cannot specify *args more than once')
-                varg = argname[1:]
+                # A bare '*' starts the keyword only arguments without
+                # accepting varargs.
+                varg = argname[1:] or None
                 argcounter = kwonlyargcount  # all following args are kwonly.
                 continue
             argcounter[0] += 1
@@ -359,228 +1041,512 @@ class Code:
         if kwarg is not None:
             append_argname(kwarg)
 
-        cellvar_names = set(cellvars)
-        freevar_names = set(freevars)
-        for instr in filter(op.attrgetter('uses_free'), instrs):
-            if instr.arg in cellvar_names:
-                instr._vartype = 'cell'
-            elif instr.arg in freevar_names:
-                instr._vartype = 'free'
-            else:
-                raise ValueError(
-                    "Argument to %r is not in cellvars or freevars." % instr
-                )
-
-        for instr in filter(op.attrgetter('is_jmp'), instrs):
-            instr.arg._target_of.add(instr)
+        self._cellvars = cellvars
+        self._freevars = freevars
+        self._bind_instrs(instrs)
 
+        self._pycode = None
+        self._pycode_version = None
+        self._compact = False
+        self._recursive = False
         self._instrs = instrs
         self._argnames = tuple(_argnames)
         self._argcount = argcount[0]
         self._kwonlyargcount = kwonlyargcount[0]
-        self._cellvars = cellvars
-        self._freevars = freevars
         self._name = name
         self._filename = filename
         self._firstlineno = firstlineno
-        self._lnotab = lnotab or {}
-        self._flags = Flag.pack(**dict(
-            dict(
-                CO_OPTIMIZED=True,
-                CO_NEWLOCALS=True,
-                CO_VARARGS=varg is not None,
-                CO_VARKEYWORDS=kwarg is not None,
-                CO_NESTED=False,
-                CO_GENERATOR=any(
-                    isinstance(instr, (YIELD_VALUE, YIELD_FROM))
-                    for instr in instrs
-                ),
-                CO_NOFREE=not any(map(op.attrgetter('uses_free'), instrs)),
-                CO_COROUTINE=False,
-                CO_ITERABLE_COROUTINE=False,
-                CO_FUTURE_DIVISION=False,
-                CO_FUTURE_ABSOLUTE_IMPORT=False,
-                CO_FUTURE_WITH_STATEMENT=False,
-                CO_FUTURE_PRINT_FUNCTION=False,
-                CO_FUTURE_UNICODE_LITERALS=False,
-                CO_FUTURE_BARRY_AS_BDFL=False,
-                CO_FUTURE_GENERATOR_STOP=False,
-            ),
-            **flags or {}
-        ))
+        self._lnotab = dict(lnotab or {})
+        self._cache = {}
+        self._cache_version = Instruction._arg_version
+        if isinstance(flags, int):
+            self._flags = flags
+        else:
+            self._flags = self._pack_flags(instrs, varg, kwarg, flags or {})
+
+    @staticmethod
+    def _pack_flags(instrs, varg, kwarg, flags):
+        """Compute the bitmask of flags for a new code object.
+
+        Parameters
+        ----------
+        instrs : tuple of Instruction
+            The instructions of the code object.
+        varg : str or None
+            The name of the ``*args`` argument.
+        kwarg : str or None
+            The name of the ``**kwargs`` argument.
+        flags : dict[str -> bool]
+            Flags to set or clear on top of the defaults.
+
+        Returns
+        -------
+        mask : int
+            The bitmask of flags.
+        """
+        values = _flag_values
+        mask = values['CO_OPTIMIZED'] | values['CO_NEWLOCALS']
+        if varg is not None:
+            mask |= values['CO_VARARGS']
+        if kwarg is not None:
+            mask |= values['CO_VARKEYWORDS']
+        generator_types = YIELD_VALUE, YIELD_FROM
+        if any(isinstance(instr, generator_types) for instr in instrs):
+            mask |= values['CO_GENERATOR']
+        if not any(map(op.attrgetter('uses_free'), instrs)):
+            mask |= values['CO_NOFREE']
+
+        for name, value in flags.items():
+            try:
+                flag = values[name]
+            except KeyError:
+                raise TypeError('unknown flag: %r' % name)
+            if value:
+                mask |= flag
+            else:
+                mask &= ~flag
+        return mask
 
     @classmethod
-    def from_pyfunc(cls, f):
+    def from_pyfunc(cls, f, *, lazy=False, compact=False, recursive=False):
         """Create a Code object from a python function object.
 
         Parameters
         ----------
         f : function
             The function from which to construct a code object.
+        lazy : bool, optional
+            Defer decoding the instructions until they are first needed.
+            See :meth:`~codetransformer.code.Code.from_pycode`.
+        compact : bool, optional
+            Store the instructions as arrays.
+            See :meth:`~codetransformer.code.Code.from_pycode`.
+        recursive : bool, optional
+            Represent nested code objects as Code objects.
+            See :meth:`~codetransformer.code.Code.from_pycode`.
 
         Returns
         -------
         code : Code
             A Code object representing f.__code__.
         """
-        return cls.from_pycode(f.__code__)
+        return cls.from_pycode(
+            f.__code__,
+            lazy=lazy,
+            compact=compact,
+            recursive=recursive,
+        )
 
     @classmethod
-    def from_pycode(cls, co):
+    def from_pycode(cls, co, *, lazy=False, compact=False, recursive=False):
         """Create a Code object from a python code object.
 
         Parameters
         ----------
         co : CodeType
             The python code object.
+        lazy : bool, optional
+            Defer decoding the instructions until they are first needed.
+            A lazy Code object only holds ``co`` and its metadata; the
+            Instruction objects are created the first time something iterates,
+            indexes or otherwise reads the instructions. ``opcodes`` is read
+            directly from ``co.co_code``, and scans like ``fingerprint`` or
+            assembling read the bytecode without creating instructions.
+        compact : bool, optional
+            Store the instructions as a
+            :class:`~codetransformer.code.CompactInstrs` instead of a tuple of
+            Instruction objects. Instruction objects are only created for the
+            instructions that are read, which uses much less memory for large
+            code objects that are scanned but only partly rewritten.
+        recursive : bool, optional
+            Represent the code objects in ``co.co_consts`` as lazy Code
+            objects, recursively. ``to_pycode`` only assembles the nested
+            code objects that were changed and reuses the original python
+            code objects for the rest.
 
         Returns
         -------
         code : Code
             The codetransformer Code object.
         """
-        # Make it sparse to instrs[n] is the instruction at bytecode[n]
-        sparse_instrs = tuple(
-            _sparse_args(
-                Instruction.from_opcode(
-                    b.opcode,
-                    Instruction._no_arg if b.arg is None else _RawArg(b.arg),
-                ) for b in Bytecode(co)
-            ),
-        )
-        for idx, instr in enumerate(sparse_instrs):
-            if instr is None:
-                # The sparse value
-                continue
-            if instr.absjmp:
-                instr.arg = sparse_instrs[instr.arg]
-            elif instr.reljmp:
-                instr.arg = sparse_instrs[instr.arg + idx + argsize + 1]
-            elif isinstance(instr, LOAD_CONST):
-                instr.arg = co.co_consts[instr.arg]
-            elif instr.uses_name:
-                instr.arg = co.co_names[instr.arg]
-            elif instr.uses_varname:
-                instr.arg = co.co_varnames[instr.arg]
-            elif instr.uses_free:
-                instr.arg = _freevar_argname(
-                    instr.arg,
-                    co.co_freevars,
-                    co.co_cellvars,
+        self = cls.__new__(cls)
+        self._pycode = co
+        # co_varnames begins with the arguments in the same
+        # [args] [kwonlyargs] [vararg] [varkwarg] order as _argnames.
+        self._argnames = co.co_varnames[:(
+            co.co_argcount +
+            co.co_kwonlyargcount +
+            bool(co.co_flags & _flag_values['CO_VARARGS']) +
+            bool(co.co_flags & _flag_values['CO_VARKEYWORDS'])
+        )]
+        self._argcount = co.co_argcount
+        self._kwonlyargcount = co.co_kwonlyargcount
+        self._cellvars = co.co_cellvars
+        self._freevars = co.co_freevars
+        self._name = co.co_name
+        self._filename = co.co_filename
+        self._firstlineno = co.co_firstlineno
+        self._flags = co.co_flags
+        self._compact = compact
+        self._recursive = recursive
+        self._pycode_version = None
+        self._cache = {}
+        self._cache_version = Instruction._arg_version
+        if not lazy:
+            self._materialize()
+        return self
+
+    def _materialize(self):
+        """Decode the instructions of a lazy Code object.
+        """
+        with _materialize_lock:
+            if hasattr(self, '_instrs'):
+                # Another thread beat us here.
+                return
+
+            co = self._pycode
+            consts = self._decoded_consts()
+            if self._compact:
+                instrs, index_at = self._pycode_instrs()
+                # The instructions that start lines are only created when
+                # the lnotab is read.
+                self._line_starts = tuple(
+                    (index_at[off], lno) for off, lno in findlinestarts(co)
                 )
-            elif instr.have_arg and isinstance(instr.arg, _RawArg):
-                instr.arg = int(instr.arg)
-
-        flags = Flag.unpack(co.co_flags)
-        has_vargs = flags['CO_VARARGS']
-        has_kwargs = flags['CO_VARKEYWORDS']
-
-        # Here we convert the varnames format into our argnames format.
-        paramnames = co.co_varnames[
-            :(co.co_argcount +
-              co.co_kwonlyargcount +
-              has_vargs +
-              has_kwargs)
-        ]
-        # We start with the positional arguments.
-        new_paramnames = list(paramnames[:co.co_argcount])
-        # Add *args next.
-        if has_vargs:
-            new_paramnames.append('*' + paramnames[-1 - has_kwargs])
-        # Add positional only arguments next.
-        new_paramnames.extend(paramnames[
-            co.co_argcount:co.co_argcount + co.co_kwonlyargcount
-        ])
-        # Add **kwargs last.
-        if has_kwargs:
-            new_paramnames.append('**' + paramnames[-1])
+            else:
+                instrs, instr_at = _decode(co, consts)
+                self._bind_instrs(instrs)
+                self._lnotab = {
+                    lno: instr_at[off] for off, lno in findlinestarts(co)
+                }
+                instrs = tuple(instrs)
+
+            # Until an instruction argument changes this assembles back to
+            # ``co``.
+            self._pycode_version = Instruction._arg_version
+            self._instrs = instrs
+
+            # These were only needed while this code object was lazy.
+            del self._pyconsts
+            try:
+                del self._pyinstrs
+            except AttributeError:
+                pass
+
+    def _decoded_consts(self):
+        """The constants of the python code object this was created from.
+
+        If this code object is recursive, nested code objects are lazy Code
+        objects. They are created once so that scanning a lazy code object
+        and decoding it later see the same nested Code objects.
+        """
+        with _materialize_lock:
+            try:
+                return self._pyconsts
+            except AttributeError:
+                pass
+
+            consts = self._pycode.co_consts
+            if self._recursive:
+                compact = self._compact
+                consts = tuple(
+                    type(self).from_pycode(
+                        const,
+                        lazy=True,
+                        compact=compact,
+                        recursive=True,
+                    )
+                    if isinstance(const, CodeType) else
+                    const
+                    for const in consts
+                )
+            self._pyconsts = consts
+            return consts
 
-        return cls(
-            filter(bool, sparse_instrs),
-            argnames=new_paramnames,
-            cellvars=co.co_cellvars,
-            freevars=co.co_freevars,
-            name=co.co_name,
-            filename=co.co_filename,
-            firstlineno=co.co_firstlineno,
-            lnotab={
-                lno: sparse_instrs[off] for off, lno in findlinestarts(co)
-            },
-            flags=flags,
-        )
+    def _pycode_instrs(self):
+        """The instructions of the python code object this was created from
+        as a :class:`CompactInstrs`.
 
-    def to_pycode(self):
-        """Create a python code object from the more abstract
-        codetransfomer.Code object.
+        This lets a lazy code object be scanned, for example to compute its
+        fingerprint, without creating Instruction objects.
 
         Returns
         -------
-        co : CodeType
-            The python code object.
+        instrs : CompactInstrs
+            The instructions.
+        index_at : list[int or None]
+            The index of the instruction that starts at each bytecode offset.
+        """
+        with _materialize_lock:
+            try:
+                return self._pyinstrs
+            except AttributeError:
+                pass
+
+            self._pyinstrs = pyinstrs = CompactInstrs.from_pycode(
+                self._pycode,
+                self._decoded_consts(),
+            )
+            return pyinstrs
+
+    def _bind_instrs(self, instrs):
+        """Setup the state on the instructions that depends on the code object
+        they are in.
+
+        Parameters
+        ----------
+        instrs : iterable of Instruction
+            The instructions of this code object.
+        """
+        cellvar_names = set(self._cellvars)
+        freevar_names = set(self._freevars)
+        for instr in filter(op.attrgetter('uses_free'), instrs):
+            if instr.arg in cellvar_names:
+                instr._vartype = 'cell'
+            elif instr.arg in freevar_names:
+                instr._vartype = 'free'
+            else:
+                raise ValueError(
+                    "Argument to %r is not in cellvars or freevars." % instr
+                )
+
+        for instr in filter(op.attrgetter('is_jmp'), instrs):
+            instr.arg._target_of.add(instr)
+
+    def dumps(self):
+        """Serialize this code object to bytes.
+
+        Returns
+        -------
+        data : bytes
+            The serialized code object. Use :meth:`loads` to read it back.
+
+        Notes
+        -----
+        The instructions are stored like :class:`CompactInstrs`: an array of
+        opcodes and an array of raw arguments where jump arguments are the
+        index of the target instruction. The operand tables and the rest of
+        the metadata are marshalled. Constants that cannot be marshalled are
+        pickled, and nested Code objects are serialized recursively.
+
+        Code objects are pickled in this format. The data can only be loaded
+        by the same version of Python, and instructions which are not in the
+        code object, like the ones that were stolen from, are not kept.
         """
         consts = self.consts
         names = self.names
         varnames = self.varnames
-        freevars = self.freevars
-        cellvars = self.cellvars
-        bc = bytearray()
-        for instr in self.instrs:
-            bc.append(instr.opcode)  # Write the opcode byte.
-            if isinstance(instr, LOAD_CONST):
-                # Resolve the constant index.
-                bc.extend(consts.index(instr.arg).to_bytes(argsize, 'little'))
-            elif instr.uses_name:
-                # Resolve the name index.
-                bc.extend(names.index(instr.arg).to_bytes(argsize, 'little'))
-            elif instr.uses_varname:
-                # Resolve the local variable index.
-                bc.extend(
-                    varnames.index(instr.arg).to_bytes(argsize, 'little'),
-                )
-            elif instr.uses_free:
-                # uses_free is really "uses freevars **or** cellvars".
+
+        opcodes = bytearray()
+        args = array('I')
+        for type_, arg in self._raw_operations():
+            opcodes.append(type_.opcode)
+            # Jump arguments are already the index of the target.
+            args.append(0 if arg is None else arg)
+
+        line_starts = tuple(self._line_start_indices())
+
+        values = list(consts)
+        special = []
+        for n, const in enumerate(consts):
+            if isinstance(const, Code):
+                values[n] = None
+                special.append((n, _DUMP_CODE, const.dumps()))
+
+        def metadata():
+            return (
+                MAGIC_NUMBER,
+                tuple(values),
+                tuple(special),
+                names,
+                varnames,
+                self.cellvars,
+                self.freevars,
+                self.argnames,
+                self.argcount,
+                self.kwonlyargcount,
+                self.name,
+                self.filename,
+                self.firstlineno,
+                self.py_flags,
+                line_starts,
+            )
+
+        try:
+            meta = marshal.dumps(metadata())
+        except ValueError:
+            # Find the constants that cannot be marshalled.
+            for n, const in enumerate(values):
                 try:
-                    # look for the name in cellvars
-                    bc.extend(
-                        cellvars.index(instr.arg).to_bytes(argsize, 'little'),
-                    )
+                    marshal.dumps(const)
                 except ValueError:
-                    # fall back to freevars, incrementing the length of
-                    # cellvars.
-                    bc.extend(
-                        (freevars.index(instr.arg) + len(cellvars)).to_bytes(
-                            argsize,
-                            'little',
-                        )
-                    )
-            elif instr.absjmp:
-                # Resolve the absolute jump target.
-                bc.extend(
-                    self.bytecode_offset(instr.arg).to_bytes(
-                        argsize,
-                        'little',
-                    ),
+                    values[n] = None
+                    special.append((n, _DUMP_PICKLE, pickle.dumps(const)))
+            meta = marshal.dumps(metadata())
+
+        return b''.join((
+            _dump_header.pack(
+                _dump_magic,
+                _dump_version,
+                sys.byteorder == 'little',
+                args.itemsize,
+                len(opcodes),
+            ),
+            args.tobytes(),
+            opcodes,
+            meta,
+        ))
+
+    @classmethod
+    def loads(cls, data):
+        """Read a code object serialized with :meth:`dumps`.
+
+        Parameters
+        ----------
+        data : bytes-like
+            The serialized code object.
+
+        Returns
+        -------
+        code : Code
+            The code object. Its instructions are stored as
+            :class:`CompactInstrs` which read the opcodes and arguments
+            directly out of ``data`` without copying them, so ``data`` must
+            not be changed while the code object is in use.
+
+        Raises
+        ------
+        ValueError
+            Raised when ``data`` is not a serialized code object or was
+            serialized by a different version of Python.
+        """
+        view = memoryview(data).cast('B')
+        try:
+            (magic,
+             version,
+             little,
+             itemsize,
+             count) = _dump_header.unpack_from(view)
+        except Exception:
+            raise ValueError('data is not a serialized Code object')
+        if magic != _dump_magic or version != _dump_version:
+            raise ValueError('data is not a serialized Code object')
+        try:
+            typecode = _dump_arg_typecodes[itemsize]
+        except KeyError:
+            raise ValueError(
+                'Code object was serialized with %d byte arguments which'
+                ' this platform cannot read' % itemsize,
+            )
+
+        start = _dump_header.size
+        opcodes_start = start + itemsize * count
+        meta_start = opcodes_start + count
+        args = view[start:opcodes_start]
+        if little == (sys.byteorder == 'little'):
+            args = args.cast(typecode)
+        else:
+            args = array(typecode, args.tobytes())
+            args.byteswap()
+        opcodes = view[opcodes_start:meta_start]
+
+        (pymagic,
+         consts,
+         special,
+         names,
+         varnames,
+         cellvars,
+         freevars,
+         argnames,
+         argcount,
+         kwonlyargcount,
+         name,
+         filename,
+         firstlineno,
+         flags,
+         line_starts) = marshal.loads(view[meta_start:])
+        if pymagic != MAGIC_NUMBER:
+            raise ValueError(
+                'Code object was serialized by a different version of Python',
+            )
+
+        if special:
+            consts = list(consts)
+            for n, kind, payload in special:
+                consts[n] = (
+                    cls.loads(payload)
+                    if kind == _DUMP_CODE else
+                    pickle.loads(payload)
                 )
-            elif instr.reljmp:
-                # Resolve the relative jump target.
-                # We do this by subtracting the curren't instructions's
-                # sparse index from the sparse index of the argument.
-                # We then subtract argsize - 1 to account for the bytes the
-                # current instruction takes up.
-                bytecode_offset = self.bytecode_offset
-                bc.extend((
-                    bytecode_offset(instr.arg) -
-                    bytecode_offset(instr) -
-                    argsize -
-                    1
-                ).to_bytes(argsize, 'little',))
-            elif instr.have_arg:
-                # Write any other arg here.
-                bc.extend(instr.arg.to_bytes(argsize, 'little'))
-            elif WORDCODE:
-                # with wordcode, all instructions are padded to 2 bytes
-                bc.append(0)
+            consts = tuple(consts)
+
+        instrs = CompactInstrs(
+            opcodes,
+            args,
+            consts=consts,
+            names=names,
+            varnames=varnames,
+            cellvars=cellvars,
+            freevars=freevars,
+        )
+
+        self = cls.__new__(cls)
+        self._pycode = None
+        self._pycode_version = None
+        self._compact = True
+        self._recursive = False
+        self._instrs = instrs
+        self._argnames = argnames
+        self._argcount = argcount
+        self._kwonlyargcount = kwonlyargcount
+        self._cellvars = cellvars
+        self._freevars = freevars
+        self._name = name
+        self._filename = filename
+        self._firstlineno = firstlineno
+        self._flags = flags
+        self._line_starts = line_starts
+        self._cache = {}
+        self._cache_version = Instruction._arg_version
+        return self
+
+    def __reduce__(self):
+        return type(self).loads, (self.dumps(),)
+
+    def to_pycode(self, *, reuse=False):
+        """Create a python code object from the more abstract
+        codetransfomer.Code object.
+
+        Parameters
+        ----------
+        reuse : bool, optional
+            Return the python code object this was created from with
+            ``from_pycode`` if nothing has changed since instead of
+            assembling a new one.
+
+        Returns
+        -------
+        co : CodeType
+            The python code object.
+
+        Notes
+        -----
+        Nested Code objects in the constants are always assembled with
+        ``reuse=True`` so that only the ones that changed are assembled again.
+        """
+        if reuse and self._unchanged():
+            return self._pycode
 
+        opcodes, args, offsets = self._assembly
+        bc = bytearray()
+        for opcode, arg, start, end in zip(
+                opcodes,
+                args,
+                offsets,
+                offsets[1:]):
+            _write_instr(bc, opcode, arg, end - start)
+
+        varnames = self.varnames
         return CodeType(
             self.argcount,
             self.kwonlyargcount,
@@ -588,31 +1554,196 @@ class Code:
             self.stacksize,
             self.py_flags,
             bytes(bc),
-            consts,
-            names,
+            tuple(
+                const.to_pycode(reuse=True) if isinstance(const, Code) else
+                const
+                for const in self.consts
+            ),
+            self.names,
             varnames,
             self.filename,
             self.name,
             self.firstlineno,
             self.py_lnotab,
-            freevars,
-            cellvars,
+            self.freevars,
+            self.cellvars,
         )
 
+    def _unchanged(self):
+        """Would this code object assemble back to the python code object it
+        was created from?
+
+        Returns
+        -------
+        unchanged : bool
+            True if this code object came from ``from_pycode`` and neither
+            its instructions nor any nested Code object have changed since.
+        """
+        if not hasattr(self, '_instrs'):
+            # This is a lazy code object that has not been materialized so
+            # its instructions have not changed, but nested code objects
+            # read by scanning it may have.
+            try:
+                consts = self._pyconsts
+            except AttributeError:
+                return True
+            return all(
+                const._unchanged()
+                for const in consts
+                if isinstance(const, Code)
+            )
+
+        version = self._pycode_version
+        if version is None:
+            return False
+
+        current = Instruction._arg_version
+        if version == current:
+            return True
+
+        # Some instruction has changed since this code object was decoded,
+        # check if it was one of ours.
+        instrs = self._instrs
+        if isinstance(instrs, CompactInstrs):
+            # Only the instructions that have been created could have
+            # changed.
+            consts = instrs._consts
+            instrs = tuple(instrs._instrs.values())
+        else:
+            consts = (
+                instr.arg for instr in instrs if isinstance(instr, LOAD_CONST)
+            )
+
+        if (any(instr._changed_at > version for instr in instrs) or
+                not all(
+                    const._unchanged()
+                    for const in consts
+                    if isinstance(const, Code)
+                )):
+            self._pycode_version = None
+            return False
+
+        self._pycode_version = current
+        return True
+
     @property
     def instrs(self):
         """The instructions in this code object.
         """
-        return self._instrs
-
-    @property
+        try:
+            return self._instrs
+        except AttributeError:
+            self._materialize()
+            return self._instrs
+
+    @_derived
+    def opcodes(self):
+        """The opcodes of the instructions in this code object as a bytes
+        object with one byte per instruction.
+
+        For a lazy code object this is read from the original bytecode without
+        creating the Instruction objects.
+        """
+        try:
+            instrs = self._instrs
+        except AttributeError:
+            return _opcodes(self._pycode)
+        if isinstance(instrs, CompactInstrs):
+            return instrs.opcodes
+        return bytes(map(op.attrgetter('opcode'), instrs))
+
+    def operations(self):
+        """Iterate over the type and argument of each instruction.
+
+        Jump arguments are the index of the target instruction instead of
+        the target itself so that the assembler can work in terms of indices.
+        Compact and lazy code objects do not create Instruction objects to do
+        this.
+
+        Yields
+        ------
+        type_ : type
+            The type of the instruction.
+        arg : any
+            The argument to the instruction.
+
+        Raises
+        ------
+        ValueError
+            Raised when an instruction jumps to an instruction that is not in
+            this code object.
+        """
+        try:
+            instrs = self._instrs
+        except AttributeError:
+            # Scan the bytecode of a lazy code object without decoding it.
+            instrs = self._pycode_instrs()[0]
+        if isinstance(instrs, CompactInstrs):
+            yield from instrs.operations()
+            return
+
+        indices = self._instr_indices
+        for instr in instrs:
+            arg = instr.arg
+            if instr.is_jmp:
+                try:
+                    arg = indices[arg]
+                except KeyError:
+                    raise ValueError(
+                        '%r jumps to an instruction that is not in this code'
+                        ' object' % instr,
+                    )
+            yield type(instr), arg
+
+    def _raw_operations(self):
+        """Iterate over the type and raw argument of each instruction.
+
+        Yields
+        ------
+        type_ : type
+            The type of the instruction.
+        arg : int or None
+            The index of the operand in the constants, names, varnames, or
+            cellvars followed by freevars. Jump arguments are the index of
+            the target instruction. This is None for instructions that do
+            not take an argument.
+        """
+        # Build the operand tables once so that each lookup is O(1).
+        const_index = self._consts_table.index
+        name_index = _OperandTable(self.names).index
+        varname_index = _OperandTable(self.varnames).index
+        # uses_free is really "uses freevars **or** cellvars". The cellvars
+        # come first so a name in both resolves to the cellvar, and freevar
+        # indices are offset by the length of cellvars.
+        free_index = _OperandTable(
+            tuple(self.cellvars) + tuple(self.freevars),
+        ).index
+
+        for type_, arg in self.operations():
+            if type_ is LOAD_CONST:
+                arg = const_index(arg)
+            elif type_.uses_name:
+                arg = name_index(arg)
+            elif type_.uses_varname:
+                arg = varname_index(arg)
+            elif type_.uses_free:
+                arg = free_index(arg)
+            elif not type_.have_arg:
+                arg = None
+            yield type_, arg
+
+    @_derived
     def sparse_instrs(self):
         """The instructions where the index of an instruction
         is the bytecode offset of that instruction.
 
         None indicates that no instruction is at that offset.
         """
-        return tuple(_sparse_args(self.instrs))
+        offsets = self._offsets
+        sparse = [None] * offsets[-1]
+        for offset, instr in zip(offsets, self.instrs):
+            sparse[offset] = instr
+        return tuple(sparse)
 
     @property
     def argcount(self):
@@ -630,20 +1761,26 @@ class Code:
         """
         return self._kwonlyargcount
 
-    @property
+    @_derived
     def consts(self):
         """The constants referenced in this code object.
         """
+        return tuple(self._consts_table)
+
+    @_derived
+    def _consts_table(self):
+        """The constants referenced in this code object as an operand table.
+        """
         # We cannot use a set comprehension because consts do not need
         # to be hashable.
-        consts = []
-        append_const = consts.append
-        for instr in self.instrs:
-            if isinstance(instr, LOAD_CONST) and instr.arg not in consts:
-                append_const(instr.arg)
-        return tuple(consts)
-
-    @property
+        consts = _ConstTable()
+        add_const = consts.add
+        for type_, arg in self.operations():
+            if type_ is LOAD_CONST:
+                add_const(arg)
+        return consts
+
+    @_derived
     def names(self):
         """The names referenced in this code object.
 
@@ -653,7 +1790,7 @@ class Code:
         # We must sort to preserve the order between calls.
         # The set comprehension is to drop the duplicates.
         return tuple(sorted({
-            instr.arg for instr in self.instrs if instr.uses_name
+            arg for type_, arg in self.operations() if type_.uses_name
         }))
 
     @property
@@ -665,16 +1802,16 @@ class Code:
         """
         return self._argnames
 
-    @property
+    @_derived
     def varnames(self):
         """The names of all of the local variables in this code object.
         """
         # We must sort to preserve the order between calls.
         # The set comprehension is to drop the duplicates.
         return self._argnames + tuple(sorted({
-            instr.arg
-            for instr in self.instrs
-            if instr.uses_varname and instr.arg not in self._argnames
+            arg
+            for type_, arg in self.operations()
+            if type_.uses_varname and arg not in self._argnames
         }))
 
     @property
@@ -767,8 +1904,54 @@ class Code:
     @property
     def lnotab(self):
         """The mapping of line number to the first instruction on that line.
+
+        This is a read only view, construct a new Code object to change the
+        line numbers.
         """
-        return self._lnotab
+        try:
+            return MappingProxyType(self._lnotab)
+        except AttributeError:
+            pass
+
+        instrs = self.instrs
+        try:
+            return MappingProxyType(self._lnotab)
+        except AttributeError:
+            # The instructions of a compact code object that start lines are
+            # created the first time the lnotab is read.
+            self._lnotab = lnotab = {
+                lno: instrs[idx] for idx, lno in self._line_starts
+            }
+            return MappingProxyType(lnotab)
+
+    def _line_start_indices(self):
+        """The index of the first instruction of each line and the line
+        number, in order.
+
+        This does not create the instructions of a lazy code object or of a
+        compact code object whose lnotab has not been read.
+        """
+        try:
+            lnotab = self._lnotab
+        except AttributeError:
+            if not hasattr(self, '_instrs'):
+                index_at = self._pycode_instrs()[1]
+                return [
+                    (index_at[off], lno)
+                    for off, lno in findlinestarts(self._pycode)
+                ]
+            self.instrs
+            try:
+                lnotab = self._lnotab
+            except AttributeError:
+                return self._line_starts
+
+        indices = self._instr_indices
+        return sorted(
+            (indices[instr], lno)
+            for instr, lno in reverse_dict(lnotab).items()
+            if instr in indices
+        )
 
     @lazyval
     def lno_of_instr(self):
@@ -779,7 +1962,7 @@ class Code:
             lnos[n] = reverse_lnotab.get(instr)
         return dict(zip(instrs, ffill(lnos)))
 
-    @property
+    @_derived
     def py_lnotab(self):
         """The encoded lnotab that python uses to compute when lines start.
 
@@ -787,17 +1970,21 @@ class Code:
         ----
         See Objects/lnotab_notes.txt in the cpython source for more details.
         """
-        reverse_lnotab = reverse_dict(self.lnotab)
+        offsets = self._offsets
+        line_starts = self._line_start_indices()
         py_lnotab = []
         prev_instr = 0
         prev_lno = self.firstlineno
-        for addr, instr in enumerate(_sparse_args(self.instrs)):
-            lno = reverse_lnotab.get(instr)
-            if lno is None:
-                continue
+        for idx, lno in line_starts:
+            addr = offsets[idx]
+            addr_delta = addr - prev_instr
+            while addr_delta > max_lnotab_addr_increment:
+                py_lnotab.append(max_lnotab_addr_increment)
+                py_lnotab.append(0)
+                addr_delta -= max_lnotab_addr_increment
 
             delta = lno - prev_lno
-            py_lnotab.append(addr - prev_instr)
+            py_lnotab.append(addr_delta)
             py_lnotab.append(min(delta, max_lnotab_increment))
             delta -= max_lnotab_increment
             while delta > 0:
@@ -810,14 +1997,17 @@ class Code:
 
         return bytes(py_lnotab)
 
-    @property
+    @_derived
     def stacksize(self):
         """The maximum amount of stack space used by this code object.
         """
         return max(scanl(
             op.add,
             0,
-            map(op.attrgetter('stack_effect'), self.instrs),
+            (
+                type_._stack_effect(None if type_.is_jmp else arg)
+                for type_, arg in self.operations()
+            ),
         ))
 
     def index(self, instr):
@@ -833,7 +2023,10 @@ class Code:
         idx : int
             The index of instr in this code object.
         """
-        return self.instrs.index(instr)
+        try:
+            return self._instr_indices[instr]
+        except (KeyError, TypeError):
+            raise ValueError('%r is not in this code object' % (instr,))
 
     def bytecode_offset(self, instr):
         """Returns the offset of instr in the bytecode representation.
@@ -848,7 +2041,87 @@ class Code:
         idx : int
             The index of instr in this code object in the sparse instructions.
         """
-        return self.sparse_instrs.index(instr)
+        return self._offsets[self.index(instr)]
+
+    @lazyval
+    def _instr_indices(self):
+        """The mapping from instruction to its index in ``self.instrs``.
+
+        Instructions hash by identity so this is an identity keyed table.
+        """
+        instrs = self.instrs
+        if isinstance(instrs, CompactInstrs):
+            # This table grows as instructions are created.
+            return instrs._indices
+
+        indices = {}
+        setdefault = indices.setdefault
+        for idx, instr in enumerate(instrs):
+            setdefault(instr, idx)
+        return indices
+
+    @_derived
+    def _assembly(self):
+        """The opcodes, raw arguments and bytecode offsets of the
+        instructions.
+
+        Returns
+        -------
+        opcodes : list[int]
+            The opcode of each instruction.
+        args : list[int or None]
+            The raw argument of each instruction, or None for instructions
+            that do not take an argument.
+        offsets : list[int]
+            The bytecode offset of each instruction, including any
+            EXTENDED_ARG prefixes, followed by the length of the bytecode.
+
+        Notes
+        -----
+        Instructions whose argument does not fit in ``argsize`` bytes are
+        prefixed with EXTENDED_ARG. Jump arguments depend on the offsets which
+        depend on the size of the jumps, so jumps start out with no prefixes
+        and are grown until the layout stops changing. Each pass is linear in
+        the number of instructions and jumps only ever grow so this reaches a
+        fixpoint after at most a few passes. A jump that ends up needing fewer
+        prefixes than it was given is padded with EXTENDED_ARG 0.
+        """
+        opcodes = []
+        args = []
+        sizes = []
+        jumps = []
+        for idx, (type_, arg) in enumerate(self._raw_operations()):
+            opcodes.append(type_.opcode)
+            if type_.is_jmp:
+                # Resolved below, ``arg`` is the index of the target.
+                jumps.append((idx, arg, type_.reljmp))
+                arg = 0
+            args.append(arg)
+            sizes.append(_instr_size(arg))
+
+        while True:
+            offsets = list(accumulate(chain((0,), sizes)))
+            grew = False
+            for idx, target, reljmp in jumps:
+                arg = offsets[target]
+                if reljmp:
+                    # Relative jumps are measured from the end of the jump.
+                    arg -= offsets[idx + 1]
+                args[idx] = arg
+                size = _instr_size(arg)
+                if size > sizes[idx]:
+                    sizes[idx] = size
+                    grew = True
+
+            if not grew:
+                return opcodes, args, offsets
+
+    @property
+    def _offsets(self):
+        """The bytecode offset of each instruction by index followed by the
+        length of the bytecode.
+        """
+        return self._assembly[2]
 
     def __getitem__(self, key):
         return self.instrs[key]
@@ -857,10 +2130,74 @@ class Code:
         return iter(self.instrs)
 
     def __len__(self):
-        return len(self.instrs)
+        return len(self.opcodes)
 
     def __contains__(self, instr):
-        return instr in self.instrs
+        try:
+            return instr in self._instr_indices
+        except TypeError:
+            # unhashable objects cannot be instructions
+            return False
+
+    @_derived
+    def fingerprint(self):
+        """A hex digest of the structure of this code object.
+
+        Two code objects with the same fingerprint run the same program: the
+        fingerprint covers the instruction types, their arguments, which
+        instruction each jump targets, the constants (nested code objects
+        by their own fingerprint), the argument names, the cell and free
+        variables and the flags. It does not cover the name, filename or line
+        numbers.
+
+        The digest is blake2b, or sha256 before python 3.6, and is stable
+        across processes for code objects whose constants are builtin
+        literals or code objects. Lazy and compact code objects are
+        fingerprinted from the raw opcodes and arguments without creating
+        Instruction objects.
+        """
+        h = _fingerprint_hash()
+        update = h.update
+
+        def write(value):
+            update(len(value).to_bytes(8, 'little'))
+            update(value)
+
+        write(fingerprint_const((
+            self.py_flags,
+            self.argcount,
+            self.kwonlyargcount,
+            self.argnames,
+            self.cellvars,
+            self.freevars,
+        )))
+        # Jump arguments are the index of the target so this also covers the
+        # shape of the control flow.
+        encode = fingerprint_const
+        for type_, arg in self.operations():
+            update(bytes((type_.opcode,)))
+            if type_.have_arg:
+                write(encode(arg))
+        return h.hexdigest()
+
+    def equiv(self, other):
+        """Check if two code objects run the same program.
+
+        Parameters
+        ----------
+        other : Code
+            The code object to compare against.
+
+        Returns
+        -------
+        equiv : bool
+            Do these code objects have the same fingerprint?
+
+        See Also
+        --------
+        :attr:`~codetransformer.code.Code.fingerprint`
+        """
+        return self.fingerprint == other.fingerprint
 
     def dis(self, file=None):
         """
@@ -0,0 +1,71 @@
+"""
+codetransformer.command
+-----------------------
+
+A setuptools command that transforms a package's modules at build time.
+"""
+from distutils.errors import DistutilsOptionError
+
+from setuptools import Command
+
+from .importer import compile_paths
+
+
+class build_transformed(Command):
+    """Write the transformed bytecode for the built python modules.
+
+    This runs ``build_py`` and then applies a transformer to every module in
+    the build directory, the same way as
+    ``python -m codetransformer compile``. The bytecode is included in
+    wheels and installs built afterwards, for example:
+    ``python setup.py build_transformed bdist_wheel``.
+
+    The transformer is configured in ``setup.cfg``:
+
+    .. code-block:: ini
+
+       [build_transformed]
+       transformer = package.module:transformer
+
+    Once installed, importing the modules with a
+    :class:`~codetransformer.importer.TransformerFinder` for the same
+    transformer loads the transformed bytecode directly.
+    """
+    description = 'write transformed bytecode for the built python modules'
+    user_options = [
+        ('transformer=', 't', 'the transformer to apply, as module:attribute'),
+        ('jobs=', 'j', 'the number of processes to use'),
+        ('force', 'f', 'transform modules even if they are up to date'),
+    ]
+    boolean_options = ['force']
+
+    def initialize_options(self):
+        self.transformer = None
+        self.jobs = None
+        self.force = False
+        self.build_lib = None
+
+    def finalize_options(self):
+        if self.transformer is None:
+            raise DistutilsOptionError(
+                'build_transformed requires a transformer',
+            )
+        if self.jobs is not None:
+            self.jobs = int(self.jobs)
+        self.set_undefined_options('build_py', ('build_lib', 'build_lib'))
+
+    def run(self):
+        self.run_command('build_py')
+        written, failed = compile_paths(
+            self.transformer,
+            [self.build_lib],
+            jobs=self.jobs,
+            force=self.force,
+        )
+        for path in written:
+            self.announce('transformed %s' % path, level=2)
+        for path in failed:
+            self.warn(
+                'could not write %s: the transformed code cannot be'
+                ' marshalled' % path,
+            )
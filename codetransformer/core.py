@@ -1,7 +1,11 @@
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from ctypes import py_object, pythonapi
 from itertools import chain
+import marshal
+import pickle
+from time import perf_counter
 from types import CodeType, FunctionType
 from weakref import WeakKeyDictionary
 
@@ -10,8 +14,9 @@ try:
 except ImportError:
     import dummy_threading as threading
 
+from .cache import code_key, freeze
 from .code import Code
-from .instructions import LOAD_CONST, STORE_FAST, LOAD_FAST
+from .instructions import Instruction, LOAD_CONST, STORE_FAST, LOAD_FAST
 from .patterns import (
     boundpattern,
     patterndispatcher,
@@ -25,6 +30,122 @@ _cell_new.argtypes = (py_object,)
 _cell_new.restype = py_object
 
 
+_missing = object()
+
+# Instance attributes that configure how a transformer runs rather than what
+# it does. These are not part of the cache key and are not sent to other
+# processes.
+_runtime_attributes = frozenset({'cache', 'executor'})
+
+
+@instance
+class _pipeline_executor(threading.local):
+    """The executor of the pipeline being applied in this thread.
+
+    The stages of a pipeline use it to transform nested code objects when
+    they do not have an executor of their own.
+    """
+    executor = None
+
+
+# The last transformer unpickled in this worker process, as
+# ``(pickled, transformer)``.
+_worker_transformer = None, None
+
+
+#: The outcome of transforming one function with
+#: :meth:`~codetransformer.core.CodeTransformer.transform_many`.
+TransformResult = namedtuple(
+    'TransformResult',
+    'original function error seconds',
+)
+
+
+def _timed(f, *args):
+    """Call a function, capturing its result or exception and the time it
+    took.
+
+    Returns
+    -------
+    result : any
+        The result of ``f`` or None if it raised.
+    error : Exception or None
+        The exception raised by ``f``.
+    seconds : float
+        The time spent in ``f``.
+    """
+    start = perf_counter()
+    try:
+        result = f(*args)
+    except Exception as e:
+        return None, e, perf_counter() - start
+    return result, None, perf_counter() - start
+
+
+def _group_key(co):
+    """The key to group python code objects that are transformed once.
+
+    This is the :func:`~codetransformer.cache.code_key` of ``co``, or its
+    identity if it has constants that cannot be told apart exactly.
+    """
+    key = code_key(Code.from_pycode(co, lazy=True))
+    if key is None:
+        return 'id', id(co)
+    return key
+
+
+class _Unmarshallable(Exception):
+    """Raised by :func:`_transform_marshalled` when the transformed code
+    object cannot be marshalled to send it back.
+    """
+
+
+def _transform_marshalled(pickled, data):
+    """Transform a marshalled code object in an executor.
+
+    Parameters
+    ----------
+    pickled : bytes
+        The pickled transformer.
+    data : bytes
+        The marshalled python code object.
+
+    Returns
+    -------
+    transformed : bytes or None
+        The marshalled transformed code object, or None if the transformation
+        did not change anything.
+
+    Raises
+    ------
+    _Unmarshallable
+        Raised when the transformed code object cannot be marshalled.
+    """
+    global _worker_transformer
+
+    last, transformer = _worker_transformer
+    if last != pickled:
+        transformer = pickle.loads(pickled)
+        # Nested code objects are transformed here, even if the class has an
+        # executor.
+        transformer.executor = None
+        _worker_transformer = pickled, transformer
+
+    # A forked worker starts with the state of the thread that forked it,
+    # which may have been applying a pipeline.
+    _pipeline_executor.executor = None
+
+    code = Code.from_pycode(marshal.loads(data), lazy=True, recursive=True)
+    transformed = transformer.transform(code)
+    if transformed is code:
+        return None
+    transformed = transformed.to_pycode(reuse=True)
+    try:
+        return marshal.dumps(transformed)
+    except ValueError as e:
+        raise _Unmarshallable(str(e))
+
+
 def _a_if_not_none(a, b):
     return a if a is not None else b
 
@@ -50,6 +171,67 @@ def _new_lnotab(instrs, lnotab):
     }
 
 
+def _signature(code):
+    """The argument names of a code object in the form accepted by ``Code``.
+
+    Parameters
+    ----------
+    code : Code
+        The code object.
+
+    Returns
+    -------
+    argnames : tuple of str
+        The names of the arguments with ``*`` and ``**`` prefixes on the
+        varargs and varkwargs.
+    """
+    argnames = code.argnames
+    argcount = code.argcount
+    kwonlyargcount = code.kwonlyargcount
+    flags = code.flags
+
+    signature = list(argnames[:argcount])
+    rest = iter(argnames[argcount + kwonlyargcount:])
+    if flags['CO_VARARGS']:
+        signature.append('*' + next(rest))
+    elif kwonlyargcount:
+        signature.append('*')
+    signature.extend(argnames[argcount:argcount + kwonlyargcount])
+    if flags['CO_VARKEYWORDS']:
+        signature.append('**' + next(rest))
+    return tuple(signature)
+
+
+def _same_instrs(instrs, old_instrs, version):
+    """Are the instructions unchanged by a transformation?
+
+    Parameters
+    ----------
+    instrs : sequence[Instruction]
+        The new instructions.
+    old_instrs : sequence[Instruction]
+        The instructions before the transformation.
+    version : int
+        The value of ``Instruction._arg_version`` before the transformation.
+
+    Returns
+    -------
+    same : bool
+        True if ``instrs`` are the same instruction objects as ``old_instrs``
+        in the same order and none of them have had their arguments reassigned
+        or their line numbers stolen.
+    """
+    if len(instrs) != len(old_instrs):
+        return False
+
+    for instr, old_instr in zip(instrs, old_instrs):
+        if (instr is not old_instr or
+                instr._changed_at > version or
+                instr._stolen_by is not None):
+            return False
+    return True
+
+
 class NoContext(Exception):
     """Exception raised to indicate that the ``code` or ``startcode``
     attribute was accessed outside of a code context.
@@ -101,6 +283,74 @@ class CodeTransformer(metaclass=CodeTransformerMeta):
     """
     __slots__ = '__weakref__',
 
+    # Should nested code objects be decoded into Code objects along with the
+    # code object of a function passed to ``__call__``?
+    _recursive = False
+
+    #: The :class:`~codetransformer.cache.TransformCache` or
+    #: :class:`~codetransformer.cache.DiskCache` to store the results of
+    #: ``transform`` in. The cache is not used when this is None.
+    cache = None
+
+    #: A :class:`concurrent.futures.Executor` to transform the nested code
+    #: objects in ``co_consts`` with. They are transformed in this thread
+    #: when this is None.
+    executor = None
+
+    def cache_key(self):
+        """A hashable description of the configuration of this transformer.
+
+        Two transformers with equal keys must transform every code object the
+        same way.
+
+        Returns
+        -------
+        key : hashable or None
+            The type of this transformer and the values of its attributes
+            other than ``cache`` and ``executor``. This is None if the
+            attributes cannot be hashed, in which case the results are not
+            cached.
+
+        Notes
+        -----
+        Override this method if a transformer's behavior depends on anything
+        other than its type and instance attributes.
+        """
+        state = self.__getstate__()
+        try:
+            return type(self), freeze(state)
+        except TypeError:
+            return None
+
+    def __getstate__(self):
+        # The cache and executor belong to this process.
+        return {
+            k: v for k, v in getattr(self, '__dict__', {}).items()
+            if k not in _runtime_attributes
+        }
+
+    def __or__(self, other):
+        if not isinstance(other, CodeTransformer):
+            return NotImplemented
+        return pipeline(self, other)
+
+    @staticmethod
+    def compose(*transformers):
+        r"""Combine transformers into one that applies each of them in order.
+
+        Parameters
+        ----------
+        \*transformers : iterable of CodeTransformer
+            The transformers to apply, first to last.
+
+        Returns
+        -------
+        composed : pipeline
+            The combined transformer. ``t1 | t2`` is the same as
+            ``CodeTransformer.compose(t1, t2)``.
+        """
+        return pipeline(*transformers)
+
     def transform_consts(self, consts):
         """transformer for the co_consts field.
 
@@ -115,13 +365,70 @@ class CodeTransformer(metaclass=CodeTransformerMeta):
         -------
         new_consts : tuple
             The new constants.
+
+        Notes
+        -----
+        Nested code objects that are already Code objects, like the ones
+        created by ``Code.from_pycode(co, recursive=True)``, are transformed
+        and kept as Code objects so that they are only assembled once with the
+        outer code object.
+
+        If ``executor`` is set, or this transformer is a stage of a pipeline
+        with an executor, the nested code objects are marshalled and
+        transformed in the executor instead. The results are python code
+        objects in the same order. Nested code objects that cannot be
+        marshalled, and all of them if this transformer cannot be pickled,
+        are transformed in this thread.
         """
-        return tuple(
-            self.transform(Code.from_pycode(const)).to_pycode()
-            if isinstance(const, CodeType) else
-            const
-            for const in consts
-        )
+        executor = _a_if_not_none(self.executor, _pipeline_executor.executor)
+        if executor is not None:
+            return self._transform_consts_in(executor, consts)
+        return tuple(map(self._transform_const, consts))
+
+    def _transform_const(self, const):
+        if isinstance(const, CodeType):
+            return self.transform(
+                Code.from_pycode(const, lazy=True),
+            ).to_pycode(reuse=True)
+        if isinstance(const, Code):
+            return self.transform(const)
+        return const
+
+    def _transform_consts_in(self, executor, consts):
+        try:
+            pickled = pickle.dumps(self)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return tuple(map(self._transform_const, consts))
+
+        futures = {}
+        for n, const in enumerate(consts):
+            if isinstance(const, Code):
+                pycode = const.to_pycode(reuse=True)
+            elif isinstance(const, CodeType):
+                pycode = const
+            else:
+                continue
+            try:
+                data = marshal.dumps(pycode)
+            except ValueError:
+                continue
+            futures[n] = executor.submit(_transform_marshalled, pickled, data)
+
+        new_consts = []
+        for n, const in enumerate(consts):
+            future = futures.get(n)
+            if future is None:
+                new_consts.append(self._transform_const(const))
+                continue
+            try:
+                data = future.result()
+            except _Unmarshallable:
+                # The result could not be marshalled. Any other error from
+                # the transformer is raised again here.
+                new_consts.append(self._transform_const(const))
+                continue
+            new_consts.append(const if data is None else marshal.loads(data))
+        return tuple(new_consts)
 
     def _id(self, obj):
         """Identity function.
@@ -162,63 +469,292 @@ class CodeTransformer(metaclass=CodeTransformerMeta):
         Returns
         -------
         new_code : Code
-            The transformed code object.
+            The transformed code object. This is ``code`` itself if the
+            transformation did not change anything.
+
+        Notes
+        -----
+        If ``cache`` is set, the result is looked up by the
+        :meth:`cache_key` of this transformer and the
+        :func:`~codetransformer.cache.code_key` of ``code``. Results are
+        assembled before they are stored, and a new lazy Code object is
+        returned for each lookup.
         """
-        # reverse lookups from for constants and names.
-        reversed_consts = {}
-        reversed_names = {}
-        reversed_varnames = {}
-        for instr in code:
-            if isinstance(instr, LOAD_CONST):
-                reversed_consts[instr] = instr.arg
-            if instr.uses_name:
-                reversed_names[instr] = instr.arg
-            if isinstance(instr, (STORE_FAST, LOAD_FAST)):
-                reversed_varnames[instr] = instr.arg
-
-        instrs, consts = tuple(zip(*reversed_consts.items())) or ((), ())
-        for instr, const in zip(instrs, self.transform_consts(consts)):
-            instr.arg = const
-
-        instrs, names = tuple(zip(*reversed_names.items())) or ((), ())
-        for instr, name_ in zip(instrs, self.transform_names(names)):
-            instr.arg = name_
-
-        instrs, varnames = tuple(zip(*reversed_varnames.items())) or ((), ())
-        for instr, varname in zip(instrs, self.transform_varnames(varnames)):
-            instr.arg = varname
+        cache = self.cache
+        key = None
+        if cache is not None:
+            transformer_key = self.cache_key()
+            if transformer_key is not None:
+                input_key = code_key(code)
+                if input_key is not None:
+                    key = transformer_key, input_key, name, filename
+
+        if key is None:
+            return self._transform(code, name=name, filename=filename)
+
+        result = cache.get(key, _missing)
+        if result is _missing:
+            new_code = self._transform(code, name=name, filename=filename)
+            result = None if new_code is code else new_code.to_pycode()
+            cache.set(key, result)
+
+        if result is None:
+            # The transformation did not change anything.
+            return code
+        return Code.from_pycode(result, lazy=True)
+
+    def _transform(self, code, *, name=None, filename=None):
+        version = Instruction._arg_version
+
+        # The index and argument of the instructions whose arguments are
+        # transformed. These are read from the operations so that the
+        # instructions of a lazy code object are only created if an argument
+        # changes or a pattern matches.
+        consts = []
+        names = []
+        varnames = []
+        for idx, (type_, arg) in enumerate(code.operations()):
+            if issubclass(type_, LOAD_CONST):
+                consts.append((idx, arg))
+            if type_.uses_name:
+                names.append((idx, arg))
+            if issubclass(type_, (STORE_FAST, LOAD_FAST)):
+                varnames.append((idx, arg))
+
+        # Only reassign the arguments that were changed so that we can tell
+        # if anything was transformed.
+        changed = False
+        for operands, transform in ((consts, self.transform_consts),
+                                    (names, self.transform_names),
+                                    (varnames, self.transform_varnames)):
+            indices, args = tuple(zip(*operands)) or ((), ())
+            for idx, arg, new_arg in zip(indices, args, transform(args)):
+                if new_arg is not arg:
+                    code[idx].arg = new_arg
+                    changed = True
 
         with self._new_context(code):
-            post_transform = self.patterndispatcher(code)
+            post_transform = self.patterndispatcher.apply(code)
+            if post_transform is None:
+                same_instrs = not changed
+            else:
+                same_instrs = _same_instrs(
+                    post_transform,
+                    code.instrs,
+                    version,
+                )
+
+            cellvars = self.transform_cellvars(code.cellvars)
+            freevars = self.transform_freevars(code.freevars)
+            name = name if name is not None else code.name
+            filename = filename if filename is not None else code.filename
+            if (cellvars == code.cellvars and
+                    freevars == code.freevars and
+                    name == code.name and
+                    filename == code.filename and
+                    same_instrs):
+                return code
+
+            if post_transform is None:
+                post_transform = tuple(code)
 
             return Code(
                 post_transform,
-                code.argnames,
-                cellvars=self.transform_cellvars(code.cellvars),
-                freevars=self.transform_freevars(code.freevars),
-                name=name if name is not None else code.name,
-                filename=filename if filename is not None else code.filename,
+                _signature(code),
+                cellvars=cellvars,
+                freevars=freevars,
+                name=name,
+                filename=filename,
                 firstlineno=code.firstlineno,
                 lnotab=_new_lnotab(post_transform, code.lnotab),
-                flags=code.flags,
+                flags=code.py_flags,
             )
 
     def __call__(self, f, *,
-                 globals_=None, name=None, defaults=None, closure=None):
+                 globals_=None,
+                 name=None,
+                 defaults=None,
+                 closure=None,
+                 copy=False):
+        """Transform a function.
+
+        Parameters
+        ----------
+        f : function
+            The function to transform.
+        globals_ : dict, optional
+            The globals for the new function.
+        name : str, optional
+            The name of the new function.
+        defaults : tuple, optional
+            The default arguments for the new function.
+        closure : tuple, optional
+            The values of the closure cells for the new function.
+        copy : bool, optional
+            Return a new function even if the transformation did not change
+            anything.
+
+        Returns
+        -------
+        transformed : function
+            The transformed function. This is ``f`` itself if the
+            transformation did not change anything and no other arguments
+            were passed.
+        """
         # Callable so that we can use CodeTransformers as decorators.
+        code = Code.from_pycode(
+            f.__code__,
+            lazy=True,
+            recursive=self._recursive,
+        )
+        transformed = self.transform(code)
+        if transformed is code:
+            overrides = globals_, name, defaults, closure
+            if not copy and all(arg is None for arg in overrides):
+                return f
+            # Nothing changed so there is no need to assemble the code.
+            new_code = f.__code__
+        else:
+            new_code = transformed.to_pycode(reuse=True)
+
         if closure is not None:
             closure = tuple(map(_cell_new, closure))
         else:
             closure = f.__closure__
 
         return FunctionType(
-            self.transform(Code.from_pycode(f.__code__)).to_pycode(),
+            new_code,
             _a_if_not_none(globals_, f.__globals__),
             _a_if_not_none(name, f.__name__),
             _a_if_not_none(defaults, f.__defaults__),
             closure,
         )
 
+    def transform_many(self, functions, *, executor=None):
+        """Transform many functions.
+
+        Parameters
+        ----------
+        functions : iterable of function
+            The functions to transform.
+        executor : concurrent.futures.Executor, optional
+            The thread or process pool to transform the functions in. By
+            default, they are transformed in this thread.
+
+        Returns
+        -------
+        results : list of TransformResult
+            For each function, in order: the original function, the
+            transformed function, the exception raised while transforming
+            it, and the seconds spent transforming it. ``function`` is the
+            original function if nothing changed and None if transforming
+            raised an exception.
+
+        Notes
+        -----
+        Each distinct code object is decoded and transformed once. Functions
+        whose code objects have the same
+        :func:`~codetransformer.cache.code_key` share one transformation and
+        its time. With a process
+        pool, code objects are sent as marshalled data and the transformer is
+        pickled once; when that is not possible they are transformed in this
+        thread. Exceptions raised in a process pool must be picklable to be
+        reported.
+        """
+        functions = list(functions)
+        results = [None] * len(functions)
+
+        # Group the functions by their code object so that each distinct
+        # code object is decoded and transformed once. Functions often share
+        # a code object so each key is only computed once.
+        groups = OrderedDict()
+        keys = {}
+        for n, f in enumerate(functions):
+            try:
+                co = f.__code__
+                try:
+                    key = keys[id(co)]
+                except KeyError:
+                    key = keys[id(co)] = _group_key(co)
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = co, []
+            except Exception as e:
+                results[n] = TransformResult(f, None, e, 0.0)
+                continue
+            group[1].append(n)
+
+        pickled = None
+        if executor is not None and not isinstance(
+                executor, ThreadPoolExecutor):
+            try:
+                pickled = pickle.dumps(self)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                executor = None
+
+        def submit(f, *args):
+            if executor is None:
+                return _timed(f, *args)
+            return executor.submit(_timed, f, *args)
+
+        tasks = []
+        for co, indices in groups.values():
+            data = None
+            if pickled is not None:
+                try:
+                    data = marshal.dumps(co)
+                except ValueError:
+                    pass
+            if data is not None:
+                task = submit(_transform_marshalled, pickled, data)
+            else:
+                task = submit(self._transform_pycode, co)
+            tasks.append((task, data is not None, co, indices))
+
+        for task, marshalled, co, indices in tasks:
+            result, error, seconds = (
+                task if executor is None else task.result()
+            )
+            if marshalled:
+                if isinstance(error, _Unmarshallable):
+                    # The result could not be marshalled, try again here to
+                    # either get the result or raise the error.
+                    result, error, seconds = _timed(self._transform_pycode, co)
+                elif result is not None:
+                    result = marshal.loads(result)
+
+            for n in indices:
+                f = functions[n]
+                if error is not None:
+                    new = None
+                elif result is None:
+                    new = f
+                else:
+                    new = FunctionType(
+                        result,
+                        f.__globals__,
+                        f.__name__,
+                        f.__defaults__,
+                        f.__closure__,
+                    )
+                results[n] = TransformResult(f, new, error, seconds)
+
+        return results
+
+    def _transform_pycode(self, co):
+        """Transform a python code object.
+
+        Returns
+        -------
+        transformed : CodeType or None
+            The transformed python code object, or None if nothing changed.
+        """
+        code = Code.from_pycode(co, lazy=True, recursive=self._recursive)
+        transformed = self.transform(code)
+        if transformed is code:
+            return None
+        return transformed.to_pycode(reuse=True)
+
     @instance
     class _context_stack(threading.local):
         """Thread safe transformation context stack.
@@ -290,3 +826,80 @@ class CodeTransformer(metaclass=CodeTransformerMeta):
             The startcode to begin.
         """
         self.context.startcode = startcode
+
+
+class pipeline(CodeTransformer):
+    r"""A transformer that applies other transformers in order.
+
+    Parameters
+    ----------
+    \*transformers : iterable of CodeTransformer
+        The transformers to apply, first to last.
+
+    Notes
+    -----
+    The code object is decoded once, each transformer is applied to the
+    :class:`~codetransformer.code.Code` object returned by the one before it,
+    and the result is assembled once at the end. Each transformer keeps its
+    own context and startcode.
+
+    When a function is transformed, nested code objects are decoded up front
+    so ``transform_consts`` will see them as
+    :class:`~codetransformer.code.Code` objects instead of python code
+    objects.
+
+    Examples
+    --------
+    >>> from codetransformer.transformers import asconstants
+    >>> from codetransformer.transformers.precomputed_slices import (
+    ...     precomputed_slices,
+    ... )
+    >>> optimize = asconstants('len') | precomputed_slices()
+    >>> @optimize
+    ... def f(a):
+    ...     return len(a[1:3])
+    ...
+    >>> f([1, 2, 3, 4])
+    2
+    """
+    _recursive = True
+
+    def __init__(self, *transformers):
+        super().__init__()
+        if not transformers:
+            raise TypeError('expected at least one transformer')
+
+        flattened = []
+        for transformer in transformers:
+            if isinstance(transformer, pipeline):
+                flattened.extend(transformer.transformers)
+            else:
+                flattened.append(transformer)
+        self.transformers = tuple(flattened)
+
+    def cache_key(self):
+        keys = tuple(t.cache_key() for t in self.transformers)
+        if any(key is None for key in keys):
+            return None
+        return type(self), keys
+
+    def _transform(self, code, *, name=None, filename=None):
+        if self.executor is None:
+            return self._apply(code, name, filename)
+
+        previous = _pipeline_executor.executor
+        _pipeline_executor.executor = self.executor
+        try:
+            return self._apply(code, name, filename)
+        finally:
+            _pipeline_executor.executor = previous
+
+    def _apply(self, code, name, filename):
+        first, *rest = self.transformers
+        code = first.transform(code, name=name, filename=filename)
+        for transformer in rest:
+            code = transformer.transform(code)
+        return code
+
+    def __repr__(self):
+        return ' | '.join(map(repr, self.transformers))
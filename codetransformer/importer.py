@@ -0,0 +1,484 @@
+"""
+codetransformer.importer
+------------------------
+
+An import hook which applies a transformer to entire modules.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from hashlib import sha256
+from importlib import import_module
+from importlib.abc import MetaPathFinder
+from importlib.machinery import PathFinder, SourceFileLoader
+from importlib.util import MAGIC_NUMBER, cache_from_source
+import marshal
+import os
+import sys
+
+from .cache import _stable_encode
+from .code import Code
+
+
+# magic number, transformer tag, source mtime and size, source hash
+_header_size = len(MAGIC_NUMBER) + 32 + 8 + 16
+
+
+def _pack_stats(stats):
+    return b''.join((
+        (int(stats['mtime']) & 0xFFFFFFFF).to_bytes(4, 'little'),
+        (stats['size'] & 0xFFFFFFFF).to_bytes(4, 'little'),
+    ))
+
+
+def _source_hash(source):
+    return sha256(source).digest()[:16]
+
+
+def transformer_tag(transformer):
+    """A digest of a transformer's configuration that is the same in every
+    process.
+
+    Parameters
+    ----------
+    transformer : CodeTransformer
+        The transformer to identify.
+
+    Returns
+    -------
+    tag : str or None
+        The hex digest of the transformer's
+        :meth:`~codetransformer.core.CodeTransformer.cache_key` along with
+        the versions of Python and codetransformer. This is None if the
+        transformer cannot be identified across processes.
+    """
+    from codetransformer import __version__
+
+    key = transformer.cache_key()
+    if key is None:
+        return None
+    try:
+        encoded = _stable_encode((MAGIC_NUMBER, __version__, key))
+    except TypeError:
+        return None
+    return sha256(encoded).hexdigest()
+
+
+class UnmarshallableCode(ValueError):
+    """Raised when transformed code cannot be written because it has
+    constants that cannot be marshalled.
+    """
+
+
+#: The outcome of :func:`~codetransformer.importer.compile_paths`.
+CompileResult = namedtuple('CompileResult', 'written failed')
+
+
+class TransformerLoader(SourceFileLoader):
+    """A source file loader which transforms the module's code object and
+    every code object nested in it.
+
+    Parameters
+    ----------
+    fullname : str
+        The name of the module.
+    path : str
+        The path to the module's source file.
+    transformer : CodeTransformer
+        The transformer to apply.
+    tag : str or None
+        The :func:`transformer_tag` of ``transformer``. The transformed code
+        is not written to disk when this is None.
+
+    Notes
+    -----
+    The transformed bytecode is cached next to the regular ``.pyc`` file,
+    with a name that includes the tag, so it never replaces the untransformed
+    bytecode.
+    """
+    def __init__(self, fullname, path, transformer, tag):
+        super().__init__(fullname, path)
+        self.transformer = transformer
+        self.tag = tag
+
+    def cache_path(self, source_path):
+        """The path to the transformed bytecode for a source file.
+
+        Parameters
+        ----------
+        source_path : str
+            The path to the source file.
+
+        Returns
+        -------
+        cache_path : str or None
+            The path to the transformed bytecode, or None if it should not be
+            cached.
+        """
+        if self.tag is None:
+            return None
+        try:
+            base, ext = os.path.splitext(cache_from_source(source_path))
+        except NotImplementedError:
+            # this implementation does not cache bytecode
+            return None
+        return '%s.codetransformer-%s%s' % (base, self.tag[:16], ext)
+
+    def _header(self, source_path, source_hash):
+        stats = self.path_stats(source_path)
+        return b''.join((
+            MAGIC_NUMBER,
+            bytes.fromhex(self.tag),
+            _pack_stats(stats),
+            source_hash,
+        ))
+
+    def _cached_code(self, source_path, cache_path):
+        """Load the transformed bytecode for a source file if it is up to
+        date.
+
+        Returns
+        -------
+        code : CodeType or None
+            The cached code object, or None if there is no usable cache.
+        """
+        try:
+            data = self.get_data(cache_path)
+        except OSError:
+            return None
+
+        prefix = MAGIC_NUMBER + bytes.fromhex(self.tag)
+        if len(data) < _header_size or not data.startswith(prefix):
+            return None
+
+        stats = data[len(prefix):len(prefix) + 8]
+        stale = stats != _pack_stats(self.path_stats(source_path))
+        source_hash = data[len(prefix) + 8:_header_size]
+        if stale and source_hash != _source_hash(self.get_data(source_path)):
+            return None
+
+        try:
+            code = marshal.loads(memoryview(data)[_header_size:])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+        if stale and not sys.dont_write_bytecode:
+            # The source file was touched but its contents are the same, so
+            # the bytecode is still valid. Update the header so the next
+            # import does not need to hash the source again.
+            self.set_data(
+                cache_path,
+                self._header(source_path, source_hash) +
+                data[_header_size:],
+            )
+        return code
+
+    def _transform_source(self, source_path):
+        """Compile and transform a source file.
+
+        Returns
+        -------
+        code : CodeType
+            The transformed module code object.
+        source_hash : bytes
+            The hash of the source that was compiled.
+        """
+        source = self.get_data(source_path)
+        code = self.source_to_code(source, source_path)
+        code = self.transformer.transform(
+            Code.from_pycode(code, lazy=True, recursive=True),
+        ).to_pycode(reuse=True)
+        return code, _source_hash(source)
+
+    def _write(self, source_path, cache_path, code, source_hash):
+        try:
+            data = self._header(source_path, source_hash) + marshal.dumps(code)
+        except ValueError:
+            # the transformer added constants that cannot be marshalled
+            return False
+        self.set_data(cache_path, data)
+        return True
+
+    def get_code(self, fullname):
+        source_path = self.get_filename(fullname)
+        cache_path = self.cache_path(source_path)
+        if cache_path is not None:
+            code = self._cached_code(source_path, cache_path)
+            if code is not None:
+                return code
+
+        code, source_hash = self._transform_source(source_path)
+        if cache_path is not None and not sys.dont_write_bytecode:
+            self._write(source_path, cache_path, code, source_hash)
+        return code
+
+    def compile(self, source_path, force=False):
+        """Write the transformed bytecode for a source file ahead of time.
+
+        Parameters
+        ----------
+        source_path : str
+            The path to the source file.
+        force : bool, optional
+            Transform the source even if the cached bytecode is up to date.
+
+        Returns
+        -------
+        written : bool
+            Was the source transformed and written? This is False if the
+            cached bytecode was up to date or the transformer cannot be
+            cached.
+
+        Raises
+        ------
+        UnmarshallableCode
+            Raised when the transformed code has constants that cannot be
+            marshalled, so it cannot be written.
+        """
+        cache_path = self.cache_path(source_path)
+        if cache_path is None:
+            return False
+        if not force:
+            if self._cached_code(source_path, cache_path) is not None:
+                return False
+        if not self._write(
+                source_path,
+                cache_path,
+                *self._transform_source(source_path)):
+            raise UnmarshallableCode(
+                'the transformed code for %s cannot be marshalled'
+                % source_path,
+            )
+        return True
+
+
+class TransformerFinder(MetaPathFinder):
+    r"""A ``sys.meta_path`` finder which applies a transformer to the modules
+    that match any of the given patterns.
+
+    Parameters
+    ----------
+    transformer : CodeTransformer
+        The transformer to apply.
+    \*modules : iterable of str
+        The names of the modules to transform. These are ``fnmatch`` style
+        patterns, for example: ``'package.*'``.
+
+    Notes
+    -----
+    Only modules that are loaded from source files on ``sys.path`` are
+    transformed. Modules that were imported before the finder was installed
+    are not reloaded.
+
+    Examples
+    --------
+    >>> from codetransformer.transformers import precomputed_slices
+    >>> finder = TransformerFinder(precomputed_slices(), 'mypackage.*')
+    >>> with finder:  # doctest: +SKIP
+    ...     import mypackage.module
+    """
+    def __init__(self, transformer, *modules):
+        if not modules:
+            raise TypeError('expected at least one module pattern')
+        self.transformer = transformer
+        self.modules = modules
+        self.tag = transformer_tag(transformer)
+
+    def find_spec(self, fullname, path=None, target=None):
+        if not any(fnmatchcase(fullname, module) for module in self.modules):
+            return None
+
+        spec = PathFinder.find_spec(fullname, path)
+        if spec is None or not isinstance(spec.loader, SourceFileLoader):
+            return None
+
+        loader = spec.loader = TransformerLoader(
+            fullname,
+            spec.origin,
+            self.transformer,
+            self.tag,
+        )
+        cache_path = loader.cache_path(spec.origin)
+        if cache_path is not None:
+            spec.cached = cache_path
+        return spec
+
+    def install(self):
+        """Add this finder to the front of ``sys.meta_path``.
+
+        Returns
+        -------
+        self : TransformerFinder
+            This finder.
+        """
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        """Remove this finder from ``sys.meta_path``.
+        """
+        try:
+            sys.meta_path.remove(self)
+        except ValueError:
+            pass
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *excinfo):
+        self.uninstall()
+
+    def __repr__(self):
+        return '{cls}({args})'.format(
+            cls=type(self).__name__,
+            args=', '.join(map(repr, (self.transformer,) + self.modules)),
+        )
+
+
+def resolve_transformer(name):
+    """Look up a transformer by name.
+
+    Parameters
+    ----------
+    name : str
+        The transformer as ``'module:attribute'``. The attribute may be a
+        dotted path. If it names a ``CodeTransformer`` subclass, the class is
+        called with no arguments.
+
+    Returns
+    -------
+    transformer : CodeTransformer
+        The transformer.
+    """
+    from .core import CodeTransformer
+
+    module, sep, attr = name.partition(':')
+    if not sep or not attr:
+        raise ValueError(
+            'transformer must be given as module:attribute, got %r' % name,
+        )
+    ob = import_module(module)
+    for part in attr.split('.'):
+        ob = getattr(ob, part)
+
+    if isinstance(ob, type) and issubclass(ob, CodeTransformer):
+        ob = ob()
+    if not isinstance(ob, CodeTransformer):
+        raise TypeError('%r is not a CodeTransformer: %r' % (name, ob))
+    return ob
+
+
+def _iter_sources(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    yield os.path.join(dirpath, filename)
+
+
+def _module_name(source_path):
+    """The dotted name of the module in a source file.
+
+    Parameters
+    ----------
+    source_path : str
+        The path to the source file.
+
+    Returns
+    -------
+    fullname : str
+        The name of the module, found by walking up the directories that
+        contain an ``__init__.py``. ``pkg/sub/__init__.py`` is ``pkg.sub``.
+    """
+    directory, filename = os.path.split(os.path.abspath(source_path))
+    name = os.path.splitext(filename)[0]
+    parts = [] if name == '__init__' else [name]
+    while os.path.isfile(os.path.join(directory, '__init__.py')):
+        directory, package = os.path.split(directory)
+        parts.append(package)
+    return '.'.join(reversed(parts))
+
+
+# The transformers resolved in this process, by name.
+_resolved = {}
+
+
+def _compile_one(args):
+    name, source_path, force = args
+    try:
+        transformer, tag = _resolved[name]
+    except KeyError:
+        transformer = resolve_transformer(name)
+        tag = transformer_tag(transformer)
+        _resolved[name] = transformer, tag
+
+    loader = TransformerLoader(
+        _module_name(source_path),
+        source_path,
+        transformer,
+        tag,
+    )
+    try:
+        return loader.compile(source_path, force=force)
+    except UnmarshallableCode:
+        return None
+
+
+def compile_paths(name, paths, *, jobs=None, force=False):
+    """Write the transformed bytecode for source files ahead of time so that
+    a :class:`TransformerFinder` with the same transformer imports them
+    without transforming anything.
+
+    Parameters
+    ----------
+    name : str
+        The transformer to apply as ``'module:attribute'``. See
+        :func:`resolve_transformer`.
+    paths : iterable of str
+        The source files and directories to compile. Directories are
+        searched recursively for ``.py`` files.
+    jobs : int, optional
+        The number of processes to use. By default, one per cpu.
+    force : bool, optional
+        Transform every file, even if its cached bytecode is up to date.
+
+    Returns
+    -------
+    result : CompileResult
+        ``written`` is the list of the source files that were transformed and
+        ``failed`` is the list of the source files whose transformed code
+        could not be written because it cannot be marshalled.
+
+    Notes
+    -----
+    Sources whose cached bytecode came from the same transformer and has the
+    same contents, by hash, are skipped, so repeated builds only transform
+    the files that changed. The failed sources are transformed again by
+    every build and when they are imported.
+    """
+    if transformer_tag(resolve_transformer(name)) is None:
+        raise ValueError(
+            'transformer %r cannot be identified across processes so its'
+            ' results cannot be cached' % name,
+        )
+
+    sources = list(_iter_sources(paths))
+    args = [(name, source, force) for source in sources]
+    if jobs == 1:
+        results = list(map(_compile_one, args))
+    else:
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(_compile_one, args))
+    written = []
+    failed = []
+    for source, result in zip(sources, results):
+        if result:
+            written.append(source)
+        elif result is None:
+            failed.append(source)
+    return CompileResult(written, failed)
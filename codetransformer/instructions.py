@@ -5,7 +5,6 @@ from enum import (
     unique,
 )
 from operator import attrgetter
-from re import escape
 
 from .patterns import matchable
 from .utils.immutable import immutableattr
@@ -115,8 +114,8 @@ class InstructionMeta(ABCMeta, matchable):
         )
         return cls
 
-    def mcompile(self):
-        return escape(bytes((self.opcode,)))
+    def first_opcodes(self):
+        return frozenset((self.opcode,)), False
 
     def __repr__(self):
         return self._reprname
@@ -138,15 +137,35 @@ class Instruction(InstructionMeta._marker, metaclass=InstructionMeta):
     """
     _no_arg = no_default
 
+    # Incremented every time the ``arg`` of an existing instruction is
+    # reassigned. Code objects use this to know when values derived from
+    # their instructions are stale.
+    _arg_version = 0
+    # The value of ``_arg_version`` when the ``arg`` of this instruction was
+    # last reassigned.
+    _changed_at = 0
+
     def __init__(self, arg=_no_arg):
         if self.have_arg and arg is self._no_arg:
             raise TypeError(
                 "{} missing 1 required argument: 'arg'".format(self.opname),
             )
-        self.arg = self._normalize_arg(arg)
+        self._arg = self._normalize_arg(arg)
         self._target_of = set()
         self._stolen_by = None  # used for lnotab recalculation
 
+    @property
+    def arg(self):
+        """The argument to this instruction.
+        """
+        return self._arg
+
+    @arg.setter
+    def arg(self, value):
+        self._arg = value
+        Instruction._arg_version += 1
+        self._changed_at = Instruction._arg_version
+
     def __repr__(self):
         arg = self.arg
         return '{op}{arg}'.format(
@@ -225,14 +244,30 @@ class Instruction(InstructionMeta._marker, metaclass=InstructionMeta):
           binary operator, and push the resulting value onto the stack.
           They have a stack effect of -1 (-2 values consumed + 1 value pushed).
         """
-        if self.opcode == NOP.opcode:  # noqa
+        return type(self)._stack_effect(self.arg)
+
+    @classmethod
+    def _stack_effect(cls, arg):
+        """The stack effect of an instance of this instruction type with
+        the given argument.
+
+        Parameters
+        ----------
+        arg : any
+            The argument to the instruction.
+
+        Returns
+        -------
+        stack_effect : int
+            The net effect on the interpreter stack.
+        """
+        if cls.opcode == NOP.opcode:  # noqa
             # dis.stack_effect is broken here
             return 0
 
         return stack_effect(
-            self.opcode,
-            *((self.arg if isinstance(self.arg, int) else 0,)
-              if self.have_arg else ())
+            cls.opcode,
+            *((arg if isinstance(arg, int) else 0,) if cls.have_arg else ())
         )
 
     def equiv(self, instr):
@@ -399,7 +434,8 @@ for name, opcode in opmap.items():
         opname[opcode],
         (Instruction,), {
             '__module__': __name__,
-            '__qualname__': '.'.join((__name__, name)),
+            # The unqualified name lets pickle find the class.
+            '__qualname__': name,
         },
         opcode=opcode,
     )
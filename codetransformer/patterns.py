@@ -1,14 +1,21 @@
-from operator import methodcaller, index, attrgetter
+from abc import ABCMeta, abstractmethod
+from collections.abc import Sequence
+from itertools import chain
+from operator import methodcaller, index, attrgetter, eq, ne, is_
 import re
 from types import MethodType
+import warnings
 
+from .automaton import ALL_OPCODES, DFA, NFA
 from .utils.instance import instance
 from .utils.immutable import immutable
 
 
 #: The default startcode for patterns.
 DEFAULT_STARTCODE = 0
-mcompile = methodcaller('mcompile')
+first_opcodes = methodcaller('first_opcodes')
+#: The number of automaton states above which creating a pattern warns.
+COMPLEXITY_THRESHOLD = 2000
 
 
 def _prepr(m):
@@ -19,14 +26,51 @@ def _prepr(m):
 
 
 def coerce_ellipsis(p):
-    """Convert ... into a matchany
+    """Convert ... into a matchany and an instruction into a matchable for
+    instructions of the same type with an equal argument.
     """
     if p is ...:
         return matchany
 
+    if isinstance(type(p), matchable) and not isinstance(p, type):
+        # ``p`` is an instance of an instruction type.
+        return type(p).where(arg=p.arg)
+
     return p
 
 
+def _in(value, container):
+    return value in container
+
+
+#: The operations that can be used in the lookups passed to
+#: :meth:`matchable.where`.
+_lookups = {
+    'eq': eq,
+    'ne': ne,
+    'in': _in,
+    'is': is_,
+    'isinstance': isinstance,
+}
+
+
+def _single_opcodes(m):
+    """The opcodes of a matchable that always matches exactly one
+    instruction.
+    """
+    if isinstance(m, type) or m is matchany:
+        return m.first_opcodes()[0]
+    if isinstance(m, or_):
+        return frozenset().union(*map(_single_opcodes, m.matchables))
+    if isinstance(m, not_) and isinstance(m.matchable, type):
+        return m.first_opcodes()[0]
+
+    raise TypeError(
+        'where may only be used on a matchable for a single instruction,'
+        ' got: {!r}'.format(m),
+    )
+
+
 class matchable:
     """Mixin for defining the operators on patterns.
     """
@@ -35,6 +79,7 @@ class matchable:
         if self is other:
             return self
 
+        other = coerce_ellipsis(other)
         if not isinstance(other, matchable):
             return NotImplemented
 
@@ -52,14 +97,95 @@ class matchable:
 
     def __ror__(self, other):
         # Flip the order on the or method
+        other = coerce_ellipsis(other)
         if not isinstance(other, matchable):
             return NotImplemented
 
-        return type(self).__or__(coerce_ellipsis(other), self)
+        return type(self).__or__(other, self)
 
     def __invert__(self):
         return not_(self)
 
+    def where(self, *predicates, **lookups):
+        r"""Only match the instructions that pass some tests.
+
+        Parameters
+        ----------
+        \*predicates : callable[(CodeTransformer, Instruction) -> bool]
+            Functions called with the transformer and the instruction.
+        \*\*lookups : any
+            Tests on the attributes of the instruction. The keys are either an
+            attribute name like ``arg`` which is compared for equality or an
+            attribute name and an operation like ``arg__in``. The operations
+            are ``eq``, ``ne``, ``in``, ``is``, and ``isinstance``.
+
+        Returns
+        -------
+        guarded : guarded
+            The new matchable.
+
+        Examples
+        --------
+        Match a ``LOAD_GLOBAL`` of ``len`` or ``print``::
+
+            LOAD_GLOBAL.where(arg__in={'len', 'print'})
+
+        Match a ``LOAD_CONST`` of a name in the transformer's ``names``::
+
+            LOAD_CONST.where(lambda self, instr: instr.arg in self.names)
+
+        Notes
+        -----
+        The tests are checked while matching, before the function for the
+        pattern is called.
+        """
+        parsed = []
+        for key, value in sorted(lookups.items()):
+            attr, _, op = key.partition('__')
+            try:
+                parsed.append((attr, op or 'eq', _lookups[op or 'eq'], value))
+            except KeyError:
+                raise TypeError('invalid lookup: {}'.format(key))
+
+        return guarded(self, predicates, tuple(parsed))
+
+    def mcompile(self, nfa):
+        """Build the automaton for this pattern.
+
+        Parameters
+        ----------
+        nfa : NFA
+            The automaton to add the states to.
+
+        Returns
+        -------
+        start, end : int
+            The states in ``nfa`` where a match of this pattern starts and
+            ends.
+
+        Notes
+        -----
+        By default a matchable matches exactly one instruction whose opcode
+        is in :meth:`first_opcodes`. Matchables that match more or fewer
+        instructions must override this.
+        """
+        return nfa.symbol(self.first_opcodes()[0])
+
+    def first_opcodes(self):
+        """The opcodes that a match of this pattern can start with.
+
+        Returns
+        -------
+        opcodes : frozenset[int]
+            The opcodes that a non-empty match can start with. This may be a
+            superset of the real set but must never be missing an opcode.
+        nullable : bool
+            Can this pattern match zero instructions?
+        """
+        # Without knowing anything about the pattern we must assume that it
+        # can start anywhere.
+        return ALL_OPCODES, True
+
     def __getitem__(self, key):
         try:
             n = index(key)
@@ -82,8 +208,12 @@ class postfix_modifier(immutable, matchable):
     """
     __slots__ = 'matchable', 'modifier'
 
-    def mcompile(self):
-        return self.matchable.mcompile() + self.modifier.mcompile()
+    def mcompile(self, nfa):
+        return self.modifier.apply(nfa, self.matchable.mcompile(nfa))
+
+    def first_opcodes(self):
+        opcodes, nullable = self.matchable.first_opcodes()
+        return opcodes, nullable or self.modifier is not plus
 
     def __repr__(self):
         return '%r[%r]' % (self.matchable, self.modifier)
@@ -93,18 +223,23 @@ class postfix_modifier(immutable, matchable):
 class meta(matchable):
     """Class for meta patterns and pattern likes. for example: ``matchany``.
     """
-    def mcompile(self):
-        return self._token
-
     def __repr__(self):
         return self._token.decode('utf-8')
     __str__ = __repr__
 
 
-class modifier(meta):
+class modifier(meta, metaclass=ABCMeta):
     """Marker class for modifier types.
     """
-    pass
+    @abstractmethod
+    def apply(self, nfa, fragment):
+        """Apply this modifier to a fragment of an automaton.
+        """
+
+    def mcompile(self, nfa):
+        # A modifier on its own applies to any instruction, so ``var`` is the
+        # same as ``matchany[var]``.
+        return self.apply(nfa, matchany.mcompile(nfa))
 
 
 @instance
@@ -113,6 +248,9 @@ class var(modifier):
     """
     _token = b'*'
 
+    def apply(self, nfa, fragment):
+        return nfa.star(fragment)
+
 
 @instance
 class plus(modifier):
@@ -120,6 +258,9 @@ class plus(modifier):
     """
     _token = b'+'
 
+    def apply(self, nfa, fragment):
+        return nfa.plus(fragment)
+
 
 @instance
 class option(modifier):
@@ -127,19 +268,22 @@ class option(modifier):
     """
     _token = b'?'
 
+    def apply(self, nfa, fragment):
+        return nfa.option(fragment)
+
 
 class matchrange(immutable, meta, defaults={'m': None}):
     __slots__ = 'matchable', 'n', 'm'
 
-    def mcompile(self):
-        m = self.m
-        return (
-            self.matchable.mcompile() +
-            b'{' +
-            bytes(str(self.n), 'utf-8') +
-            b',' + (b'' if m is None else (b', ' + bytes(str(m), 'utf-8'))) +
-            b'}'
-        )
+    def mcompile(self, nfa):
+        n = self.n
+        # ``matchable[n]`` matches exactly ``n`` times.
+        m = n if self.m is None else self.m
+        return nfa.repeat(self.matchable.mcompile, n, m)
+
+    def first_opcodes(self):
+        opcodes, nullable = self.matchable.first_opcodes()
+        return opcodes, nullable or not self.n
 
     def __repr__(self):
         return '{matchable}[{args}]'.format(
@@ -154,6 +298,9 @@ class matchany(meta):
     """
     _token = b'.'
 
+    def first_opcodes(self):
+        return ALL_OPCODES, False
+
     def __repr__(self):
         return '...'
 
@@ -177,10 +324,24 @@ class seq(immutable, matchable):
         return super().__new__(cls)
 
     def __init__(self, *matchables):
+        if len(matchables) == 1:
+            # ``__new__`` returned the matchable itself, if it is a ``seq``
+            # then it is already initialized.
+            return
         self.matchables = tuple(map(coerce_ellipsis, matchables))
 
-    def mcompile(self):
-        return b''.join(map(mcompile, self.matchables))
+    def mcompile(self, nfa):
+        return nfa.concat(m.mcompile(nfa) for m in self.matchables)
+
+    def first_opcodes(self):
+        opcodes = set()
+        for matchable in self.matchables:
+            first, nullable = matchable.first_opcodes()
+            opcodes.update(first)
+            if not nullable:
+                return frozenset(opcodes), False
+        # every element can match nothing
+        return frozenset(opcodes), True
 
     def __repr__(self):
         return '{cls}({args})'.format(
@@ -199,8 +360,12 @@ class or_(immutable, matchable):
     """
     __slots__ = '*matchables',
 
-    def mcompile(self):
-        return b'(' + b'|'.join(map(mcompile, self.matchables)) + b')'
+    def mcompile(self, nfa):
+        return nfa.union(m.mcompile(nfa) for m in self.matchables)
+
+    def first_opcodes(self):
+        firsts, nullables = zip(*map(first_opcodes, self.matchables))
+        return frozenset().union(*firsts), any(nullables)
 
     def __repr__(self):
         return ' | '.join(map(_prepr, self.matchables))
@@ -208,20 +373,238 @@ class or_(immutable, matchable):
 
 class not_(immutable, matchable):
     """Logical not of a matchable.
+
+    The not of a single instruction type matches any one other instruction.
+    The not of anything else matches any run of instructions that does not
+    contain a match of the matchable.
     """
     __slots__ = 'matchable',
 
-    def mcompile(self):
+    def mcompile(self, nfa):
         matchable = self.matchable
-        if isinstance(matchable, (seq, or_, not_)):
-            return b'((?!(' + matchable.mcompile() + b')).)*'
-
-        return b'[^' + matchable.mcompile() + b']'
+        if isinstance(matchable, type):
+            return nfa.symbol(ALL_OPCODES - matchable.first_opcodes()[0])
+        if isinstance(matchable, guarded):
+            # Any other opcode or the same opcodes failing the tests.
+            start, end = nfa.symbol(ALL_OPCODES - matchable.opcodes)
+            nfa.edge(start, matchable.opcodes, end, matchable._failed)
+            return start, end
+        if matchable is matchany:
+            # Every instruction is matched by ``...``.
+            return nfa.symbol(())
+
+        return nfa.complement(matchable.mcompile)
+
+    def first_opcodes(self):
+        matchable = self.matchable
+        if isinstance(matchable, type):
+            return ALL_OPCODES - matchable.first_opcodes()[0], False
+        if isinstance(matchable, guarded):
+            return ALL_OPCODES, False
+        if matchable is matchany:
+            return frozenset(), False
+        return ALL_OPCODES, True
 
     def __repr__(self):
         return '~' + _prepr(self.matchable)
 
 
+class guarded(immutable, matchable):
+    """A matchable for a single instruction that only matches when the
+    instruction passes some tests.
+
+    Parameters
+    ----------
+    matchable : matchable
+        The matchable to test the matches of. This must match exactly one
+        instruction.
+    predicates : tuple[callable[(CodeTransformer, Instruction) -> bool]]
+        Functions called with the transformer and the instruction.
+    lookups : tuple[(str, str, callable, any)]
+        The attribute name, operation name, operation, and value of each
+        attribute test.
+
+    See Also
+    --------
+    codetransformer.patterns.matchable.where
+    """
+    __slots__ = 'matchable', 'predicates', 'lookups', 'opcodes', '_failed'
+
+    def __init__(self, matchable, predicates, lookups):
+        self.matchable = matchable
+        self.predicates = predicates
+        self.lookups = lookups
+        self.opcodes = _single_opcodes(matchable)
+        self._failed = lambda transformer, instr: not self.test(
+            transformer,
+            instr,
+        )
+
+    def test(self, transformer, instr):
+        """Check if an instruction passes the tests.
+
+        Parameters
+        ----------
+        transformer : CodeTransformer
+            The transformer that is matching.
+        instr : Instruction
+            The instruction to test.
+
+        Returns
+        -------
+        passed : bool
+            Did the instruction pass all of the tests?
+        """
+        for attr, _, op, value in self.lookups:
+            if not op(getattr(instr, attr), value):
+                return False
+        for predicate in self.predicates:
+            if not predicate(transformer, instr):
+                return False
+        return True
+
+    def where(self, *predicates, **lookups):
+        new = self.matchable.where(*predicates, **lookups)
+        return type(self)(
+            self.matchable,
+            self.predicates + new.predicates,
+            self.lookups + new.lookups,
+        )
+
+    def mcompile(self, nfa):
+        return nfa.symbol(self.opcodes, self.test)
+
+    def first_opcodes(self):
+        return self.opcodes, False
+
+    def __repr__(self):
+        return '{matchable}.where({args})'.format(
+            matchable=_prepr(self.matchable),
+            args=', '.join(chain(
+                map(repr, self.predicates),
+                (
+                    '{}{}={!r}'.format(
+                        attr,
+                        '' if opname == 'eq' else '__' + opname,
+                        value,
+                    )
+                    for attr, opname, _, value in self.lookups
+                ),
+            )),
+        )
+
+
+class capture(immutable, matchable):
+    r"""Name the instructions matched by a sequence of matchables.
+
+    Parameters
+    ----------
+    name : str
+        The name of the keyword argument to pass the instructions as.
+    \*matchables : iterable of matchable
+        The matchables to match in order.
+
+    Notes
+    -----
+    Captures may only be passed directly to
+    :class:`~codetransformer.patterns.pattern`. The instructions that they
+    match are passed to the function as a
+    :class:`~codetransformer.patterns.matchview` instead of being passed
+    positionally.
+    """
+    __slots__ = 'name', 'matchable'
+
+    def __init__(self, name, *matchables):
+        self.name = name
+        self.matchable = seq(*matchables)
+
+    def mcompile(self, nfa):
+        raise TypeError(
+            'capture may only be used at the top level of a pattern',
+        )
+
+    def first_opcodes(self):
+        return self.matchable.first_opcodes()
+
+    def __repr__(self):
+        return '{cls}({name!r}, {matchable!r})'.format(
+            cls=type(self).__name__,
+            name=self.name,
+            matchable=self.matchable,
+        )
+
+
+class matchview(Sequence):
+    """A view of a range of instructions that were captured by a pattern.
+
+    Parameters
+    ----------
+    opcodes : bytes
+        The opcodes of all of the instructions.
+    instrs : sequence of Instruction
+        All of the instructions.
+    start, stop : int
+        The range of indices that were captured.
+
+    Attributes
+    ----------
+    opcodes : memoryview
+        The opcodes of the captured instructions.
+    start, stop : int
+        The range of indices that were captured.
+
+    Notes
+    -----
+    Neither the instructions nor their opcodes are copied. Views can be passed
+    back to a pattern dispatcher to match against the captured instructions.
+    """
+    __slots__ = '_instrs', 'opcodes', 'start', 'stop'
+
+    def __init__(self, opcodes, instrs, start, stop):
+        self._instrs = instrs
+        self.opcodes = memoryview(opcodes)[start:stop]
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return tuple(self)[key]
+            return self._instrs[self.start + start:self.start + stop]
+
+        key = index(key)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return self._instrs[self.start + key]
+
+    def __iter__(self):
+        return map(self._instrs.__getitem__, range(self.start, self.stop))
+
+    def __repr__(self):
+        return '<{cls}: {instrs!r}>'.format(
+            cls=type(self).__name__,
+            instrs=list(self),
+        )
+
+
+def _automaton(matchable, reverse=False):
+    """Build a DFA for a matchable.
+    """
+    nfa = NFA()
+    start, end = matchable.mcompile(nfa)
+    if reverse:
+        nfa, start = nfa.reverse(start, end)
+    else:
+        nfa.accepts[end] = 0
+    return DFA(nfa, start)
+
+
 class pattern(immutable):
     """
     A pattern of instructions that can be matched against.
@@ -255,18 +638,128 @@ class pattern(immutable):
     Match a single BINARY_ADD followed by any number of instructions::
 
         pattern(BINARY_ADD, matchany[var])
+
+    Pass the instructions between a BUILD_MAP and a MAP_ADD as ``body``::
+
+        pattern(BUILD_MAP, capture('body', matchany[var]), MAP_ADD)
+
+    Notes
+    -----
+    Patterns are matched with an automaton so matching takes time linear in
+    the number of instructions that are looked at. The number of states in
+    the automaton is stored as ``complexity``; a
+    :class:`~codetransformer.patterns.PatternComplexityWarning` is issued when
+    it is more than ``COMPLEXITY_THRESHOLD``.
     """
-    __slots__ = 'matchable', 'startcodes', '_compiled'
+    __slots__ = (
+        'matchable',
+        'startcodes',
+        'complexity',
+        '_segments',
+        '_splitters',
+        '_compiled',
+        '_first',
+    )
 
     def __init__(self, *matchables, startcodes=(DEFAULT_STARTCODE,)):
         if not matchables:
             raise TypeError('expected at least one matchable')
         self.matchable = matchable = seq(*matchables)
         self.startcodes = startcodes
-        self._compiled = re.compile(matchable.mcompile())
+
+        # Split the matchables into runs that are passed to the function
+        # together: captures are named and everything else is positional.
+        segments = []
+        uncaptured = []
+        for m in map(coerce_ellipsis, matchables):
+            if not isinstance(m, capture):
+                uncaptured.append(m)
+                continue
+            if uncaptured:
+                segments.append((None, seq(*uncaptured)))
+                uncaptured = []
+            if m.name in dict(segments):
+                raise TypeError('duplicate capture name: {!r}'.format(m.name))
+            segments.append((m.name, m.matchable))
+        if uncaptured:
+            segments.append((None, seq(*uncaptured)))
+        self._segments = segments = tuple(segments)
+
+        if len(segments) == 1 and segments[0][0] is None:
+            self._splitters = None
+        else:
+            # To find where each run ends we need an automaton for the run
+            # and one for the reverse of everything after it.
+            self._splitters = tuple(
+                (
+                    _automaton(m),
+                    _automaton(seq(*(m for _, m in segments[n + 1:])), True),
+                )
+                for n, (_, m) in enumerate(segments[:-1])
+            )
+
+        nfa = NFA()
+        start, end = self._mcompile(nfa)
+        nfa.accepts[end] = 0
+        self.complexity = complexity = len(nfa)
+        if complexity > COMPLEXITY_THRESHOLD:
+            warnings.warn(
+                'pattern {!r} has {} states'.format(matchable, complexity),
+                PatternComplexityWarning,
+                stacklevel=2,
+            )
+        self._compiled = DFA(nfa, start)
+        self._first = matchable.first_opcodes()[0]
 
     def __call__(self, f):
-        return boundpattern(self._compiled, self.startcodes, f)
+        return boundpattern(self, f)
+
+    def _mcompile(self, nfa):
+        return nfa.concat(m.mcompile(nfa) for _, m in self._segments)
+
+    def _split(self, opcodes, instrs, start, stop, context):
+        """Find the ranges of instructions matched by each run of
+        matchables.
+
+        Parameters
+        ----------
+        opcodes : bytes
+            The opcodes of all of the instructions.
+        instrs : sequence of Instruction
+            All of the instructions.
+        start, stop : int
+            The range of indices that the whole pattern matched.
+        context : any
+            The first argument passed to the guards.
+
+        Returns
+        -------
+        ranges : list[(int, int)]
+            The range of indices matched by each run. Each run takes as many
+            instructions as it can while leaving a match for the rest.
+        """
+        bounds = [start]
+        for forward, backward in self._splitters:
+            rest = {
+                stop - n for n in backward.accepting(
+                    opcodes,
+                    range(stop - 1, start - 1, -1),
+                    instrs,
+                    context,
+                )
+            }
+            start = max(
+                start + n for n in forward.accepting(
+                    opcodes,
+                    range(start, stop),
+                    instrs,
+                    context,
+                )
+                if start + n in rest
+            )
+            bounds.append(start)
+        bounds.append(stop)
+        return list(zip(bounds, bounds[1:]))
 
     def __repr__(self):
         return '{cls}(matchable={m!r}, startcodes={s})'.format(
@@ -279,28 +772,93 @@ class pattern(immutable):
 class boundpattern(immutable):
     """A pattern bound to a function.
     """
-    __slots__ = '_compiled', '_startcodes', '_f'
+    __slots__ = '_pattern', '_f'
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
 
-        return type(self)(
-            self._compiled,
-            self._startcodes,
-            MethodType(self._f, instance)
-        )
-
-    def __call__(self, compiled_instrs, instrs, startcode):
-        if startcode not in self._startcodes:
+        return type(self)(self._pattern, MethodType(self._f, instance))
+
+    def __call__(self, compiled_instrs, instrs, startcode, idx=0):
+        """Try to match this pattern at an index.
+
+        Parameters
+        ----------
+        compiled_instrs : bytes
+            The opcodes of all of the instructions.
+        instrs : sequence of Instruction
+            All of the instructions.
+        startcode : any
+            The current startcode.
+        idx : int, optional
+            The index to match at.
+
+        Returns
+        -------
+        processed : iterable of Instruction
+            The result of calling the function with the matched instructions.
+        nconsumed : int
+            The number of instructions that were matched.
+
+        Raises
+        ------
+        NoMatch
+            Raised when the pattern does not match a non-empty run of
+            instructions starting at ``idx``.
+        """
+        pattern = self._pattern
+        if startcode not in pattern.startcodes:
             raise NoMatch(compiled_instrs, startcode)
 
-        match = self._compiled.match(compiled_instrs)
-        if match is None or match.end is 0:
+        # Only non-empty matches are reported, the function is never called
+        # with no instructions.
+        context = getattr(self._f, '__self__', None)
+        ends = pattern._compiled.match(compiled_instrs, idx, instrs, context)
+        if not ends:
             raise NoMatch(compiled_instrs, startcode)
 
-        mend = match.end()
-        return self._f(*instrs[:mend]), mend
+        return self._apply(compiled_instrs, instrs, idx, ends[0][1], context)
+
+    def _apply(self, compiled_instrs, instrs, start, stop, context):
+        """Call the function on the matched instructions.
+
+        Parameters
+        ----------
+        compiled_instrs : bytes
+            The opcodes of all of the instructions.
+        instrs : sequence of Instruction
+            All of the instructions.
+        start, stop : int
+            The range of indices that were matched.
+        context : any
+            The first argument passed to the guards.
+
+        Returns
+        -------
+        processed : iterable of Instruction
+            The result of calling the function with the matched instructions.
+        nconsumed : int
+            The number of instructions that were matched.
+        """
+        pattern = self._pattern
+        if pattern._splitters is None:
+            return self._f(*instrs[start:stop]), stop - start
+
+        args = []
+        kwargs = {}
+        ranges = pattern._split(compiled_instrs, instrs, start, stop, context)
+        for (name, _), (run_start, run_stop) in zip(pattern._segments, ranges):
+            if name is None:
+                args.extend(instrs[run_start:run_stop])
+            else:
+                kwargs[name] = matchview(
+                    compiled_instrs,
+                    instrs,
+                    run_start,
+                    run_stop,
+                )
+        return self._f(*args, **kwargs), stop - start
 
 
 class NoMatch(Exception):
@@ -309,10 +867,79 @@ class NoMatch(Exception):
     pass
 
 
+class PatternComplexityWarning(UserWarning):
+    """Indicates that a pattern compiled to a very large automaton.
+    """
+    pass
+
+
 class patterndispatcher(immutable):
     """A set of patterns that can dispatch onto instrs.
     """
-    __slots__ = '*patterns',
+    __slots__ = 'patterns', '_matchers'
+
+    def __init__(self, *patterns):
+        self.patterns = patterns
+        self._matchers = {}
+
+    def matchers(self, startcode):
+        """The matchers used to dispatch the patterns that apply in a
+        startcode.
+
+        Parameters
+        ----------
+        startcode : any
+            The startcode to get the matchers for.
+
+        Returns
+        -------
+        combined : DFA
+            An automaton for all of the patterns at once. Each match is tagged
+            with the index of the pattern in ``self.patterns``.
+        candidates : compiled regex or None
+            A regex that matches one opcode that at least one of the patterns
+            can start with. Searching with this skips the positions where
+            nothing can match. This is None if any opcode could start a
+            match.
+        """
+        try:
+            return self._matchers[startcode]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable startcodes are not cached
+            return self._compile_matchers(startcode)
+
+        matchers = self._matchers[startcode] = self._compile_matchers(
+            startcode,
+        )
+        return matchers
+
+    def _compile_matchers(self, startcode):
+        patterns = [
+            (n, p._pattern) for n, p in enumerate(self.patterns)
+            if startcode in p._pattern.startcodes
+        ]
+
+        first = frozenset().union(*(p._first for _, p in patterns))
+        if first == ALL_OPCODES:
+            candidates = None
+        else:
+            # ``(?!)`` never matches, this is used when no patterns apply.
+            candidates = re.compile(
+                b'[' + b''.join(re.escape(bytes((c,))) for c in first) + b']'
+                if first else
+                b'(?!)',
+            )
+
+        nfa = NFA()
+        start = nfa.state()
+        for n, p in patterns:
+            pattern_start, pattern_end = p._mcompile(nfa)
+            nfa.epsilon(start, pattern_start)
+            nfa.accepts[pattern_end] = n
+
+        return DFA(nfa, start), candidates
 
     def __get__(self, instance, owner):
         if instance is None:
@@ -320,6 +947,7 @@ class patterndispatcher(immutable):
 
         return boundpatterndispatcher(
             instance,
+            self,
             *map(
                 methodcaller('__get__', instance, owner),
                 self.patterns,
@@ -330,35 +958,97 @@ class patterndispatcher(immutable):
 class boundpatterndispatcher(immutable):
     """A set of patterns bound to a transformer.
     """
-    __slots__ = 'transformer', '*patterns'
-
-    def _dispatch(self, compiled_instrs, instrs, startcode):
-        for p in self.patterns:
+    __slots__ = 'transformer', 'dispatcher', '*patterns'
+
+    def _dispatch(self, compiled_instrs, instrs, startcode, idx=0):
+        patterns = self.patterns
+        combined = self.dispatcher.matchers(startcode)[0]
+        # Scan this position once for all of the patterns. The matches come
+        # back in the order the patterns were defined.
+        ends = combined.match(compiled_instrs, idx, instrs, self.transformer)
+        for n, mend in ends:
             try:
-                return p(compiled_instrs, instrs, startcode)
+                return patterns[n]._apply(
+                    compiled_instrs,
+                    instrs,
+                    idx,
+                    mend,
+                    self.transformer,
+                )
             except NoMatch:
                 pass
 
         raise NoMatch(instrs, startcode)
 
     def __call__(self, instrs):
-        opcodes = bytes(map(attrgetter('opcode'), instrs))
+        post_transform = self.apply(instrs)
+        if post_transform is None:
+            return tuple(instrs)
+        return post_transform
+
+    def apply(self, instrs):
+        """Apply the patterns to a sequence of instructions.
+
+        Parameters
+        ----------
+        instrs : sequence[Instruction] or Code
+            The instructions to transform.
+
+        Returns
+        -------
+        post_transform : tuple[Instruction] or None
+            The transformed instructions, or None if no pattern matched.
+
+        Notes
+        -----
+        The instructions between matches are only read once a pattern has
+        matched, so a lazy code object that no pattern matches is scanned
+        without creating its instructions.
+        """
+        try:
+            # Code objects know their opcodes without touching the
+            # instructions, which lets lazy code objects stay lazy while we
+            # scan for matches.
+            opcodes = instrs.opcodes
+        except AttributeError:
+            opcodes = bytes(map(attrgetter('opcode'), instrs))
         idx = 0  # The current index into the pre-transformed instrs.
-        post_transform = []  # The instrs that have been transformed.
+        start = 0  # The first instr that has not been copied yet.
+        post_transform = None  # The instrs that have been transformed.
         transformer = self.transformer
-        while idx < len(instrs):
+        matchers = self.dispatcher.matchers
+        ninstrs = len(opcodes)
+        while idx < ninstrs:
+            # NOTE: the startcode may be changed by any of the patterns.
+            candidates = matchers(transformer.startcode)[1]
+            if candidates is not None:
+                # Skip straight to the next instruction that a pattern
+                # could start with.
+                match = candidates.search(opcodes, idx)
+                if match is None:
+                    break
+                idx = match.start()
+
             try:
                 processed, nconsumed = self._dispatch(
-                    opcodes[idx:],
-                    instrs[idx:],
+                    opcodes,
+                    instrs,
                     # NOTE: do not remove this attribute access
                     # self._dispatch can mutate the value of the startcode
                     transformer.startcode,
+                    idx,
                 )
             except NoMatch:
-                post_transform.append(instrs[idx])
                 idx += 1
             else:
+                if post_transform is None:
+                    post_transform = []
+                post_transform.extend(instrs[start:idx])
                 post_transform.extend(processed)
                 idx += nconsumed
+                start = idx
+
+        if post_transform is None:
+            return None
+        post_transform.extend(instrs[start:])
         return tuple(post_transform)
@@ -0,0 +1,228 @@
+import os
+from types import FunctionType
+
+import pytest
+
+from codetransformer import CodeTransformer, Code, pattern
+from codetransformer.cache import (
+    CacheInfo,
+    DiskCache,
+    TransformCache,
+    code_key,
+    freeze,
+)
+from codetransformer.instructions import LOAD_CONST, RETURN_VALUE
+from codetransformer.transformers import asconstants
+
+
+class add(CodeTransformer):
+    calls = 0
+
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+
+    @pattern(LOAD_CONST)
+    def _load_const(self, instr):
+        type(self).calls += 1
+        if isinstance(instr.arg, int):
+            yield LOAD_CONST(instr.arg + self.n).steal(instr)
+        else:
+            yield instr
+
+
+def f():  # pragma: no cover
+    return 1
+
+
+def test_lru():
+    cache = TransformCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.info() == CacheInfo(hits=3, misses=1, maxsize=2, currsize=2)
+
+    cache.clear()
+    assert cache.info() == CacheInfo(hits=0, misses=0, maxsize=2, currsize=0)
+
+    with pytest.raises(ValueError):
+        TransformCache(maxsize=0)
+
+
+def test_transform_cache():
+    cache = TransformCache()
+    add.calls = 0
+
+    first = add(1)
+    first.cache = cache
+    g = first(f)
+    assert g() == 2
+    assert add.calls == 1
+
+    # a different instance with the same configuration shares the results
+    second = add(1)
+    second.cache = cache
+    assert second(f).__code__ is g.__code__
+    assert add.calls == 1
+
+    third = add(2)
+    third.cache = cache
+    assert third(f)() == 3
+    assert add.calls == 2
+    assert cache.info() == CacheInfo(hits=1, misses=2, maxsize=128, currsize=2)
+
+    # the name is part of the key
+    code = Code.from_pyfunc(f)
+    assert first.transform(code, name='g').name == 'g'
+    assert add.calls == 3
+
+
+def test_unchanged_is_cached():
+    cache = TransformCache()
+    t = asconstants('len')
+    t.cache = cache
+    assert t(f) is f
+    assert t(f) is f
+
+    code = Code.from_pyfunc(f)
+    assert t.transform(code) is code
+    assert cache.info().hits == 2
+
+
+def test_uncacheable():
+    cache = TransformCache()
+
+    t = asconstants(a=bytearray())
+    assert t.cache_key() is None
+    t.cache = cache
+    t(f)
+    assert cache.info() == CacheInfo(hits=0, misses=0, maxsize=128, currsize=0)
+
+    code = Code.from_pyfunc(f)
+    code[0].arg = object()
+    assert code_key(code) is None
+    assert code_key(Code.from_pyfunc(f)) is not None
+
+
+def test_code_key(tmpdir):
+    code = Code.from_pyfunc(f, lazy=True)
+    key = code_key(code)
+    assert not hasattr(code, '_instrs')
+    assert key == code_key(Code.from_pyfunc(f))
+
+    # equal constants of different types are kept apart
+    assert (
+        code_key(Code((LOAD_CONST(1), RETURN_VALUE()))) !=
+        code_key(Code((LOAD_CONST(True), RETURN_VALUE())))
+    )
+
+    # a cache hit does not decode the code object
+    t = add(1)
+    t.cache = DiskCache(str(tmpdir))
+    t.transform(Code.from_pyfunc(f))
+    code = Code.from_pyfunc(f, lazy=True)
+    assert FunctionType(t.transform(code).to_pycode(), {})() == 2
+    assert t.cache.info().hits == 1
+    assert not hasattr(code, '_instrs')
+
+
+def test_cache_key():
+    assert add(1).cache_key() == add(1).cache_key()
+    assert add(1).cache_key() != add(2).cache_key()
+    assert add(1).cache_key() != add(1.0).cache_key()
+    assert (
+        asconstants('len').cache_key() != asconstants('print').cache_key()
+    )
+    assert (add(1) | add(2)).cache_key() == (add(1) | add(2)).cache_key()
+    assert (add(1) | add(2)).cache_key() != (add(2) | add(1)).cache_key()
+    assert (add(1) | add(bytearray())).cache_key() is None
+
+    assert freeze({'a': [1, {2}]}) == freeze({'a': [1, {2}]})
+    assert freeze([1]) != freeze((1,))
+    assert freeze({1}) != freeze({1.0})
+    with pytest.raises(TypeError):
+        freeze([[], {}, bytearray()])
+
+
+def test_disk_cache(tmpdir):
+    path = str(tmpdir)
+    add.calls = 0
+
+    t = add(1)
+    t.cache = DiskCache(path)
+    assert t(f)() == 2
+    assert add.calls == 1
+    assert t.cache.info() == CacheInfo(
+        hits=0,
+        misses=1,
+        maxsize=64 * 1024 * 1024,
+        currsize=t.cache.info().currsize,
+    )
+    assert len(t.cache) == 1
+
+    # a new cache on the same directory, as in a new process
+    t = add(1)
+    t.cache = DiskCache(path)
+    assert t(f)() == 2
+    assert add.calls == 1
+    assert t.cache.info().hits == 1
+
+    # only finished results are left in the directory
+    assert all(name.endswith('.ctc') for name in os.listdir(path))
+
+    t.cache.clear()
+    assert len(t.cache) == 0
+    assert t(f)() == 2
+    assert add.calls == 2
+
+
+def test_disk_cache_corrupt(tmpdir):
+    path = str(tmpdir)
+    t = add(1)
+    t.cache = DiskCache(path)
+    t(f)
+
+    name, = os.listdir(path)
+    with open(os.path.join(path, name), 'wb') as file:
+        file.write(b'garbage')
+
+    assert t(f)() == 2
+    assert t.cache.info().misses == 2
+
+
+def test_disk_cache_bounded(tmpdir):
+    path = str(tmpdir)
+    cache = DiskCache(path, max_bytes=1024)
+    for n in range(100):
+        cache.set(n, b'x' * 100)
+    assert cache.info().currsize <= 1024
+    # the most recent result is kept
+    assert cache.get(99) == b'x' * 100
+
+    with pytest.raises(ValueError):
+        DiskCache(path, max_bytes=0)
+
+
+def test_disk_cache_unstorable(tmpdir):
+    path = str(tmpdir)
+    cache = DiskCache(path)
+
+    class local:
+        pass
+
+    # keys that are not the same in every process
+    cache.set(local, 1)
+    cache.set((f,), 1)
+    assert cache.get(local) is None
+    assert cache.get((f,)) is None
+
+    # values that cannot be marshalled
+    cache.set('a', object())
+    assert cache.get('a') is None
+
+    assert len(cache) == 0
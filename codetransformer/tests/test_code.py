@@ -1,13 +1,29 @@
-from dis import dis
+from array import array
+from dis import dis, findlinestarts, get_instructions, hasjabs, hasjrel
 from io import StringIO
 from itertools import product, chain
+import operator as op
+import pickle
 import random
 import sys
+from struct import pack, unpack_from
+from types import CodeType, FunctionType
 
 import pytest
 
-from codetransformer.code import Code, Flag, pycode
-from codetransformer.instructions import LOAD_CONST, LOAD_FAST, uses_free
+from codetransformer.code import CompactInstrs, Code, Flag, pycode
+from codetransformer.instructions import (
+    BUILD_LIST,
+    BUILD_TUPLE,
+    Instruction,
+    EXTENDED_ARG,
+    JUMP_ABSOLUTE,
+    LOAD_CLOSURE,
+    LOAD_CONST,
+    LOAD_FAST,
+    RETURN_VALUE,
+    uses_free,
+)
 
 
 @pytest.fixture(scope='module')
@@ -65,6 +81,22 @@ def test_lnotab_really_dumb_whitespace():
     assert f.__code__.co_lnotab == code.py_lnotab == code.to_pycode().co_lnotab
 
 
+def test_lnotab_read_only():
+    lnotab = {}
+    code = Code((LOAD_CONST(None), RETURN_VALUE()), lnotab=lnotab)
+    lnotab[2] = code[0]
+    assert not code.lnotab
+
+    for code in (
+        Code.from_pyfunc(test_lnotab_read_only),
+        Code.from_pyfunc(test_lnotab_read_only, compact=True),
+    ):
+        with pytest.raises(TypeError):
+            code.lnotab[1] = code[0]
+        with pytest.raises(TypeError):
+            del code.lnotab[min(code.lnotab)]
+
+
 def test_flag_packing(sample_flags):
     for flags in sample_flags:
         assert Flag.unpack(Flag.pack(**flags)) == flags
@@ -102,6 +134,20 @@ def test_flag_max_immutable():
         Flag.CO_OPTIMIZED.max = None
 
 
+def test_code_flags_mask():
+    instrs = LOAD_CONST(None), RETURN_VALUE()
+    mask = Flag.CO_NEWLOCALS | Flag.CO_GENERATOR
+    assert Code(instrs, flags=mask).py_flags == mask
+
+    code = Code(instrs, flags={'CO_NESTED': True, 'CO_NOFREE': False})
+    assert code.py_flags == (
+        Flag.CO_OPTIMIZED | Flag.CO_NEWLOCALS | Flag.CO_NESTED
+    )
+
+    with pytest.raises(TypeError):
+        Code(instrs, flags={'CO_NOT_A_FLAG': True})
+
+
 def test_code_multiple_varargs():
     with pytest.raises(ValueError) as e:
         Code(
@@ -220,3 +266,518 @@ def test_code_dis(capsys):
     buf = StringIO()
     code.dis(file=buf)
     assert buf.getvalue() == expected
+
+
+def test_bytecode_offset(abc_code):
+    (a, b, c), code = abc_code
+
+    sparse_instrs = code.sparse_instrs
+    for instr in code:
+        assert sparse_instrs[code.bytecode_offset(instr)] is instr
+
+    with pytest.raises(ValueError):
+        code.bytecode_offset(c)
+
+
+def test_many_jumps_roundtrip():
+    ns = {}
+    exec(
+        'def f(x):\n' +
+        ''.join('    if x == %d:\n        return %d\n' % (n, n)
+                for n in range(20)) +
+        '    return -1\n',
+        ns,
+    )
+    f = ns['f']
+    code = Code.from_pyfunc(f)
+    g = FunctionType(code.to_pycode(), ns)
+    assert g.__code__ is not f.__code__
+    for n in range(20):
+        assert g(n) == n
+    assert g(20) == -1
+
+
+def test_unhashable_consts():
+    a = [1]
+    b = [1]
+    code = Code(
+        (
+            LOAD_CONST(a),
+            LOAD_CONST('c'),
+            LOAD_CONST(b),
+            LOAD_CONST((a,)),
+            BUILD_TUPLE(4),
+            RETURN_VALUE(),
+        ),
+    )
+    assert code.consts == ([1], 'c', ([1],))
+    assert code.consts[0] is a
+
+    result = FunctionType(code.to_pycode(), {})()
+    assert result == ([1], 'c', [1], ([1],))
+    assert result[0] is result[2] is a
+
+
+def test_derived_properties_cached():
+    a = LOAD_CONST('a')
+    b = LOAD_FAST('b')
+    code = Code((a, b, BUILD_TUPLE(2), RETURN_VALUE()), argnames=('b',))
+
+    consts = code.consts
+    varnames = code.varnames
+    assert consts == ('a',)
+    assert code.consts is consts
+    assert code.varnames is varnames
+
+    # mutating an instruction invalidates the cached values
+    a.arg = 'c'
+    assert code.consts == ('c',)
+    assert code.varnames is not varnames
+    assert code.varnames == varnames
+
+
+def test_decode_extended_arg():
+    ns = {}
+    exec(
+        'def f():\n    return [%s]' % ', '.join(map(repr, range(300))),
+        ns,
+    )
+    f = ns['f']
+    code = Code.from_pyfunc(f)
+    assert not any(isinstance(instr, EXTENDED_ARG) for instr in code)
+    assert code[-2].equiv(BUILD_LIST(300))
+    assert [instr.arg for instr in code[:-2]] == list(range(300))
+
+    # the assembler writes the prefixes back out
+    co = Code(code.instrs).to_pycode()
+    assert EXTENDED_ARG.opcode in co.co_code
+    assert FunctionType(co, ns)() == list(range(300))
+
+
+def test_extended_arg_jumps():
+    ns = {}
+    exec(
+        'def f(x):\n' +
+        ''.join('    if x == %d:\n        return %d\n' % (n, -n)
+                for n in range(300)) +
+        '    return None\n',
+        ns,
+    )
+    f = ns['f']
+    decoded = Code.from_pyfunc(f)
+    code = Code(
+        decoded.instrs,
+        decoded.argnames,
+        firstlineno=decoded.firstlineno,
+        lnotab=decoded.lnotab,
+    )
+    co = code.to_pycode()
+    assert EXTENDED_ARG.opcode in co.co_code
+    assert [lno for _, lno in findlinestarts(co)] == [
+        lno for _, lno in findlinestarts(f.__code__)
+    ]
+
+    g = FunctionType(co, ns)
+    for n in range(300):
+        assert g(n) == -n
+    assert g(300) is None
+
+    # the jump offsets account for the prefixes
+    sparse_instrs = code.sparse_instrs
+    for instr in code:
+        assert sparse_instrs[code.bytecode_offset(instr)] is instr
+
+    jumps = [instr for instr in code if instr.is_jmp]
+    assembled_jumps = [
+        instr for instr in get_instructions(co)
+        if instr.opcode in hasjabs or instr.opcode in hasjrel
+    ]
+    assert len(jumps) == len(assembled_jumps)
+    for instr, assembled in zip(jumps, assembled_jumps):
+        assert assembled.argval == code.bytecode_offset(instr.arg)
+
+
+def test_decode_cell_and_free_vars():
+    def outer():  # pragma: no cover
+        x = 1
+
+        def middle():
+            y = 2
+
+            def inner():
+                return x + y
+
+            return inner
+
+        return middle
+
+    middle = outer()
+    code = Code.from_pyfunc(middle)
+    assert code.cellvars == ('y',)
+    assert code.freevars == ('x',)
+
+    closures = [instr for instr in code if isinstance(instr, LOAD_CLOSURE)]
+    assert {instr.arg: instr.vartype for instr in closures} == {
+        'x': 'free',
+        'y': 'cell',
+    }
+
+    new_middle = FunctionType(
+        code.to_pycode(),
+        middle.__globals__,
+        closure=middle.__closure__,
+    )
+    assert new_middle()() == 3
+
+
+def test_lazy_code():
+    def f(a, *b, c, **d):  # pragma: no cover
+        return a + 1
+
+    co = f.__code__
+    code = Code.from_pycode(co, lazy=True)
+    eager = Code.from_pycode(co)
+
+    # metadata is available without decoding the instructions
+    assert code.argnames == eager.argnames == ('a', 'c', 'b', 'd')
+    assert code.argcount == 1
+    assert code.kwonlyargcount == 1
+    assert code.py_flags == co.co_flags
+    assert code.opcodes == bytes(instr.opcode for instr in eager)
+    assert len(code) == len(eager)
+    assert not hasattr(code, '_instrs')
+
+    # assembling reads the bytecode without creating the instructions
+    new_co = code.to_pycode()
+    assert not hasattr(code, '_instrs')
+    assert new_co is not co
+    assert new_co.co_code == eager.to_pycode().co_code
+    assert new_co.co_lnotab == eager.py_lnotab
+    assert FunctionType(new_co, {})(1, c=2) == 2
+
+    # accessing the instructions materializes them
+    assert all(map(Instruction.equiv, code, eager))
+    assert code.lnotab.keys() == eager.lnotab.keys()
+    assert code.to_pycode().co_code == new_co.co_code
+
+    # nothing changed so the original can be reused
+    assert code.to_pycode(reuse=True) is co
+
+
+def test_compact_code():
+    def f(a, b):  # pragma: no cover
+        c = a
+
+        def g():
+            return c
+
+        if a:
+            return g()
+        return b
+
+    co = f.__code__
+    eager = Code.from_pycode(co)
+    code = Code.from_pycode(co, compact=True)
+
+    assert isinstance(code.instrs, CompactInstrs)
+    assert code.opcodes == eager.opcodes
+    assert code.consts == eager.consts
+    assert code.names == eager.names
+    assert code.varnames == eager.varnames
+    assert code.stacksize == eager.stacksize
+    assert code.py_lnotab == eager.py_lnotab
+
+    assert code.to_pycode() is not co
+    assert code.to_pycode().co_code == eager.to_pycode().co_code
+
+    # reading an instruction always gives back the same object
+    assert code[0] is code[0]
+    for a, b in zip(code, eager):
+        assert type(a) is type(b)
+        if not a.is_jmp:
+            assert a.arg == b.arg
+    assert code.index(code[3]) == 3
+    assert code[3] in code
+    assert code[-1] is code[len(code) - 1]
+
+    # jumps are wired up to the instruction objects
+    jmp = next(instr for instr in code if instr.is_jmp)
+    assert jmp.arg in code
+    assert jmp in jmp.arg._target_of
+
+    for instr in code:
+        if instr.uses_free:
+            assert instr.vartype == 'cell'
+
+    # mutations through the instructions are seen by the code object
+    load_b = next(
+        instr for instr in code
+        if isinstance(instr, LOAD_FAST) and instr.arg == 'b'
+    )
+    load_b.arg = 'a'
+    assert FunctionType(code.to_pycode(), {})(0, 1) == 0
+
+
+def test_compact_long_jump_chain():
+    # every jump targets the next one
+    ret = [LOAD_CONST(None), RETURN_VALUE()]
+    jumps = [JUMP_ABSOLUTE(ret[0])]
+    for _ in range(sys.getrecursionlimit() * 2):
+        jumps.append(JUMP_ABSOLUTE(jumps[-1]))
+    jumps.reverse()
+    co = Code(jumps + ret).to_pycode()
+
+    code = Code.from_pycode(co, compact=True)
+    # nothing is created until it is read, even to assemble
+    assert code.py_lnotab == Code.from_pycode(co).py_lnotab
+    assert not code.instrs._instrs
+
+    # reading one instruction creates everything connected to it by jumps,
+    # which is everything but the RETURN_VALUE
+    instr = code[0]
+    assert len(code.instrs._instrs) == len(code) - 1
+    for _ in jumps:
+        assert instr in instr.arg._target_of
+        instr = instr.arg
+    assert instr is code[-2]
+
+
+def test_fingerprint():
+    def make(n):
+        def f(a, *, b):  # pragma: no cover
+            c = (a, 'c', 1.5)
+
+            def g():
+                return c
+
+            if a:
+                return g
+            return n + b
+
+        return f
+
+    code = Code.from_pyfunc(make(1))
+    assert code.fingerprint == Code.from_pyfunc(make(2)).fingerprint
+    assert code.fingerprint == Code.from_pyfunc(
+        make(1),
+        compact=True,
+    ).fingerprint
+    for recursive in (False, True):
+        lazy = Code.from_pyfunc(make(1), lazy=True, recursive=recursive)
+        assert code.fingerprint == lazy.fingerprint
+        # the instructions were not decoded
+        assert not hasattr(lazy, '_instrs')
+        assert code.fingerprint == lazy.fingerprint
+    assert code.equiv(Code.from_pycode(code.to_pycode()))
+
+    def f(a, *, b):  # pragma: no cover
+        c = (a, 'd', 1.5)
+
+        def g():
+            return c
+
+        if a:
+            return g
+        return b
+
+    # a different nested constant
+    assert not code.equiv(Code.from_pyfunc(f))
+
+    # mutating an instruction changes the fingerprint
+    other = Code.from_pyfunc(make(1))
+    assert code.equiv(other)
+    next(instr for instr in other if isinstance(instr, LOAD_FAST)).arg = 'c'
+    assert not code.equiv(other)
+
+    # constants are compared by type and value
+    assert not Code((LOAD_CONST(1), RETURN_VALUE())).equiv(
+        Code((LOAD_CONST(1.0), RETURN_VALUE())),
+    )
+    assert Code((LOAD_CONST(frozenset('ab')), RETURN_VALUE())).equiv(
+        Code((LOAD_CONST(frozenset('ba')), RETURN_VALUE())),
+    )
+
+
+def test_recursive_code():
+    def f(a):  # pragma: no cover
+        def g(b):
+            def h():
+                return b + 1
+
+            return h
+
+        def i():
+            return a
+
+        return g(a)(), i()
+
+    co = f.__code__
+    for compact in (False, True):
+        code = Code.from_pycode(co, recursive=True, compact=compact)
+        g, i = (const for const in code.consts if isinstance(const, Code))
+        assert g.name == 'g'
+        assert i.name == 'i'
+
+        # the nested code objects are decoded lazily
+        assert not hasattr(g, '_instrs')
+        h, = (const for const in g.consts if isinstance(const, Code))
+        assert h.name == 'h'
+        assert not hasattr(h, '_instrs')
+
+        # the outer code object is assembled again but the unchanged nested
+        # code objects are reused
+        new_co = code.to_pycode()
+        assert new_co is not co
+        new_consts = [
+            const for const in new_co.co_consts if isinstance(const, CodeType)
+        ]
+        old_consts = [
+            const for const in co.co_consts if isinstance(const, CodeType)
+        ]
+        assert all(map(op.is_, new_consts, old_consts))
+        assert FunctionType(new_co, {})(1) == (2, 1)
+
+        # changing a nested code object reassembles the code objects that
+        # contain it
+        one, = (instr for instr in h if isinstance(instr, LOAD_CONST))
+        one.arg = 2
+        new_g = g.to_pycode()
+        assert new_g is not old_consts[0]
+        assert new_g.co_consts[1] is not old_consts[0].co_consts[1]
+        new_consts = [
+            const
+            for const in code.to_pycode().co_consts
+            if isinstance(const, CodeType)
+        ]
+        assert new_consts[0] is not old_consts[0]
+        assert new_consts[1] is old_consts[1]
+        assert FunctionType(code.to_pycode(), {})(1) == (3, 1)
+
+
+def test_dumps_loads():
+    def f(a, *b, c=1, **d):
+        x = [i + 0.0 for i in b]
+
+        def g():
+            return x, c
+
+        while a:
+            a -= 1
+        return g(), slice(1), 0, False
+
+    co = f.__code__
+    for compact, recursive in product((False, True), repeat=2):
+        code = Code.from_pycode(co, compact=compact, recursive=recursive)
+        loaded = Code.loads(code.dumps())
+        assert isinstance(loaded.instrs, CompactInstrs)
+
+        # the loaded code runs the same program and has the same line
+        # numbers
+        assert loaded.fingerprint == code.fingerprint
+        assert loaded.name == code.name
+        assert loaded.filename == code.filename
+        assert loaded.firstlineno == code.firstlineno
+        assert {lno: loaded.index(instr)
+                for lno, instr in loaded.lnotab.items()} == \
+            {lno: code.index(instr) for lno, instr in code.lnotab.items()}
+        assert loaded.py_lnotab == code.py_lnotab
+
+        # equal constants of different types are kept apart
+        consts = [
+            const for const in loaded.consts
+            if not isinstance(const, (Code, CodeType))
+        ]
+        assert [type(const) for const in consts if const == 0] == [int, bool]
+
+        nested = [const for const in loaded.consts if isinstance(const, Code)]
+        assert len(nested) == (2 if recursive else 0)
+
+        new = FunctionType(loaded.to_pycode(), globals(), 'f', (), None)
+        assert new(2, 3, c=4) == (([3.0], 4), slice(1), 0, False)
+        assert type(new(0, c=0)[-1]) is bool
+
+    # pickle uses the same format
+    code = Code.from_pycode(co, recursive=True)
+    loaded = pickle.loads(pickle.dumps(code))
+    assert loaded.fingerprint == code.fingerprint
+
+    # the instructions are read directly from the buffer
+    data = bytearray(code.dumps())
+    loaded = Code.loads(memoryview(data))
+    assert loaded.fingerprint == code.fingerprint
+
+    with pytest.raises(ValueError):
+        Code.loads(b'not a code object')
+    with pytest.raises(ValueError):
+        Code.loads(b'')
+
+
+def test_loads_arg_size():
+    def f(a):
+        while a:
+            a -= 1
+        return a
+
+    code = Code.from_pyfunc(f)
+    data = code.dumps()
+    # the header is the magic, version, byte order, argument size, a pad
+    # byte, and the number of instructions
+    magic, version, little, itemsize, count = unpack_from('<4sBBBxI', data)
+    assert itemsize == array('I').itemsize
+    args = array('I', data[12:12 + itemsize * count])
+    rest = data[12 + itemsize * count:]
+
+    # data written with other argument sizes and byte orders can be read
+    for typecode, swap in product('HQ', (False, True)):
+        new_args = array(typecode, args)
+        if swap:
+            new_args.byteswap()
+        loaded = Code.loads(
+            pack(
+                '<4sBBBxI',
+                magic,
+                version,
+                little != swap,
+                new_args.itemsize,
+                count,
+            ) +
+            new_args.tobytes() +
+            rest,
+        )
+        assert loaded.fingerprint == code.fingerprint
+
+    with pytest.raises(ValueError):
+        Code.loads(
+            pack('<4sBBBxI', magic, version, little, 3, count) +
+            bytes(3 * count) +
+            rest,
+        )
+
+
+def test_dumps_unmarshallable_consts():
+    ob = object()
+    code = Code(
+        (LOAD_CONST(slice(1, 2)), LOAD_CONST(ob), BUILD_TUPLE(2),
+         RETURN_VALUE()),
+    )
+    loaded = Code.loads(code.dumps())
+    assert loaded.consts[0] == slice(1, 2)
+    # objects that cannot be marshalled are pickled
+    assert type(loaded.consts[1]) is object
+
+
+def test_pickle_instructions():
+    def f(a):
+        while a:
+            a -= 1
+        return a
+
+    code = Code.from_pycode(f.__code__)
+    instrs = pickle.loads(pickle.dumps(code.instrs))
+    assert list(map(type, instrs)) == list(map(type, code.instrs))
+    for instr, new in zip(code.instrs, instrs):
+        if instr.is_jmp:
+            assert instrs.index(new.arg) == code.index(instr.arg)
+            assert new in new.arg._target_of
+        else:
+            assert new.arg == instr.arg
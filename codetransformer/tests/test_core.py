@@ -1,10 +1,18 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import FunctionType
+
 import pytest
 import toolz.curried.operator as op
 
 from codetransformer import CodeTransformer, Code, pattern
-from codetransformer.core import Context, NoContext
-from codetransformer.instructions import Instruction
-from codetransformer.patterns import DEFAULT_STARTCODE
+from codetransformer.core import Context, NoContext, TransformResult
+from codetransformer.instructions import (
+    BINARY_ADD,
+    Instruction,
+    LOAD_CONST,
+    NOP,
+)
+from codetransformer.patterns import DEFAULT_STARTCODE, NoMatch, plus, var
 from codetransformer.utils.instance import instance
 
 
@@ -128,3 +136,453 @@ def test_no_context():
         c.context
 
     assert str(e.value) == 'no active transformation context'
+
+
+def test_transform_recursive_code():
+    class add_one(CodeTransformer):
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            if isinstance(instr.arg, int):
+                instr.arg += 1
+            yield instr
+
+    def f():  # pragma: no cover
+        def g():
+            return 1
+
+        return g() + 1
+
+    code = Code.from_pyfunc(f, recursive=True)
+    g, = (const for const in code.consts if isinstance(const, Code))
+
+    new = add_one().transform(code)
+    new_g, = (const for const in new.consts if isinstance(const, Code))
+    assert new_g is not g
+    assert FunctionType(new.to_pycode(), {})() == 4
+
+
+def test_pattern_matches_at_every_index():
+    @instance
+    class c(CodeTransformer):
+        matches = []
+
+        @pattern(LOAD_CONST, LOAD_CONST)
+        def _(self, *instrs):
+            self.matches.append(tuple(instr.arg for instr in instrs))
+            yield from instrs
+
+        @pattern(NOP[var])
+        def _empty(self, *instrs):
+            # this only matches an empty run of instructions so it must not
+            # be called
+            raise AssertionError('called on an empty match')
+
+    def f():  # pragma: no cover
+        a = 1
+        return a, 2, 3, 4
+
+    c.transform(Code.from_pyfunc(f))
+    assert c.matches == [(2, 3)]
+
+
+def test_pattern_priority():
+    @instance
+    class c(CodeTransformer):
+        matches = []
+
+        @pattern(LOAD_CONST, LOAD_CONST)
+        def _pair(self, *instrs):
+            self.matches.append(('pair',) + tuple(i.arg for i in instrs))
+            yield from instrs
+
+        @pattern(LOAD_CONST)
+        def _single(self, instr):
+            if instr.arg == 4:
+                # fall through to the next pattern that matches
+                raise NoMatch()
+            self.matches.append(('single', instr.arg))
+            return instr,
+
+        @pattern(LOAD_CONST[plus])
+        def _run(self, *instrs):
+            self.matches.append(('run',) + tuple(i.arg for i in instrs))
+            yield from instrs
+
+        @pattern(LOAD_CONST, startcodes=('other',))
+        def _other(self, instr):  # pragma: no cover
+            raise AssertionError('wrong startcode')
+
+    def f():  # pragma: no cover
+        a = 1
+        return a, 2, 3, a, 4
+
+    c.transform(Code.from_pyfunc(f))
+    assert c.matches == [('single', 1), ('pair', 2, 3), ('run', 4)]
+
+
+def test_unchanged_transform():
+    class passthrough(CodeTransformer):
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            yield instr
+
+    class mutate(CodeTransformer):
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            instr.arg = 2
+            yield instr
+
+    class replace(CodeTransformer):
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            yield LOAD_CONST(instr.arg).steal(instr)
+
+    class transform_consts(CodeTransformer):
+        def transform_consts(self, consts):
+            return tuple(2 if c == 1 else c for c in consts)
+
+    def f():  # pragma: no cover
+        return 1
+
+    code = Code.from_pyfunc(f)
+    assert passthrough().transform(code) is code
+    assert passthrough()(f) is f
+
+    copied = passthrough()(f, copy=True)
+    assert copied is not f
+    assert copied.__code__ is f.__code__
+    assert passthrough()(f, name='g').__name__ == 'g'
+
+    for transformer in mutate, replace, transform_consts:
+        new = transformer()(f)
+        assert new is not f
+        assert new.__code__ is not f.__code__
+
+    assert passthrough().transform(Code.from_pyfunc(f), name='g') is not code
+
+
+def test_unmatched_transform_stays_lazy():
+    class add(CodeTransformer):
+        @pattern(BINARY_ADD)
+        def _(self, instr):  # pragma: no cover
+            raise AssertionError('nothing to add')
+
+    class transform_consts(CodeTransformer):
+        def transform_consts(self, consts):
+            return tuple(2 if c == 1 else c for c in consts)
+
+    def f(a):  # pragma: no cover
+        def g():
+            return a
+
+        return g, 1
+
+    for compact in (False, True):
+        code = Code.from_pyfunc(f, lazy=True, compact=compact, recursive=True)
+        assert add().transform(code) is code
+        assert not hasattr(code, '_instrs')
+        g, = (const for const in code.consts if isinstance(const, Code))
+        assert not hasattr(g, '_instrs')
+
+        # changing an argument materializes the code object
+        new = transform_consts().transform(code)
+        assert new is not code
+        assert hasattr(code, '_instrs')
+        assert not hasattr(g, '_instrs')
+        assert FunctionType(new.to_pycode(), {})(0)[1] == 2
+
+
+def test_transform_preserves_signature():
+    class replace(CodeTransformer):
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            yield LOAD_CONST(instr.arg).steal(instr)
+
+    def f(a, *args, b, **kwargs):
+        return 1, a, args, b, kwargs
+
+    def g(a, *, b):
+        return 1, a, b
+
+    new_f = replace()(f)
+    assert new_f.__code__ is not f.__code__
+    assert new_f(1, 2, b=3, c=4) == (1, 1, (2,), 3, {'c': 4})
+    assert new_f.__code__.co_varnames == f.__code__.co_varnames
+    assert new_f.__code__.co_argcount == 1
+    assert new_f.__code__.co_kwonlyargcount == 1
+
+    new_g = replace()(g)
+    assert new_g(1, b=2) == (1, 1, 2)
+    assert new_g.__code__.co_varnames == g.__code__.co_varnames
+    assert new_g.__code__.co_flags == g.__code__.co_flags
+    with pytest.raises(TypeError):
+        new_g(1, 2)
+
+
+def test_pipeline():
+    class add_one(CodeTransformer):
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            if isinstance(instr.arg, int):
+                instr.arg += 1
+            yield instr
+
+    class double(CodeTransformer):
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            if isinstance(instr.arg, int):
+                yield LOAD_CONST(instr.arg * 2).steal(instr)
+            else:
+                yield instr
+
+    class startcodes(CodeTransformer):
+        # each transformer in a pipeline has its own startcode
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            assert self.startcode == DEFAULT_STARTCODE
+            self.begin('seen')
+            yield instr
+
+    def f():  # pragma: no cover
+        def g():
+            return 1
+
+        return g() + 2
+
+    p = add_one() | startcodes() | double()
+    assert isinstance(p, CodeTransformer)
+    assert len(p.transformers) == 3
+    assert p(f)() == 4 + 6
+    assert (double() | add_one())(f)() == 3 + 5
+
+    composed = CodeTransformer.compose(add_one(), p)
+    assert [type(t) for t in composed.transformers] == [
+        add_one,
+        add_one,
+        startcodes,
+        double,
+    ]
+    assert composed(f)() == 6 + 8
+
+    class passthrough(CodeTransformer):
+        pass
+
+    code = Code.from_pyfunc(f)
+    assert (passthrough() | passthrough()).transform(code) is code
+    assert (passthrough() | passthrough())(f) is f
+
+    with pytest.raises(TypeError):
+        CodeTransformer.compose()
+
+
+class increment_ints(CodeTransformer):
+    @pattern(LOAD_CONST)
+    def _(self, instr):
+        if isinstance(instr.arg, int):
+            yield LOAD_CONST(instr.arg + 1).steal(instr)
+        else:
+            yield instr
+
+
+class double_adds(CodeTransformer):
+    @pattern(BINARY_ADD)
+    def _(self, instr):
+        yield instr
+        yield LOAD_CONST(2)
+        yield BINARY_ADD()
+
+
+def test_transform_consts_executor():
+    def f():  # pragma: no cover
+        def g():
+            def h():
+                return 1 + 1
+            return h() + 1
+
+        class C:
+            a = 1
+
+        return g(), C.a
+
+    serial = increment_ints() | double_adds()
+    expected = serial(f)()
+    # 1 + 1 is folded by the compiler
+    assert expected == ((2 + 1) + 2 + 2, 2)
+
+    with ProcessPoolExecutor(1) as executor:
+        # an executor on a stage
+        t = increment_ints()
+        t.executor = executor
+        assert t(f)() == ((2 + 1) + 2, 2)
+
+        # an executor on a pipeline is used by its stages
+        p = increment_ints() | double_adds()
+        p.executor = executor
+        assert p(f)() == expected
+        assert p.transform(Code.from_pyfunc(f)).to_pycode() == (
+            serial.transform(Code.from_pyfunc(f)).to_pycode()
+        )
+        assert p.cache_key() == serial.cache_key()
+
+    class local(CodeTransformer):
+        @pattern(LOAD_CONST)
+        def _(self, instr):
+            yield LOAD_CONST(instr.arg).steal(instr)
+
+    with ThreadPoolExecutor(2) as executor:
+        # transformers that cannot be pickled are applied in this thread
+        t = local()
+        t.executor = executor
+        assert t(f)() == f()
+
+        # nested code objects that do not change are kept as is
+        code = Code.from_pyfunc(f)
+        t = double_adds()
+        t.executor = executor
+        consts = t.transform(code).consts
+        g, C = (
+            next(c for c in consts if getattr(c, 'co_name', None) == name)
+            for name in ('g', 'C')
+        )
+        assert g is not f.__code__.co_consts[1]
+        assert C is f.__code__.co_consts[3]
+
+
+class reject_ints(CodeTransformer):
+    calls = 0
+
+    @pattern(LOAD_CONST)
+    def _(self, instr):
+        if isinstance(instr.arg, int):
+            type(self).calls += 1
+            raise ValueError('no ints allowed')
+        yield instr
+
+
+class box_ints(CodeTransformer):
+    @pattern(LOAD_CONST)
+    def _(self, instr):
+        if isinstance(instr.arg, int):
+            yield LOAD_CONST([instr.arg]).steal(instr)
+        else:
+            yield instr
+
+
+def test_transform_errors_in_executor():
+    def f():  # pragma: no cover
+        def g():
+            return 1
+
+        return g()
+
+    with ThreadPoolExecutor(1) as executor:
+        # errors from the transformer are not retried in this thread
+        reject_ints.calls = 0
+        t = reject_ints()
+        t.executor = executor
+        with pytest.raises(ValueError):
+            t(f)
+        assert reject_ints.calls == 1
+
+        # results that cannot be marshalled are transformed in this thread
+        t = box_ints()
+        t.executor = executor
+        assert t(f)() == [1]
+
+    with ProcessPoolExecutor(1) as executor:
+        reject_ints.calls = 0
+        result, = reject_ints().transform_many([f], executor=executor)
+        assert isinstance(result.error, ValueError)
+        assert reject_ints.calls == 0
+
+        result, = box_ints().transform_many([f], executor=executor)
+        assert result.error is None
+        assert result.function() == [1]
+
+
+class strict_increment_ints(CodeTransformer):
+    @pattern(LOAD_CONST)
+    def _(self, instr):
+        if isinstance(instr.arg, str):
+            raise TypeError('no strings allowed')
+        if isinstance(instr.arg, int):
+            yield LOAD_CONST(instr.arg + 1).steal(instr)
+        else:
+            yield instr
+
+
+def _make_adder(n):
+    def adder(a):  # pragma: no cover
+        return a + n + 1
+    return adder
+
+
+def _one():  # pragma: no cover
+    return 1
+
+
+def _string():  # pragma: no cover
+    return 'a'
+
+
+def _name(a):  # pragma: no cover
+    return a
+
+
+def test_transform_many():
+    functions = [_make_adder(1), _one, _make_adder(2), _string, len, _name]
+
+    def check(results):
+        assert [r.original for r in results] == functions
+        assert all(isinstance(r, TransformResult) for r in results)
+        assert all(r.seconds >= 0 for r in results)
+
+        adder1, one, adder2, string, builtin, name = results
+        # closures keep their own cells
+        assert adder1.function(1) == 4
+        assert adder2.function(1) == 5
+        assert adder1.function.__code__ is adder2.function.__code__
+        assert adder1.seconds == adder2.seconds
+        assert one.function() == 2
+        assert one.error is None
+
+        assert string.function is None
+        assert isinstance(string.error, TypeError)
+        assert builtin.function is None
+        assert isinstance(builtin.error, AttributeError)
+
+        # unchanged functions are returned as is
+        assert name.function is _name
+        assert name.error is None
+
+    t = strict_increment_ints()
+    check(t.transform_many(functions))
+    with ThreadPoolExecutor(2) as executor:
+        check(t.transform_many(functions, executor=executor))
+    with ProcessPoolExecutor(1) as executor:
+        check(t.transform_many(functions, executor=executor))
+
+    assert t.transform_many([]) == []
+
+    # separately compiled copies of the same code are transformed once
+    copies = []
+    for _ in range(2):
+        ns = {}
+        exec(compile('def f():\n    return 1\n', '<copy>', 'exec'), ns)
+        copies.append(ns['f'])
+    assert copies[0].__code__ is not copies[1].__code__
+    first, second = t.transform_many(copies)
+    assert first.function() == second.function() == 2
+    assert first.function.__code__ is second.function.__code__
+
+    # the filename is part of the key
+    ns = {}
+    exec(compile('def f():\n    return 1\n', '<other>', 'exec'), ns)
+    _, other = t.transform_many([copies[0], ns['f']])
+    assert other.function.__code__.co_filename == '<other>'
+
+    # equal constants of different types are kept apart
+    ns = {}
+    exec(compile('def f():\n    return 1.0\n', '<copy>', 'exec'), ns)
+    _, other = t.transform_many([copies[0], ns['f']])
+    assert other.function() == 1.0
@@ -0,0 +1,227 @@
+import os
+import sys
+from textwrap import dedent
+
+import pytest
+
+from codetransformer import CodeTransformer, pattern
+from codetransformer.__main__ import main
+from codetransformer.importer import (
+    TransformerFinder,
+    _module_name,
+    compile_paths,
+    resolve_transformer,
+    transformer_tag,
+)
+from codetransformer.instructions import LOAD_CONST
+from codetransformer.transformers import asconstants
+
+
+class add(CodeTransformer):
+    calls = 0
+
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+
+    def transform(self, code, **kwargs):
+        type(self).calls += 1
+        return super().transform(code, **kwargs)
+
+    @pattern(LOAD_CONST)
+    def _load_const(self, instr):
+        if isinstance(instr.arg, int):
+            yield LOAD_CONST(instr.arg + self.n).steal(instr)
+        else:
+            yield instr
+
+
+add_one = add(1)
+
+
+@pytest.yield_fixture
+def modules(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+    tmpdir.join('ct_test_module.py').write(dedent(
+        """\
+        a = 1
+
+        def f():
+            def g():
+                return 2
+            return g()
+        """,
+    ))
+    tmpdir.join('ct_test_other.py').write('a = 1\n')
+    sys.path.insert(0, str(tmpdir))
+    try:
+        yield tmpdir
+    finally:
+        sys.path.remove(str(tmpdir))
+        for name in 'ct_test_module', 'ct_test_other':
+            sys.modules.pop(name, None)
+
+
+def test_import_hook(modules):
+    add.calls = 0
+    with TransformerFinder(add(1), 'ct_test_mod*') as finder:
+        import ct_test_module
+        import ct_test_other
+
+    assert finder not in sys.meta_path
+
+    # module level code and nested functions are transformed
+    assert ct_test_module.a == 2
+    assert ct_test_module.f() == 3
+    assert ct_test_other.a == 1
+
+    pycache = modules.join('__pycache__')
+    tag = transformer_tag(add(1))[:16]
+    cached, = (
+        name for name in os.listdir(str(pycache)) if tag in name
+    )
+    assert ct_test_module.__cached__ == str(pycache.join(cached))
+    calls = add.calls
+
+    # the transformed bytecode is loaded without transforming again
+    del sys.modules['ct_test_module']
+    with TransformerFinder(add(1), 'ct_test_mod*'):
+        import ct_test_module
+    assert ct_test_module.f() == 3
+    assert add.calls == calls
+
+    # a differently configured transformer has its own cache
+    del sys.modules['ct_test_module']
+    with TransformerFinder(add(2), 'ct_test_mod*'):
+        import ct_test_module
+    assert ct_test_module.f() == 4
+    assert add.calls > calls
+
+
+def test_import_hook_source_changed(modules):
+    with TransformerFinder(add(1), 'ct_test_module'):
+        import ct_test_module
+    assert ct_test_module.a == 2
+
+    del sys.modules['ct_test_module']
+    modules.join('ct_test_module.py').write('a = 10 \n')
+    with TransformerFinder(add(1), 'ct_test_module'):
+        import ct_test_module
+    assert ct_test_module.a == 11
+
+
+def test_import_hook_uncacheable(modules):
+    t = asconstants(b=bytearray())
+    assert transformer_tag(t) is None
+
+    with TransformerFinder(t, 'ct_test_module'):
+        import ct_test_module
+
+    # the transformed code is not written to disk
+    assert not modules.join('__pycache__').check()
+    assert ct_test_module.a == 1
+
+
+def test_no_patterns():
+    with pytest.raises(TypeError):
+        TransformerFinder(add(1))
+
+
+def test_compile_paths(modules):
+    name = __name__ + ':add_one'
+    path = str(modules)
+    source = str(modules.join('ct_test_module.py'))
+    other = str(modules.join('ct_test_other.py'))
+
+    assert compile_paths(name, [path], jobs=1) == ([source, other], [])
+    # the bytecode is up to date
+    assert compile_paths(name, [path], jobs=1) == ([], [])
+
+    # touching a file does not change its contents
+    st = os.stat(source)
+    os.utime(source, (st.st_atime + 10, st.st_mtime + 10))
+    assert compile_paths(name, [path], jobs=1) == ([], [])
+
+    modules.join('ct_test_module.py').write('a = 10\n')
+    assert compile_paths(name, [path], jobs=2) == ([source], [])
+    assert compile_paths(name, [other], jobs=2, force=True) == ([other], [])
+
+    add.calls = 0
+    with TransformerFinder(add(1), 'ct_test_*'):
+        import ct_test_module
+        import ct_test_other
+    assert ct_test_module.a == 11
+    assert ct_test_other.a == 2
+    # everything was loaded from the precompiled bytecode
+    assert add.calls == 0
+
+    with pytest.raises(ValueError):
+        compile_paths(
+            'codetransformer.transformers:asconstants',
+            [path],
+            jobs=1,
+        )
+
+
+def test_module_name(tmpdir):
+    sub = tmpdir.mkdir('pkg').mkdir('sub')
+    tmpdir.join('pkg', '__init__.py').write('')
+    sub.join('__init__.py').write('')
+    sub.join('mod.py').write('')
+    tmpdir.join('top.py').write('')
+
+    assert _module_name(str(sub.join('__init__.py'))) == 'pkg.sub'
+    assert _module_name(str(sub.join('mod.py'))) == 'pkg.sub.mod'
+    assert _module_name(str(tmpdir.join('pkg', '__init__.py'))) == 'pkg'
+    assert _module_name(str(tmpdir.join('top.py'))) == 'top'
+
+
+def test_compile_unmarshallable(modules, capsys):
+    # precomputed_slices puts slice objects in the constants which cannot be
+    # marshalled
+    name = 'codetransformer.transformers:precomputed_slices'
+    modules.join('ct_test_slice.py').write('def f(a):\n    return a[1:2]\n')
+    path = str(modules)
+    source = str(modules.join('ct_test_slice.py'))
+
+    written, failed = compile_paths(name, [path], jobs=1)
+    assert failed == [source]
+    assert source not in written
+
+    assert main(['compile', '-j', '1', '-q', name, path]) == 1
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert err == (
+        'could not write %s: the transformed code cannot be marshalled\n'
+        % source
+    )
+
+
+def test_resolve_transformer():
+    assert resolve_transformer(__name__ + ':add_one') is add_one
+    assert isinstance(
+        resolve_transformer('codetransformer.transformers:asconstants'),
+        asconstants,
+    )
+    with pytest.raises(ValueError):
+        resolve_transformer(__name__)
+    with pytest.raises(TypeError):
+        resolve_transformer(__name__ + ':test_resolve_transformer')
+
+
+def test_main(modules, capsys):
+    name = __name__ + ':add_one'
+    path = str(modules)
+    assert main(['compile', '-j', '1', name, path]) == 0
+    out, _ = capsys.readouterr()
+    assert out == ''.join(
+        'transformed %s\n' % modules.join(module)
+        for module in ('ct_test_module.py', 'ct_test_other.py')
+    )
+
+    assert main(['compile', '-j', '1', '-f', '-q', name, path]) == 0
+    out, _ = capsys.readouterr()
+    assert out == ''
+
+    with pytest.raises(SystemExit):
+        main(['compile', '-j', '1', 'not_a_module:t', path])
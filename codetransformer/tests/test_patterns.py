@@ -0,0 +1,371 @@
+from time import perf_counter
+
+import pytest
+
+from codetransformer import CodeTransformer, Code, pattern
+from codetransformer.instructions import (
+    BINARY_ADD,
+    COMPARE_OP,
+    LOAD_CONST,
+    LOAD_GLOBAL,
+    LOAD_FAST,
+    RETURN_VALUE,
+    UNARY_POSITIVE,
+)
+from codetransformer.patterns import (
+    ALL_OPCODES,
+    COMPLEXITY_THRESHOLD,
+    PatternComplexityWarning,
+    capture,
+    matchany,
+    matchable,
+    matchview,
+    modifier,
+    option,
+    plus,
+    seq,
+    var,
+)
+from codetransformer.utils.instance import instance
+
+
+def test_first_opcodes():
+    const = LOAD_CONST.opcode
+    fast = LOAD_FAST.opcode
+    add = BINARY_ADD.opcode
+
+    assert LOAD_CONST.first_opcodes() == ({const}, False)
+    assert matchany.first_opcodes() == (ALL_OPCODES, False)
+    assert seq(LOAD_CONST, LOAD_FAST).first_opcodes() == ({const}, False)
+    assert (LOAD_CONST | LOAD_FAST).first_opcodes() == (
+        {const, fast},
+        False,
+    )
+    assert seq(LOAD_CONST[var], LOAD_FAST).first_opcodes() == (
+        {const, fast},
+        False,
+    )
+    assert seq(LOAD_CONST[option], LOAD_FAST[plus]).first_opcodes() == (
+        {const, fast},
+        False,
+    )
+    assert seq(LOAD_CONST[var], LOAD_FAST[0, 2]).first_opcodes() == (
+        {const, fast},
+        True,
+    )
+    assert seq(LOAD_CONST[2], BINARY_ADD).first_opcodes() == (
+        {const},
+        False,
+    )
+    assert (~LOAD_CONST).first_opcodes() == (ALL_OPCODES - {const}, False)
+    assert (~seq(LOAD_CONST, BINARY_ADD)).first_opcodes() == (
+        ALL_OPCODES,
+        True,
+    )
+    assert seq(LOAD_FAST[var], ...).first_opcodes() == (ALL_OPCODES, False)
+    assert add not in seq(LOAD_FAST, BINARY_ADD).first_opcodes()[0]
+
+
+def test_dispatch_skips_to_candidates():
+    @instance
+    class c(CodeTransformer):
+        matches = []
+
+        @pattern(BINARY_ADD, RETURN_VALUE)
+        def _(self, *instrs):
+            self.matches.append(instrs)
+            yield from instrs
+
+    def f(a, b):  # pragma: no cover
+        c = a + b
+        d = c + a
+        return d + b
+
+    code = Code.from_pyfunc(f)
+    transformed = c.transform(code)
+    assert [tuple(map(type, m)) for m in c.matches] == [
+        (BINARY_ADD, RETURN_VALUE),
+    ]
+    # the skipped instructions are passed through as is
+    assert transformed.instrs == code.instrs
+
+
+def _longest_match(p, *types):
+    """The length of the longest match of ``p`` at the start of ``types``.
+    """
+    ends = p._compiled.match(bytes(t.opcode for t in types))
+    return ends[0][1] if ends else None
+
+
+def test_matchany_matches_every_opcode():
+    # UNARY_POSITIVE is opcode 10 which is a newline in a regex
+    assert UNARY_POSITIVE.opcode == ord('\n')
+    assert _longest_match(pattern(...), UNARY_POSITIVE) == 1
+    assert _longest_match(
+        pattern(LOAD_CONST, matchany[var], RETURN_VALUE),
+        LOAD_CONST,
+        UNARY_POSITIVE,
+        RETURN_VALUE,
+    ) == 3
+
+
+def test_default_mcompile():
+    class digits(matchable):
+        def first_opcodes(self):
+            return frozenset({LOAD_CONST.opcode, LOAD_FAST.opcode}), False
+
+    p = pattern(digits()[plus], RETURN_VALUE)
+    assert _longest_match(p, LOAD_CONST, LOAD_FAST, RETURN_VALUE) == 3
+    assert _longest_match(p, LOAD_GLOBAL, RETURN_VALUE) is None
+
+
+def test_modifier():
+    class incomplete(modifier):
+        _token = b'?'
+
+    with pytest.raises(TypeError):
+        incomplete()
+
+    # a modifier on its own modifies ``...``
+    assert _longest_match(
+        pattern(LOAD_CONST, var, RETURN_VALUE),
+        LOAD_CONST,
+        UNARY_POSITIVE,
+        BINARY_ADD,
+        RETURN_VALUE,
+    ) == 4
+
+
+def test_matchrange():
+    consts = (LOAD_CONST,) * 5
+    assert _longest_match(pattern(LOAD_CONST[3]), *consts) == 3
+    assert _longest_match(pattern(LOAD_CONST[3]), *consts[:2]) is None
+    assert _longest_match(pattern(LOAD_CONST[2, 4]), *consts) == 4
+    assert _longest_match(pattern(LOAD_CONST[2, 4]), *consts[:3]) == 3
+    assert _longest_match(pattern(LOAD_CONST[2, 4]), *consts[:1]) is None
+
+
+def test_not():
+    p = pattern(~LOAD_CONST)
+    assert _longest_match(p, LOAD_FAST, LOAD_FAST) == 1
+    assert _longest_match(p, LOAD_CONST) is None
+
+    # the not of a sequence is the longest run that does not contain it
+    p = pattern(~seq(LOAD_CONST, BINARY_ADD), RETURN_VALUE)
+    assert _longest_match(
+        p,
+        LOAD_CONST,
+        LOAD_FAST,
+        BINARY_ADD,
+        RETURN_VALUE,
+    ) == 4
+    assert _longest_match(
+        p,
+        LOAD_FAST,
+        LOAD_CONST,
+        BINARY_ADD,
+        RETURN_VALUE,
+    ) is None
+
+    assert _longest_match(pattern(~matchany), LOAD_CONST) is None
+
+
+def test_nested_not_is_linear():
+    # ``((?!(ab)).)*`` repeated like this backtracks exponentially with re
+    p = pattern(
+        (~seq(LOAD_CONST, BINARY_ADD))[var],
+        (~seq(LOAD_FAST, BINARY_ADD))[var],
+        RETURN_VALUE,
+    )
+    opcodes = bytes((LOAD_CONST.opcode, LOAD_FAST.opcode)) * 50000
+
+    start = perf_counter()
+    assert not p._compiled.match(opcodes)
+    assert perf_counter() - start < 5
+
+
+def test_complexity():
+    assert pattern(LOAD_CONST).complexity == 2
+    assert (
+        pattern(LOAD_CONST[2, 4]).complexity >
+        pattern(LOAD_CONST[2]).complexity
+    )
+
+    with pytest.warns(PatternComplexityWarning):
+        p = pattern(LOAD_CONST[COMPLEXITY_THRESHOLD])
+    assert p.complexity > COMPLEXITY_THRESHOLD
+
+
+def test_where():
+    @instance
+    class c(CodeTransformer):
+        names = {'a'}
+        calls = []
+
+        @pattern(LOAD_GLOBAL.where(lambda self, i: i.arg in self.names))
+        def _load_global(self, instr):
+            self.calls.append(instr.arg)
+            yield LOAD_CONST(1).steal(instr)
+
+        @pattern(LOAD_CONST.where(arg__isinstance=str), RETURN_VALUE)
+        def _return_str(self, load_const, return_value):
+            self.calls.append(load_const.arg)
+            yield LOAD_CONST(load_const.arg * 2).steal(load_const)
+            yield return_value
+
+    def f():  # pragma: no cover
+        return a + b  # noqa
+
+    def g():  # pragma: no cover
+        return 'ayy'
+
+    def h():  # pragma: no cover
+        return 1
+
+    code = Code.from_pyfunc(f)
+    transformed = c.transform(code)
+    assert [type(i) for i in transformed] == [
+        LOAD_CONST,
+        LOAD_GLOBAL,
+        BINARY_ADD,
+        RETURN_VALUE,
+    ]
+    # the handler is only called on the instructions that pass the tests
+    assert c.calls == ['a']
+
+    del c.calls[:]
+    assert c.transform(Code.from_pyfunc(g))[0].arg == 'ayyayy'
+    c.transform(Code.from_pyfunc(h))
+    assert c.calls == ['ayy']
+
+
+def test_where_lookups():
+    m = LOAD_CONST.where(arg__in={1, 2})
+    assert m.test(None, LOAD_CONST(1))
+    assert not m.test(None, LOAD_CONST(3))
+    assert LOAD_CONST.where(arg=1).test(None, LOAD_CONST(1))
+    assert LOAD_CONST.where(arg__ne=1).test(None, LOAD_CONST(2))
+    assert LOAD_CONST.where(arg__is=None).test(None, LOAD_CONST(None))
+    assert not m.where(arg__ne=1).test(None, LOAD_CONST(1))
+
+    with pytest.raises(TypeError):
+        LOAD_CONST.where(arg__startswith='a')
+    with pytest.raises(TypeError):
+        seq(LOAD_CONST, LOAD_FAST).where(arg=1)
+    with pytest.raises(TypeError):
+        pattern(~seq(LOAD_CONST.where(arg=1), LOAD_FAST))
+
+    assert repr(LOAD_CONST.where(arg__in=(1,))) == (
+        'LOAD_CONST.where(arg__in=(1,))'
+    )
+
+
+def test_instruction_instance_pattern():
+    def _matches(m, *instrs):
+        p = pattern(m)
+        ends = p._compiled.match(
+            bytes(instr.opcode for instr in instrs),
+            0,
+            instrs,
+        )
+        return ends[0][1] if ends else None
+
+    m = COMPARE_OP.EXCEPTION_MATCH
+    assert _matches(m, COMPARE_OP.EXCEPTION_MATCH) == 1
+    assert _matches(m, COMPARE_OP.LT) is None
+
+    not_m = ~COMPARE_OP.where(arg=COMPARE_OP.comparator.EXCEPTION_MATCH)
+    assert _matches(not_m, COMPARE_OP.LT) == 1
+    assert _matches(not_m, LOAD_CONST(1)) == 1
+    assert _matches(not_m, COMPARE_OP.EXCEPTION_MATCH) is None
+    assert _matches(m | LOAD_CONST, LOAD_CONST(1)) == 1
+    assert _matches(LOAD_CONST | m, COMPARE_OP.EXCEPTION_MATCH) == 1
+
+
+def test_capture():
+    @instance
+    class c(CodeTransformer):
+        calls = []
+
+        @pattern(
+            capture('consts', LOAD_CONST[var]),
+            capture('fasts', LOAD_FAST[plus], LOAD_FAST[var]),
+            BINARY_ADD,
+        )
+        def _add(self, add, *, consts, fasts):
+            self.calls.append((
+                add,
+                type(consts),
+                [type(i) for i in consts],
+                [type(i) for i in fasts],
+                fasts.start,
+                fasts.stop,
+            ))
+            yield from consts
+            yield from fasts
+            yield add
+
+    def f(a, b):  # pragma: no cover
+        return a + b
+
+    code = Code.from_pyfunc(f)
+    transformed = c.transform(code)
+    assert transformed.instrs == code.instrs
+    [(add, view_type, consts, fasts, start, stop)] = c.calls
+    assert isinstance(add, BINARY_ADD)
+    assert view_type is matchview
+    assert consts == []
+    # the first capture takes as much as it can
+    assert fasts == [LOAD_FAST, LOAD_FAST]
+    assert (start, stop) == (0, 2)
+
+
+def test_capture_redispatch():
+    @instance
+    class c(CodeTransformer):
+        @pattern(LOAD_CONST, capture('body', matchany[var]), RETURN_VALUE)
+        def _body(self, load_const, return_value, *, body):
+            yield load_const
+            # dispatch on the view without copying the instructions
+            yield from self.patterndispatcher(body)
+            yield return_value
+
+        @pattern(LOAD_FAST)
+        def _load_fast(self, instr):
+            yield LOAD_CONST(2).steal(instr)
+
+    def f(a):  # pragma: no cover
+        return 1 + a
+
+    out = c.transform(Code.from_pyfunc(f)).instrs
+    assert [type(i) for i in out] == [
+        LOAD_CONST,
+        LOAD_CONST,
+        BINARY_ADD,
+        RETURN_VALUE,
+    ]
+    assert out[1].arg == 2
+
+
+def test_matchview():
+    instrs = (LOAD_CONST(1), LOAD_FAST('a'), BINARY_ADD(), RETURN_VALUE())
+    opcodes = bytes(instr.opcode for instr in instrs)
+    view = matchview(opcodes, instrs, 1, 3)
+
+    assert len(view) == 2
+    assert list(view) == list(instrs[1:3])
+    assert view[0] is instrs[1]
+    assert view[-1] is instrs[2]
+    assert view[:1] == instrs[1:2]
+    assert bytes(view.opcodes) == opcodes[1:3]
+    with pytest.raises(IndexError):
+        view[2]
+
+
+def test_capture_errors():
+    with pytest.raises(TypeError):
+        pattern(capture('a', LOAD_CONST), capture('a', LOAD_FAST))
+    with pytest.raises(TypeError):
+        pattern(seq(capture('a', LOAD_CONST), LOAD_FAST), RETURN_VALUE)
+    with pytest.raises(TypeError):
+        pattern(seq(capture('a', LOAD_CONST), LOAD_FAST))
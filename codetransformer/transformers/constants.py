@@ -117,14 +117,13 @@ class asconstants(CodeTransformer):
             )
         return super().transform(code, **kwargs)
 
-    @pattern(LOAD_NAME | LOAD_GLOBAL | LOAD_DEREF | LOAD_CLASSDEREF)
+    @pattern(
+        (LOAD_NAME | LOAD_GLOBAL | LOAD_DEREF | LOAD_CLASSDEREF).where(
+            lambda self, instr: instr.arg in self._constnames,
+        ),
+    )
     def _load_name(self, instr):
-        name = instr.arg
-        if name not in self._constnames:
-            yield instr
-            return
-
-        yield LOAD_CONST(self._constnames[name]).steal(instr)
+        yield LOAD_CONST(self._constnames[instr.arg]).steal(instr)
 
     _store = pattern(
         STORE_NAME | STORE_GLOBAL | STORE_DEREF | STORE_FAST,
@@ -63,20 +63,19 @@ class interpolated_strings(CodeTransformer):
             out.append(str)
         return tuple(out)
 
-    @pattern(LOAD_CONST)
+    @pattern(LOAD_CONST.where(
+        lambda self, instr: isinstance(
+            instr.arg,
+            (tuple, frozenset) + self.types,
+        ),
+    ))
     def _load_const(self, instr):
         const = instr.arg
 
         if isinstance(const, (tuple, frozenset)):
             yield from self._transform_constant_sequence(const)
-            return
-
-        if isinstance(const, bytes) and self._transform_bytes:
-            yield from self.transform_stringlike(const)
-        elif isinstance(const, str) and self._transform_str:
-            yield from self.transform_stringlike(const)
         else:
-            yield instr
+            yield from self.transform_stringlike(const)
 
     def _transform_constant_sequence(self, seq):
         """
@@ -6,7 +6,7 @@ from textwrap import dedent
 
 from .. import instructions
 from ..core import CodeTransformer
-from ..patterns import pattern,  matchany, var
+from ..patterns import capture, pattern, matchany, var
 from ..utils.instance import instance
 
 
@@ -52,8 +52,12 @@ class overloaded_dicts(CodeTransformer):
         super().__init__()
         self.astype = astype
 
-    @pattern(instructions.BUILD_MAP, matchany[var], instructions.MAP_ADD)
-    def _start_comprehension(self, instr, *instrs):
+    @pattern(
+        instructions.BUILD_MAP,
+        capture('body', matchany[var]),
+        instructions.MAP_ADD,
+    )
+    def _start_comprehension(self, instr, map_add, *, body):
         yield instructions.LOAD_CONST(self.astype).steal(instr)
         # TOS  = self.astype
 
@@ -62,7 +66,6 @@ class overloaded_dicts(CodeTransformer):
 
         yield instructions.STORE_FAST('__map__')
 
-        *body, map_add = instrs
         yield from self.patterndispatcher(body)
         # TOS  = k
         # TOS1 = v
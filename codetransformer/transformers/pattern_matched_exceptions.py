@@ -108,9 +108,6 @@ class pattern_matched_exceptions(CodeTransformer):
         del CALL_FUNCTION_EX
         del BUILD_TUPLE_UNPACK_WITH_CALL
 
-    @pattern(COMPARE_OP)
+    @pattern(COMPARE_OP.EXCEPTION_MATCH)
     def _compare_op(self, instr):
-        if instr.equiv(COMPARE_OP.EXCEPTION_MATCH):
-            yield from self._match(instr)
-        else:
-            yield instr
+        yield from self._match(instr)
@@ -1,6 +1,6 @@
 from codetransformer.core import CodeTransformer
 from codetransformer.instructions import LOAD_CONST, BUILD_SLICE
-from codetransformer.patterns import pattern, plus
+from codetransformer.patterns import capture, pattern, plus
 
 
 class precomputed_slices(CodeTransformer):
@@ -26,13 +26,14 @@ class precomputed_slices(CodeTransformer):
                   6 BINARY_SUBSCR
                   7 RETURN_VALUE
     """
-    @pattern(LOAD_CONST[plus], BUILD_SLICE)
-    def make_constant_slice(self, *instrs):
-        *loads, build = instrs
+    @pattern(capture('loads', LOAD_CONST[plus]), BUILD_SLICE)
+    def make_constant_slice(self, build, *, loads):
         if build.arg != len(loads):
             # There are non-constant loads before the consts:
             # e.g. x[<non-const expr>:1:2]
-            yield from instrs
+            yield from loads
+            yield build
+            return
 
         slice_ = slice(*(instr.arg for instr in loads))
         yield LOAD_CONST(slice_).steal(loads[0])
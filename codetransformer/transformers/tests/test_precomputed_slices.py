@@ -35,3 +35,14 @@ def test_precomputed_slices_non_const():
 
     for orig, xformed in zip(f_instrs, transformed_instrs):
         assert orig.equiv(xformed)
+
+
+def test_precomputed_slices_mixed_const():
+
+    @precomputed_slices()
+    def f(a, b):
+        return a[b:5:2]
+
+    values = list(range(10))
+    assert f(values, 1) == values[1:5:2]
+    assert BUILD_SLICE in set(map(type, Code.from_pyfunc(f).instrs))
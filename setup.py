@@ -34,6 +34,15 @@ setup(
     ],
     url='https://github.com/llllllllll/codetransformer',
     install_requires=['toolz'],
+    # build_transformed is registered as an entry point instead of in
+    # cmdclass so that it is available to the projects that install
+    # codetransformer, and so that this file does not need to import
+    # codetransformer, and its dependencies, before they are installed.
+    entry_points={
+        'distutils.commands': [
+            'build_transformed = codetransformer.command:build_transformed',
+        ],
+    },
     extras_require={
         'dev': [
             'flake8==3.3.0',